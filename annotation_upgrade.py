@@ -0,0 +1,227 @@
+"""
+This script upgrades PGN files that were annotated with a small budget (e.g. Lc0 at 2500 nodes) without annotating
+them again. The expected point loss of each move is calculated from the existing [%eval] (Stockfish) or [%wdl] (Lc0)
+annotations as the analyzers do, and a move is selected when a deeper search could change the metrics:
+- its loss is within a margin of a blunder, mistake or inaccuracy threshold of the analyzer, so the count may change
+- its loss (or gain) is a large swing, where a shallow search is most often wrong
+The positions before and after the selected moves are searched again with a higher budget and only their annotations
+are replaced; the other comments are kept and the files are rewritten in place. The stats of each game are calculated
+before and after, and a report with the number of upgraded plies and the changes of GI, missed points and counts is
+written and summarized.
+"""
+
+import chess
+import chess.pgn
+import csv
+import instrumentation
+import os
+import re
+from chess.engine import Cp
+from pgn_io import open_pgn, is_pgn_file, is_compressed
+from game_metrics import extract_eval_from_node, extract_wdl_from_node, calculate_expected_value
+
+# margin: a move is selected when its expected point loss is within this of a threshold
+# swing: a move is selected when its expected point loss or gain is at least this
+# depth: Stockfish search depth of the selected plies
+# nodes: Lc0 nodes of the selected plies
+UPGRADE_DEFAULTS = {
+    'margin': 0.02,
+    'swing': 0.3,
+    'depth': 30,
+    'nodes': 20000,
+}
+
+# Inaccuracy, mistake and blunder thresholds of the analyzers (the Lc0 ones are multiplied by the win value)
+STOCKFISH_THRESHOLDS = {'white': [0.05, 0.2, 0.5], 'black': [0.05, 0.2, 0.5]}
+LC0_THRESHOLDS = {'white': [0.07, 0.15, 0.30], 'black': [0.07, 0.20, 0.23]}
+
+# Annotations replaced by the upgrade
+EVAL_PATTERN = re.compile(r'\[%eval [^\]]+\]')
+EVAL_LC0_PATTERN = re.compile(r'\[%eval_lc0 [^\]]+\]')
+WDL_PATTERN = re.compile(r'\[%wdl \[[^\]]*\]\]')
+
+# Metrics compared before and after the upgrade
+REPORT_METRICS = ['white_gi', 'black_gi', 'white_missed_points', 'black_missed_points']
+REPORT_COUNTS = ['white_inaccuracy', 'white_mistake', 'white_blunder', 'black_inaccuracy', 'black_mistake', 'black_blunder']
+
+# Function to get the expected point loss of each move from the Stockfish evaluations, as gi_and_gpl of
+# pgn_evaluation_fast_analyzer.py. Returns (index of the node before, index of the node after, player, loss).
+def stockfish_move_losses(nodes, wdl_values):
+    evaluated = [(i, evaluation) for i, evaluation in enumerate(extract_eval_from_node(node) for node in nodes) if evaluation is not None]
+    if not evaluated:
+        return []
+    # As stockfish_pawns_list, the initial value is the first evaluation
+    evaluated = [evaluated[0]] + evaluated
+    losses = []
+    for j in range(1, len(evaluated)):
+        turn = "White" if j % 2 == 0 else "Black"
+        expected = []
+        for evaluation in (evaluated[j - 1][1], evaluated[j][1]):
+            wdl = Cp(int(100 * evaluation)).wdl()
+            expected.append(calculate_expected_value(wdl.wins / 1000, wdl.draws / 1000, wdl.losses / 1000, turn, wdl_values))
+        (premove_white, premove_black), (postmove_white, postmove_black) = expected
+        if turn == "Black":
+            losses.append((evaluated[j - 1][0], evaluated[j][0], 'white', postmove_white - premove_white))
+        else:
+            losses.append((evaluated[j - 1][0], evaluated[j][0], 'black', premove_black - postmove_black))
+    return losses
+
+# Function to get the expected point loss of each move from the Lc0 WDLs, as gi_and_gpl of
+# pgn_evaluation_fast_analyzer_lc0.py (missing WDLs are filled with the previous one)
+def lc0_move_losses(nodes, wdl_values):
+    wdl_list, annotated = [], []
+    for i, node in enumerate(nodes):
+        wdl = extract_wdl_from_node(node)
+        if wdl is not None:
+            annotated.append(i)
+        wdl_list.append(wdl if wdl is not None else (wdl_list[-1] if wdl_list else [0.33, 0.34, 0.33]))
+    losses = []
+    for i in range(1, len(wdl_list)):
+        turn = "White" if i % 2 == 0 else "Black"
+        premove_white, premove_black = calculate_expected_value(*wdl_list[i - 1], turn, wdl_values)
+        postmove_white, postmove_black = calculate_expected_value(*wdl_list[i], turn, wdl_values)
+        if turn == "Black":
+            losses.append((i - 1, i, 'white', postmove_white - premove_white))
+        else:
+            losses.append((i - 1, i, 'black', premove_black - postmove_black))
+    return losses
+
+# Function to select the plies (node indices) of a game to search again
+def select_plies(nodes, engine, wdl_values, settings):
+    if engine == 'stockfish':
+        losses, thresholds = stockfish_move_losses(nodes, wdl_values), STOCKFISH_THRESHOLDS
+    else:
+        losses, thresholds = lc0_move_losses(nodes, wdl_values), {player: [t * wdl_values[0] for t in values] for player, values in LC0_THRESHOLDS.items()}
+    selected = set()
+    for before, after, player, loss in losses:
+        near_threshold = any(abs(loss - threshold) <= settings['margin'] for threshold in thresholds[player])
+        if near_threshold or abs(loss) >= settings['swing']:
+            selected.update((before, after))
+    # Finished positions are scored by the rules, a deeper search does not change them
+    return sorted(i for i in selected if not nodes[i].board().is_game_over())
+
+# Function to replace an annotation in a comment, or add it if the comment does not have it
+def replace_annotation(comment, pattern, annotation):
+    if pattern.search(comment):
+        return pattern.sub(lambda match: annotation, comment, count=1)
+    return f"{comment} {annotation}" if comment else annotation
+
+# Function to search a ply again and replace its annotations, returns False if the search failed
+def upgrade_ply(engine, game, node, engine_name, settings):
+    board = node.board()
+    if engine_name == 'stockfish':
+        from stockfish_pgn_annotator import search_evaluation
+        evaluation = search_evaluation(engine, board, settings['depth'], game=game)
+        if evaluation is None:
+            return False
+        node.comment = replace_annotation(node.comment, EVAL_PATTERN, f"[%eval {evaluation}]")
+    else:
+        from lc0_pgn_annotator import evaluate_position_lc0
+        result = evaluate_position_lc0(engine, board, game, None, settings['nodes'], game_session=True)
+        if result is None or result[0] is None or sum(result[1]) == 0:
+            return False
+        evaluation, wdl = result
+        node.comment = replace_annotation(node.comment, EVAL_LC0_PATTERN, f"[%eval_lc0 {evaluation}]")
+        node.comment = replace_annotation(node.comment, WDL_PATTERN, f"[%wdl [{wdl[0]:.2f}, {wdl[1]:.2f}, {wdl[2]:.2f}]]")
+    return True
+
+# Function to calculate the stats of a game compared in the report, None if the game has no annotations
+def report_stats(game, engine_name, wdl_values, weighted):
+    if engine_name == 'stockfish':
+        from pgn_evaluation_fast_analyzer import analyze_game
+        game_data = analyze_game(game, wdl_values, weighted)
+    else:
+        from pgn_evaluation_fast_analyzer_lc0 import analyze_game_lc0
+        # The time control only changes the clock stats, which are not compared
+        game_data = analyze_game_lc0(game, wdl_values, [90, 30, 30], weighted)
+    if game_data is None:
+        return None
+    return {**{metric: game_data[metric] for metric in REPORT_METRICS}, **{count: game_data['counts'][count] for count in REPORT_COUNTS}}
+
+# Function to upgrade the games of a PGN file and rewrite it in place. Returns the report rows of its games.
+def upgrade_file(pgn_file_path, engine, engine_name, wdl_values, weighted, settings, dry_run=False):
+    rows = []
+    tmp_path = f"{pgn_file_path}.upgrade.tmp"
+    with open_pgn(pgn_file_path) as pgn, open(tmp_path, 'w') as output:
+        game_number = 0
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            game_number += 1
+            nodes = list(game.mainline())
+            plies = select_plies(nodes, engine_name, wdl_values, settings)
+            row = {'file': pgn_file_path, 'game': game_number, 'White': game.headers.get('White'), 'Black': game.headers.get('Black'),
+                   'plies': len(nodes), 'plies_selected': len(plies), 'plies_upgraded': 0}
+            before = report_stats(game, engine_name, wdl_values, weighted) if plies else None
+            if not dry_run:
+                row['plies_upgraded'] = sum(upgrade_ply(engine, game, nodes[i], engine_name, settings) for i in plies)
+            after = report_stats(game, engine_name, wdl_values, weighted) if row['plies_upgraded'] else before
+            for name in REPORT_METRICS + REPORT_COUNTS:
+                row[f'{name}_before'] = before[name] if before else None
+                row[f'{name}_after'] = after[name] if after else None
+            rows.append(row)
+            game.accept(chess.pgn.FileExporter(output))
+    if dry_run or not any(row['plies_upgraded'] for row in rows):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, pgn_file_path)
+    return rows
+
+# Function to print the summary of the report rows
+def print_upgrade_summary(rows):
+    plies = sum(row['plies'] for row in rows)
+    selected = sum(row['plies_selected'] for row in rows)
+    upgraded = sum(row['plies_upgraded'] for row in rows)
+    changed = [row for row in rows if row['plies_upgraded']]
+    print(f"{len(rows)} games, {selected} of {plies} plies selected ({100 * selected / max(plies, 1):.1f}%), {upgraded} upgraded in {len(changed)} games")
+    for name in REPORT_METRICS:
+        differences = [abs(row[f'{name}_after'] - row[f'{name}_before']) for row in changed if row[f'{name}_before'] is not None]
+        if differences:
+            print(f"  {name}: mean change {sum(differences) / len(differences):.3f}, max change {max(differences):.3f}")
+    for name in REPORT_COUNTS:
+        before = sum(row[f'{name}_before'] or 0 for row in changed)
+        after = sum(row[f'{name}_after'] or 0 for row in changed)
+        if before != after:
+            print(f"  {name}: {before} -> {after}")
+
+# Upgrade the annotations of the PGN files in input_pgn_dir (searched recursively) in place. engine_name is the engine
+# the files were annotated with, 'stockfish' or 'lc0' (engine_path is then the lc0 executable and weights its weights).
+# settings: see UPGRADE_DEFAULTS. With dry_run, the plies are only selected and counted. The report has one row per
+# game and is written to report_path if given. Returns the report rows.
+@instrumentation.timed_stage('upgrade_annotations')
+def main_upgrade_annotations(input_pgn_dir, engine_name, engine_path, wdl_values, weighted, settings=None, weights=None, supervisor=None, report_path=None, dry_run=False):
+    from engine_supervisor import open_supervised_engine
+    settings = {**UPGRADE_DEFAULTS, **(settings or {})}
+    if engine_name == 'stockfish':
+        engine_command, options = engine_path, None
+    else:
+        engine_command, options = [engine_path, f"--weights={weights}"], {"UCI_ShowWDL": True}
+    rows = []
+    engine = open_supervised_engine(engine_command, options, supervisor, name=engine_name) if not dry_run else None
+    try:
+        for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
+            for filename in sorted(filenames):
+                if not is_pgn_file(filename):
+                    continue
+                if is_compressed(filename):
+                    print(f"Skipping {filename}: compressed files cannot be rewritten in place")
+                    continue
+                rows.extend(upgrade_file(os.path.join(dirpath, filename), engine, engine_name, wdl_values, weighted, settings, dry_run))
+    finally:
+        if engine is not None:
+            engine.quit()
+    instrumentation.count('plies', sum(row['plies_upgraded'] for row in rows))
+    if report_path is not None and rows:
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    print_upgrade_summary(rows)
+    return rows
+
+if __name__ == "__main__":
+    # Example usage:
+    input_pgn_dir = '/path/to/WCC_matches/Lc0'
+    main_upgrade_annotations(input_pgn_dir, 'lc0', '/path/to/lc0', [1, 0.5, 0], True, {'nodes': 20000}, weights='/path/to/weights.pb.gz',
+                             report_path='/path/to/upgrade_report.csv')
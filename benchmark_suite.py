@@ -0,0 +1,166 @@
+"""
+This script benchmarks the CPU-bound stages of the pipeline (main_analyze, main_analyze_lc0, main_analyze_unified, main_json_to_csv,
+main_stats and main_summary_stats) on synthetic corpora generated by synthetic_pgn_generator.py. Each stage runs in a
+fresh process, so its wall time and peak memory are measured in isolation. The results are compared against stored
+baselines and regressions are flagged, together with the cold-start time of the main.py command line interface.
+Before the timings, equivalence_check.py checks that the optimized modes reproduce the numbers of the reference
+implementations. It runs offline and does not need any engine binary.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from synthetic_pgn_generator import main_generate_corpus
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCHMARK_STAGES = ['main_analyze', 'main_analyze_lc0', 'main_analyze_unified', 'main_json_to_csv', 'main_stats', 'main_summary_stats']
+CLI_STARTUP_COMMANDS = [['--help'], ['analyze', '--help'], ['stats', '--help']]
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# Function to get the peak resident set size of this process in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+# Function to run a single stage, runs in a fresh process and returns its wall time and peak memory
+def run_stage(stage, corpus_dir, work_dir, wdl_values=[1, 0.5, 0], plus_min_plus_sec=[90, 30, 30], weighted=False):
+    json_dir = os.path.join(work_dir, 'json')
+    json_lc0_dir = os.path.join(work_dir, 'json_lc0')
+    stats_dir = os.path.join(work_dir, 'Stats')
+    # Import before timing, so the import time of pandas etc. is not counted
+    if stage == 'main_analyze':
+        from pgn_evaluation_fast_analyzer import main_analyze
+        run = lambda: main_analyze(corpus_dir, json_dir, wdl_values, weighted)
+    elif stage == 'main_analyze_lc0':
+        from pgn_evaluation_fast_analyzer_lc0 import main_analyze_lc0
+        run = lambda: main_analyze_lc0(corpus_dir, json_lc0_dir, wdl_values, plus_min_plus_sec, weighted)
+    elif stage == 'main_analyze_unified':
+        from pgn_evaluation_unified_analyzer import main_analyze_unified
+        run = lambda: main_analyze_unified(corpus_dir, os.path.join(work_dir, 'json_unified'), wdl_values, plus_min_plus_sec, weighted)
+    elif stage == 'main_json_to_csv':
+        from json_to_csv_converter import main_json_to_csv
+        run = lambda: main_json_to_csv(json_dir, stats_dir, 'bench')
+    elif stage == 'main_stats':
+        from csv_to_player_stats import main_stats
+        run = lambda: main_stats(os.path.join(stats_dir, 'aggregated_game_data_bench.csv'), stats_dir, 'bench')
+    elif stage == 'main_summary_stats':
+        from summary_stats import main_summary_stats
+        run = lambda: main_summary_stats(os.path.join(stats_dir, 'player_stats_bench.csv'), stats_dir, 'bench')
+    else:
+        raise ValueError(f"Unknown benchmark stage: {stage}")
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    return seconds, peak_rss_mb()
+
+# Function to run a stage in a fresh process
+def run_stage_isolated(stage, corpus_dir, work_dir):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_stage, stage, corpus_dir, work_dir).result()
+
+# Function to measure the cold-start time of the command line interface (median over repeats, in seconds)
+def measure_cli_startup(repeats=5):
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    startup = {}
+    for command in CLI_STARTUP_COMMANDS:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, main_path] + command, stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start)
+        startup[' '.join(command)] = round(statistics.median(timings), 4)
+    return startup
+
+# Function to generate the corpus for a scale, unless it already exists
+def prepare_corpus(work_dir, n_games, seed=0):
+    corpus_dir = os.path.join(work_dir, f'corpus_{n_games}', 'PGNs')
+    marker = os.path.join(corpus_dir, '.complete')
+    if not os.path.exists(marker):
+        main_generate_corpus(corpus_dir, n_games, seed=seed)
+        with open(marker, 'w') as f:
+            f.write(str(n_games))
+    return corpus_dir
+
+def load_baselines(baseline_path):
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            return json.load(f)
+    return {}
+
+# Function to compare a result with its baseline. tolerance is the allowed relative slowdown / memory increase
+def compare_with_baseline(result, baseline, tolerance):
+    if not baseline:
+        return 'new'
+    status = []
+    if result['games_per_sec'] < baseline['games_per_sec'] * (1 - tolerance):
+        status.append('SLOWER')
+    if result['peak_rss_mb'] and baseline.get('peak_rss_mb') and result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        status.append('MORE MEMORY')
+    return ', '.join(status) if status else 'ok'
+
+# Run the benchmarks for each scale (number of games) and stage, compare with and optionally update the baselines.
+# equivalence: settings of the equivalence check (see EQUIVALENCE_DEFAULTS, {} for the defaults), None to skip it.
+def main_benchmark(work_dir, scales=[10000], stages=BENCHMARK_STAGES, baseline_path=DEFAULT_BASELINE_PATH, update_baseline=False, tolerance=0.2, equivalence={}):
+    baselines = load_baselines(baseline_path)
+    results = {}
+    if equivalence is not None:
+        from equivalence_check import main_equivalence_check
+        report = main_equivalence_check(os.path.join(work_dir, 'equivalence'), equivalence)
+        results['equivalence'] = {mode: {'checked': result['checked'], 'failed': result['failed'], 'status': result['status']} for mode, result in report.items()}
+    for n_games in scales:
+        corpus_dir = prepare_corpus(work_dir, n_games)
+        run_dir = os.path.join(work_dir, f'corpus_{n_games}', 'output')
+        results[str(n_games)] = {}
+        for stage in stages:
+            seconds, peak_rss = run_stage_isolated(stage, corpus_dir, run_dir)
+            result = {
+                'seconds': round(seconds, 3),
+                'games_per_sec': round(n_games / seconds, 1) if seconds > 0 else None,
+                'peak_rss_mb': peak_rss,
+            }
+            result['status'] = compare_with_baseline(result, baselines.get(str(n_games), {}).get(stage), tolerance)
+            results[str(n_games)][stage] = result
+            print(f"{n_games:>8} games  {stage:<20} {result['seconds']:>9.2f} s  {result['games_per_sec']:>10} games/s  {result['peak_rss_mb']} MB  {result['status']}")
+    # Cold-start time of the command line interface, lower is better
+    results['cli_startup'] = {}
+    for command, seconds in measure_cli_startup().items():
+        baseline = baselines.get('cli_startup', {}).get(command)
+        status = 'new' if baseline is None else ('SLOWER' if seconds > baseline * (1 + tolerance) else 'ok')
+        results['cli_startup'][command] = {'seconds': seconds, 'status': status}
+        print(f"{'cli':>8}        main.py {command:<20} {seconds:>9.3f} s  {status}")
+    with open(os.path.join(work_dir, 'benchmark_results.json'), 'w') as f:
+        json.dump(results, f, indent=4)
+    if update_baseline and baseline_path:
+        for scale, stage_results in results.items():
+            if scale == 'equivalence':
+                continue
+            for stage, result in stage_results.items():
+                if scale == 'cli_startup':
+                    baselines.setdefault(scale, {})[stage] = result['seconds']
+                else:
+                    baselines.setdefault(scale, {})[stage] = {'games_per_sec': result['games_per_sec'], 'peak_rss_mb': result['peak_rss_mb']}
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=4)
+    return results
+
+if __name__ == "__main__":
+    # Example usage:
+    work_dir = '/path/to/benchmarks'
+    # Number of games per corpus, e.g. [10000, 100000, 1000000]
+    scales = [10000]
+    # Set update_baseline to True to store the results as the new baselines
+    update_baseline = False
+    main_benchmark(work_dir, scales, update_baseline=update_baseline)
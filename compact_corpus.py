@@ -0,0 +1,275 @@
+"""
+This script stores a corpus of annotated games in a compact form for repeated experiments on millions of games:
+- the mainline moves as uint16 codes (from square, to square and promotion piece)
+- the evaluations (pawns), WDL probabilities and clock times (seconds) as float32 arrays, NaN where a ply has no
+  annotation, with the offsets of the plies of each game
+- the headers as categorical columns: an int32 code per game and the list of distinct values
+A corpus is saved as a directory of .npy files and loaded memory-mapped, so only the pages that are used are read. One
+ply takes 22 bytes, so a million games of 80 plies take under 2 GB. The Stockfish stats of a game are calculated
+directly from the arrays of the corpus, with the same results as pgn_evaluation_fast_analyzer.py but without building
+python-chess game trees or per-ply objects; the WDL of each centipawn value is looked up in a table built once.
+"""
+
+import chess
+import chess.engine
+import chess.pgn
+import instrumentation
+import json
+import os
+import numpy as np
+from array import array
+from pgn_io import open_pgn, is_pgn_file
+from game_metrics import (extract_eval_from_node, extract_wdl_from_node, extract_time_from_node, calculate_gi_by_result,
+                          calculate_normalized_gi, calculate_adjusted_gi)
+from pgn_evaluation_fast_analyzer import format_stockfish_metrics
+
+# Headers stored in the corpus
+CORPUS_HEADERS = ['White', 'Black', 'Event', 'Site', 'Round', 'Date', 'Result', 'WhiteElo', 'BlackElo']
+
+# Centipawn range of the WDL table, evaluations are at most a mate score of 10000
+CP_LIMIT = 10000
+
+# Function to encode a move as 16 bits: from square, to square and promotion piece type (0 if none)
+def encode_move(move):
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def decode_move(code):
+    code = int(code)
+    return chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None)
+
+class CompactCorpus:
+    def __init__(self, moves, evals, wdl, clocks, offsets, codes, vocab):
+        self.moves = moves
+        self.evals = evals
+        self.wdl = wdl
+        self.clocks = clocks
+        self.offsets = offsets
+        self.codes = codes
+        self.vocab = vocab
+
+    @property
+    def n_games(self):
+        return len(self.offsets) - 1
+
+    # Function to get a header of game i, None if the game does not have it
+    def header(self, name, i):
+        code = self.codes[name][i]
+        return self.vocab[name][code] if code >= 0 else None
+
+    # Function to get the mainline moves of game i, e.g. to replay the positions
+    def game_moves(self, i):
+        return [decode_move(code) for code in self.moves[self.offsets[i]:self.offsets[i + 1]]]
+
+    def save(self, corpus_dir):
+        os.makedirs(corpus_dir, exist_ok=True)
+        for name in ('moves', 'evals', 'wdl', 'clocks', 'offsets'):
+            np.save(os.path.join(corpus_dir, f'{name}.npy'), getattr(self, name))
+        for name, codes in self.codes.items():
+            np.save(os.path.join(corpus_dir, f'header_{name}.npy'), codes)
+        with open(os.path.join(corpus_dir, 'headers.json'), 'w') as f:
+            json.dump(self.vocab, f)
+        with open(os.path.join(corpus_dir, 'corpus.json'), 'w') as f:
+            json.dump({'games': self.n_games, 'plies': int(self.offsets[-1]), 'headers': list(self.codes)}, f)
+
+    # Load a saved corpus, the arrays are memory-mapped unless mmap is False
+    @classmethod
+    def load(cls, corpus_dir, mmap=True):
+        mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(corpus_dir, f'{name}.npy'), mmap_mode=mode) for name in ('moves', 'evals', 'wdl', 'clocks', 'offsets')}
+        with open(os.path.join(corpus_dir, 'headers.json')) as f:
+            vocab = json.load(f)
+        codes = {name: np.load(os.path.join(corpus_dir, f'header_{name}.npy'), mmap_mode=mode) for name in vocab}
+        return cls(codes=codes, vocab=vocab, **arrays)
+
+# Builds a corpus game by game into compact buffers, the per-game objects of python-chess are not kept
+class CorpusBuilder:
+    def __init__(self):
+        self.moves = array('H')
+        self.evals = array('f')
+        self.wdl = array('f')
+        self.clocks = array('f')
+        self.offsets = array('q', [0])
+        self.codes = {name: array('i') for name in CORPUS_HEADERS}
+        self.index = {name: {} for name in CORPUS_HEADERS}
+
+    def add_game(self, game):
+        for node in game.mainline():
+            self.moves.append(encode_move(node.move))
+            evaluation = extract_eval_from_node(node)
+            self.evals.append(evaluation if evaluation is not None else np.nan)
+            self.wdl.extend(extract_wdl_from_node(node) or (np.nan, np.nan, np.nan))
+            clock = extract_time_from_node(node)
+            self.clocks.append(clock.total_seconds() if clock is not None else np.nan)
+        self.offsets.append(len(self.moves))
+        for name in CORPUS_HEADERS:
+            value = game.headers.get(name, None)
+            # Distinct values are interned, missing headers get -1
+            self.codes[name].append(self.index[name].setdefault(value, len(self.index[name])) if value is not None else -1)
+
+    def corpus(self):
+        vocab = {name: list(index) for name, index in self.index.items()}
+        return CompactCorpus(
+            moves=np.frombuffer(self.moves, dtype=np.uint16), evals=np.frombuffer(self.evals, dtype=np.float32),
+            wdl=np.frombuffer(self.wdl, dtype=np.float32).reshape(-1, 3), clocks=np.frombuffer(self.clocks, dtype=np.float32),
+            offsets=np.frombuffer(self.offsets, dtype=np.int64), codes={name: np.frombuffer(codes, dtype=np.int32) for name, codes in self.codes.items()},
+            vocab=vocab)
+
+# Function to build a corpus from the annotated PGN files of a directory (searched recursively)
+@instrumentation.timed_stage('build_corpus')
+def build_corpus(input_pgn_dir):
+    builder = CorpusBuilder()
+    for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
+        for filename in sorted(filenames):
+            if is_pgn_file(filename):
+                with open_pgn(os.path.join(dirpath, filename)) as pgn:
+                    while True:
+                        game = chess.pgn.read_game(pgn)
+                        if game is None:
+                            break
+                        builder.add_game(game)
+    instrumentation.count('games', len(builder.offsets) - 1)
+    instrumentation.count('plies', len(builder.moves))
+    return builder.corpus()
+
+_wins_table = None
+
+# Function to get the table of Cp(cp).wdl().wins for cp from -CP_LIMIT to CP_LIMIT, built once
+def wins_table():
+    global _wins_table
+    if _wins_table is None:
+        _wins_table = np.array([chess.engine.Cp(cp).wdl().wins for cp in range(-CP_LIMIT, CP_LIMIT + 1)], dtype=np.int64)
+    return _wins_table
+
+# Function to calculate the expected values of White and Black from centipawn values, with the WDL of Cp.wdl() and
+# calculate_expected_value of game_metrics.py; white_turn is the turn argument of calculate_expected_value. wdl_values
+# is one scoring system or an array with one per row, the expected values then have one row per scoring system.
+def expected_values(cp, white_turn, wdl_values):
+    table = wins_table()
+    cp = np.clip(cp, -CP_LIMIT, CP_LIMIT)
+    wins, losses = table[cp + CP_LIMIT], table[CP_LIMIT - cp]
+    win_prob, draw_prob, loss_prob = wins / 1000, (1000 - wins - losses) / 1000, losses / 1000
+    wdl_values = np.asarray(wdl_values, dtype=np.float64)
+    win_value, draw_value = wdl_values[..., 0:1], wdl_values[..., 1:2]
+    expected_white = np.where(white_turn, win_prob * win_value + draw_prob * draw_value, loss_prob * win_value + draw_prob * draw_value)
+    expected_black = np.where(white_turn, loss_prob * win_value + draw_prob * draw_value, win_prob * win_value + draw_prob * draw_value)
+    return expected_white, expected_black
+
+# Function to sum a list of values in order, as the += loops of the analyzers do (np.sum adds pairwise). With a 2-D
+# array, each row is summed.
+def sequential_sum(values):
+    values = np.asarray(values)
+    if values.ndim == 2:
+        return np.cumsum(values, axis=1)[:, -1] if values.shape[1] else np.zeros(values.shape[0])
+    return float(np.cumsum(values)[-1]) if len(values) else 0
+
+# Inaccuracy, mistake and blunder thresholds of the expected point loss of pgn_evaluation_fast_analyzer.py
+STOCKFISH_THRESHOLDS = [0.05, 0.2, 0.5]
+
+# Function to calculate the Stockfish stats of game i of a corpus for several scoring configurations at once, each a
+# dict with wdl_values, weighted and optionally thresholds (see STOCKFISH_THRESHOLDS). The evaluations are read and
+# converted to WDL once and the expected values of all configurations are one array operation. Returns the metrics and
+# counts of each configuration, the same as gi_and_gpl and calculate_acpl of pgn_evaluation_fast_analyzer.py, or None
+# if the game has no evaluations.
+def corpus_metrics_sweep(corpus, i, configurations):
+    evals = corpus.evals[corpus.offsets[i]:corpus.offsets[i + 1]]
+    evals = evals[~np.isnan(evals)]
+    if len(evals) == 0:
+        return None
+    # The evaluations are whole centipawns divided by 100 (see extract_eval_from_node), restored exactly from float32
+    pawns = np.rint(evals.astype(np.float64) * 100) / 100.0
+    pawns = np.concatenate([pawns[:1], pawns])
+    white_turn = np.arange(len(pawns)) % 2 == 0
+    # As Cp(int(100 * ...)) in gi_and_gpl, the first premove evaluation is that of the first move
+    premove = np.trunc(100 * np.concatenate([pawns[1:2], pawns[:-1]])).astype(np.int64)
+    postmove = np.trunc(100 * pawns).astype(np.int64)
+    # One row per configuration
+    wdl_values = np.array([configuration['wdl_values'] for configuration in configurations], dtype=np.float64)
+    thresholds = np.array([configuration.get('thresholds') or STOCKFISH_THRESHOLDS for configuration in configurations], dtype=np.float64)
+    premove_white, premove_black = expected_values(premove, white_turn, wdl_values)
+    postmove_white, postmove_black = expected_values(postmove, white_turn, wdl_values)
+    # White's moves are at the odd indices, Black's at the even ones
+    losses = {'white': (postmove_white - premove_white)[:, ~white_turn], 'black': (premove_black - postmove_black)[:, white_turn]}
+    counts = {}
+    for player, player_losses in losses.items():
+        inaccuracy, mistake, blunder = thresholds[:, 0:1], thresholds[:, 1:2], thresholds[:, 2:3]
+        counts[f'{player}_inaccuracy'] = np.count_nonzero((player_losses >= inaccuracy) & (player_losses < mistake), axis=1)
+        counts[f'{player}_mistake'] = np.count_nonzero((player_losses >= mistake) & (player_losses < blunder), axis=1)
+        counts[f'{player}_blunder'] = np.count_nonzero(player_losses >= blunder, axis=1)
+    white_gpls, black_gpls = sequential_sum(losses['white']), sequential_sum(losses['black'])
+    game_result = corpus.header('Result', i)
+    WhiteElo, BlackElo = corpus.header('WhiteElo', i), corpus.header('BlackElo', i)
+    # ACPL as in calculate_acpl, the same for all configurations
+    centipawn_losses = 100 * (pawns[1:] - pawns[:-1])
+    white_cpl, black_cpl = -centipawn_losses[0::2], centipawn_losses[1::2]
+    white_acpl = sequential_sum(white_cpl) / len(white_cpl) if len(white_cpl) else 0
+    black_acpl = sequential_sum(black_cpl) / len(black_cpl) if len(black_cpl) else 0
+    white_move_number, black_move_number = losses['white'].shape[1], losses['black'].shape[1] - 1
+    results = []
+    for c, configuration in enumerate(configurations):
+        white_gpl, black_gpl = float(white_gpls[c]), float(black_gpls[c])
+        white_gi, black_gi = calculate_gi_by_result(white_gpl, black_gpl, game_result, configuration['wdl_values'],
+                                                    float(postmove_white[c, -1]), float(postmove_black[c, -1]))
+        white_gpl, black_gpl = white_gpl / configuration['wdl_values'][0], black_gpl / configuration['wdl_values'][0]
+        if configuration['weighted'] and WhiteElo and BlackElo:
+            white_gi = calculate_adjusted_gi(white_gi, int(BlackElo), 2800)
+            black_gi = calculate_adjusted_gi(black_gi, int(WhiteElo), 2800)
+        white_gi_raw, black_gi_raw = white_gi, black_gi
+        white_gi, black_gi = calculate_normalized_gi(white_gi), calculate_normalized_gi(black_gi)
+        metrics = format_stockfish_metrics(white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw,
+                                           white_move_number, black_move_number, white_acpl, black_acpl)
+        results.append((metrics, {key: int(counts[key][c]) for key in ('white_inaccuracy', 'white_mistake', 'white_blunder',
+                                                                         'black_inaccuracy', 'black_mistake', 'black_blunder')}))
+    return results
+
+# Function to calculate the Stockfish stats of game i of a corpus, the same as gi_and_gpl and calculate_acpl of
+# pgn_evaluation_fast_analyzer.py for the game. Returns None if the game has no evaluations.
+def corpus_stockfish_metrics(corpus, i, wdl_values, weighted):
+    results = corpus_metrics_sweep(corpus, i, [{'wdl_values': wdl_values, 'weighted': weighted}])
+    return results[0] if results is not None else None
+
+# Function to get the details of game i of a corpus as in the JSON output of main_analyze
+def corpus_game_details(corpus, i):
+    result = corpus.header('Result', i)
+    white_result, black_result = {'1-0': (1, 0), '0-1': (0, 1), '1/2-1/2': (0.5, 0.5)}.get(result, ('...', '...'))
+    details = {name: corpus.header(name, i) for name in ['White', 'Black', 'Event', 'Site', 'Round', 'WhiteElo', 'BlackElo']}
+    return {**details, 'WhiteResult': white_result, 'BlackResult': black_result, 'Date': corpus.header('Date', i)}
+
+# Function to calculate the Stockfish stats of all games of a corpus, returns the rows of the aggregated game data CSV
+# (see json_to_csv_converter.py) as a DataFrame
+@instrumentation.timed_stage('analyze_corpus')
+def analyze_corpus(corpus, wdl_values, weighted):
+    import pandas as pd
+    from json_to_csv_converter import extract_full_name
+    rows = []
+    for i in range(corpus.n_games):
+        result = corpus_stockfish_metrics(corpus, i, wdl_values, weighted)
+        if result is None:
+            continue
+        metrics, counts = result
+        details = corpus_game_details(corpus, i)
+        details['White'], details['Black'] = extract_full_name(details['White']), extract_full_name(details['Black'])
+        rows.append({**metrics, **details, **{f'counts.{key}': value for key, value in counts.items()}})
+    instrumentation.count('games', len(rows))
+    return pd.DataFrame(rows)
+
+# Build a corpus from the annotated PGN files in input_pgn_dir and save it to corpus_dir
+def main_build_corpus(input_pgn_dir, corpus_dir):
+    corpus = build_corpus(input_pgn_dir)
+    corpus.save(corpus_dir)
+    size = sum(os.path.getsize(os.path.join(corpus_dir, name)) for name in os.listdir(corpus_dir))
+    print(f"Saved {corpus.n_games} games ({int(corpus.offsets[-1])} plies, {size / 1e6:.1f} MB) to {corpus_dir}")
+
+# Calculate the Stockfish stats of a saved corpus and write aggregated_game_data_{folder}.csv for main_stats
+def main_analyze_corpus(corpus_dir, csv_output_dir, folder, wdl_values, weighted):
+    corpus = CompactCorpus.load(corpus_dir)
+    games = analyze_corpus(corpus, wdl_values, weighted)
+    if not os.path.exists(csv_output_dir):
+        os.makedirs(csv_output_dir)
+    csv_output_file = os.path.join(csv_output_dir, f'aggregated_game_data_{folder}.csv')
+    games.to_csv(csv_output_file, index=False)
+    print(f"Game data of {len(games)} games saved to {csv_output_file}")
+
+if __name__ == "__main__":
+    # Example usage:
+    main_build_corpus('/path/to/WCC_matches/Stockfish', '/path/to/corpus')
+    main_analyze_corpus('/path/to/corpus', '/path/to/Stats', 'all', [1, 0.5, 0], True)
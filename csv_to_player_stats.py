@@ -2,12 +2,37 @@
 and generates a final DataFrame with player statistics, sorted by the average gi score in descending order.
 """
 
-from pr_calculator import calculate_TPR
+from pr_calculator import calculate_TPR, calculate_TPR_array
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+import numpy as np
 import pandas as pd
 import sys
 import os
 import glob
 
+# Columns of the player stats CSV
+PLAYER_STATS_COLUMNS = ['Player', 'avg_gi', 'avg_missed_points', 'total_game_count', 'Points', 'gi_median', 
+    'missed_points_median', 'Elo', 'TPR', 'total_moves', 'White_games', 'Black_games',  'avg_acpl', 'acpl_median', 'gi_std', 'missed_points_std', 'acpl_std', 'avg_gi_raw',
+    'avg_missed_points_white', 'avg_missed_points_black', 'avg_gi_white', 'avg_gi_black', 'white_result_sum', 
+    'black_result_sum', 'gi_var', 'gi_raw_median', 'gi_raw_var', 'gi_raw_std', 
+    'missed_points_var', 'acpl_var']
+
+# resamples: bootstrap resamples per player
+# confidence: level of the percentile intervals
+# seed: seed of the resamples, the intervals do not depend on the number of workers
+# workers: processes (None for all cores)
+# max_batch: maximum number of resampled games per batch (memory)
+BOOTSTRAP_DEFAULTS = {
+    'resamples': 10000,
+    'confidence': 0.95,
+    'seed': 0,
+    'workers': 1,
+    'max_batch': 2 ** 22,
+}
+
+# Metrics with bootstrap intervals, each adds the columns <metric>_ci_low and <metric>_ci_high
+BOOTSTRAP_METRICS = ['avg_gi', 'avg_missed_points', 'TPR']
 
 def combine_csv_files(input_dir, output_filename='combined.csv'):
     csv_files = glob.glob(os.path.join(input_dir, '*.csv'))
@@ -85,9 +110,13 @@ def calculate_average_elo(df):
     white_elo_avg = df.groupby('White')['WhiteElo'].mean().reset_index().rename(columns={'White': 'Player', 'WhiteElo': 'avg_elo_white'})
     black_elo_avg = df.groupby('Black')['BlackElo'].mean().reset_index().rename(columns={'Black': 'Player', 'BlackElo': 'avg_elo_black'})
     elo_avg = pd.merge(white_elo_avg, black_elo_avg, on='Player', how='outer').fillna(0)
-    elo_avg['Elo'] = elo_avg.apply(lambda row: round((row['avg_elo_white'] + row['avg_elo_black']) / 2 if row['avg_elo_white'] > 0 and row['avg_elo_black'] > 0 else max(row['avg_elo_white'], row['avg_elo_black']), 0), axis=1)
+    elo_avg['Elo'] = combine_average_elo(elo_avg)
     return elo_avg[['Player', 'Elo']]
 
+# The Elo of a player is the mean of the average Elo as White and as Black, or the known one
+def combine_average_elo(elo_avg):
+    return elo_avg.apply(lambda row: round((row['avg_elo_white'] + row['avg_elo_black']) / 2 if row['avg_elo_white'] > 0 and row['avg_elo_black'] > 0 else max(row['avg_elo_white'], row['avg_elo_black']), 0), axis=1)
+
 def calculate_pr(player_stats):
     # define m (Points) and n (total_game_count)
     player_stats['TPR'] = player_stats.apply(lambda row: calculate_TPR(row['Points'], row['total_game_count'], row['avg_opponent_elo']), axis=1)
@@ -138,12 +167,9 @@ def calculate_averages(player_stats):
 def save_to_csv(df, file_path):
     df.to_csv(file_path, index=False)
 
-# Main Functionality
-def main_stats(csv_all_games_path, player_stats_output_dir, folder):
-    if not os.path.exists(csv_all_games_path):
-        print(f"File not found: {csv_all_games_path}")
-        return
-    df = read_csv(csv_all_games_path)
+# Function to calculate the player stats from the games of an aggregated game data CSV
+def player_stats_from_csv(df):
+    instrumentation.count('games', len(df))
 
     # Calculating Sums
     white_gi_sum = calculate_sum(df, 'White', 'white_gi', 'white_gi')
@@ -203,15 +229,116 @@ def main_stats(csv_all_games_path, player_stats_output_dir, folder):
 
     # Merge this Elo information with the player_stats DataFrame
     player_stats = pd.merge(player_stats, average_elo, on='Player', how='left')
-    
-    # columns_to_include
-    columns_to_include = ['Player', 'avg_gi', 'avg_missed_points', 'total_game_count', 'Points', 'gi_median', 
-        'missed_points_median', 'Elo', 'TPR', 'total_moves', 'White_games', 'Black_games',  'avg_acpl', 'acpl_median', 'gi_std', 'missed_points_std', 'acpl_std', 'avg_gi_raw',
-        'avg_missed_points_white', 'avg_missed_points_black', 'avg_gi_white', 'avg_gi_black', 'white_result_sum', 
-        'black_result_sum', 'gi_var', 'gi_raw_median', 'gi_raw_var', 'gi_raw_std', 
-        'missed_points_var', 'acpl_var']
+    return player_stats
+
+# Function to calculate the player stats from a game store (see game_store.py), the sums, counts, medians and
+# variances are aggregated by SQLite and the averages, TPR and Elo are calculated as for the CSV
+def player_stats_from_store(store_path, engine=None):
+    from game_store import GameStore
+    with GameStore(store_path) as store:
+        player_stats = store.player_aggregates(engine)
+    instrumentation.count('games', int(player_stats['total_game_count'].sum() // 2))
+    for value_col in ['gi', 'gi_raw', 'missed_points', 'acpl']:
+        # As after the fillna(0) of merge_dataframes, e.g. the variance of a player with a single game
+        player_stats[[f'{value_col}_median', f'{value_col}_var']] = player_stats[[f'{value_col}_median', f'{value_col}_var']].fillna(0)
+        player_stats[f'{value_col}_std'] = player_stats[f'{value_col}_var'] ** 0.5
+    player_stats['Points'] = player_stats['white_result_sum'] + player_stats['black_result_sum']
+    player_stats = calculate_averages(player_stats)
+    player_stats['avg_opponent_elo'] = player_stats['sum_opponent_elo'] / player_stats['total_game_count']
+    player_stats = calculate_pr(player_stats)
+    player_stats['Elo'] = combine_average_elo(player_stats)
+    return player_stats
+
+# Function to get one row per player and game (Player, gi, missed_points, result, opponent_elo) from the games of an
+# aggregated game data CSV
+def player_games_from_csv(df):
+    names = ['Player', 'gi', 'missed_points', 'result', 'opponent_elo']
+    white = df[['White', 'white_gi', 'white_missed_points', 'WhiteResult', 'BlackElo']].set_axis(names, axis=1)
+    black = df[['Black', 'black_gi', 'black_missed_points', 'BlackResult', 'WhiteElo']].set_axis(names, axis=1)
+    return pd.concat([white, black], ignore_index=True)
+
+# Function to calculate the bootstrap intervals of the players of a batch, who all have n games. values has the shape
+# (players, n, 4) with the gi, missed points, result and opponent Elo of each game. The games of each player are
+# resampled with replacement as one array of indices, which is turned into the number of times each game is drawn in
+# each resample, so the sums of all resamples are one matrix product.
+def bootstrap_batch(values, n, resamples, confidence, seed):
+    rng = np.random.default_rng(seed)
+    n_players = values.shape[0]
+    indices = rng.integers(0, n, size=(n_players * resamples, n), dtype=np.uint8 if n < 256 else np.int64)
+    rows = np.arange(n_players * resamples, dtype=np.int64)[:, None] * n + indices
+    draws = np.bincount(rows.ravel(), minlength=n_players * resamples * n).reshape(n_players, resamples, n)
+    # Missing values count as 0 in the sums, as in main_stats
+    sums = np.matmul(draws.astype(float), np.nan_to_num(values))
+    sums = [sums[:, :, k] for k in range(4)]
+    resampled = {
+        'avg_gi': sums[0] / n,
+        'avg_missed_points': sums[1] / n,
+        'TPR': calculate_TPR_array(sums[2], n, sums[3] / n),
+    }
+    tail = (1 - confidence) / 2
+    intervals = {}
+    for metric in BOOTSTRAP_METRICS:
+        intervals[f'{metric}_ci_low'], intervals[f'{metric}_ci_high'] = np.quantile(resampled[metric], [tail, 1 - tail], axis=1)
+    return intervals
+
+def bootstrap_task(task):
+    players, values, n, resamples, confidence, seed = task
+    return players, bootstrap_batch(values, n, resamples, confidence, seed)
+
+# Function to calculate the bootstrap percentile intervals of avg_gi, avg_missed_points and TPR per player from the rows
+# of player_games_from_csv (or GameStore.player_games). Players with the same number of games are resampled together in
+# batches, and the batches run in parallel with settings['workers'] > 1.
+@instrumentation.timed_stage('bootstrap')
+def bootstrap_intervals(player_games, settings=None):
+    settings = {**BOOTSTRAP_DEFAULTS, **(settings or {})}
+    resamples = settings['resamples']
+    groups = {}
+    for player, games in player_games.groupby('Player', sort=True):
+        groups.setdefault(len(games), []).append((player, games[['gi', 'missed_points', 'result', 'opponent_elo']].to_numpy(dtype=float)))
+    tasks = []
+    for n, group in sorted(groups.items()):
+        batch_players = max(1, settings['max_batch'] // (resamples * n))
+        for start in range(0, len(group), batch_players):
+            batch = group[start:start + batch_players]
+            tasks.append(([player for player, values in batch], np.stack([values for player, values in batch]), n, resamples, settings['confidence']))
+    seeds = np.random.SeedSequence(settings['seed']).spawn(len(tasks))
+    tasks = [task + (seed,) for task, seed in zip(tasks, seeds)]
+    if settings['workers'] != 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=settings['workers']) as executor:
+            results = list(executor.map(bootstrap_task, tasks))
+    else:
+        results = [bootstrap_task(task) for task in tasks]
+    instrumentation.count('bootstrap_resamples', resamples * len(player_games))
+    rows = [pd.DataFrame({'Player': players, **intervals}) for players, intervals in results]
+    columns = ['Player'] + [f'{metric}_ci_{bound}' for metric in BOOTSTRAP_METRICS for bound in ('low', 'high')]
+    return pd.concat(rows, ignore_index=True)[columns] if rows else pd.DataFrame(columns=columns)
+
+# Main Functionality
+# csv_all_games_path can also be a game store (a .db/.sqlite file written by main_analyze(..., store=...)), engine then
+# selects the games of one analyzer ('stockfish' or 'lc0'). Set bootstrap to a dict of settings (see
+# BOOTSTRAP_DEFAULTS, {} for the defaults) to add the bootstrap intervals of avg_gi, avg_missed_points and TPR.
+@instrumentation.timed_stage('player_stats')
+def main_stats(csv_all_games_path, player_stats_output_dir, folder, engine=None, bootstrap=None):
+    if not os.path.exists(csv_all_games_path):
+        print(f"File not found: {csv_all_games_path}")
+        return
+    # The extensions of game_store.GAME_STORE_EXTENSIONS, game_store is only imported for stores
+    if csv_all_games_path.lower().endswith(('.db', '.sqlite', '.sqlite3')):
+        player_stats = player_stats_from_store(csv_all_games_path, engine)
+        if bootstrap is not None:
+            from game_store import GameStore
+            with GameStore(csv_all_games_path) as store:
+                player_games = store.player_games(engine)
+    else:
+        df = read_csv(csv_all_games_path)
+        player_stats = player_stats_from_csv(df)
+        if bootstrap is not None:
+            player_games = player_games_from_csv(df)
+
     player_stats = player_stats.round(2)
-    player_stats = player_stats[columns_to_include]
+    player_stats = player_stats[PLAYER_STATS_COLUMNS]
+    if bootstrap is not None:
+        player_stats = pd.merge(player_stats, bootstrap_intervals(player_games, bootstrap).round(2), on='Player', how='left')
 
     # Ensure the output directory exists
     if not os.path.exists(player_stats_output_dir):
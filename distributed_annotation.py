@@ -0,0 +1,427 @@
+"""
+This script runs the engine annotation on several machines. A coordinator splits the games of the PGN files in a
+directory into jobs of a few games and adds them to a work queue. Workers on any node claim a job with a time-limited
+lease, annotate its games with Stockfish or Lc0 and upload the annotated games; the lease is renewed after each game,
+and a job whose lease expired (e.g. the worker died) is claimed again by another worker. A job that was claimed
+max_attempts times without being completed is marked failed and not claimed again. When all jobs are done, the
+coordinator writes the annotated games of each file in their original order to FILE_annotated.pgn, so the output is
+the same as that of main_stockfish or main_lc0 on one machine.
+
+Two queue backends are provided, both with the methods add_jobs, claim, renew, complete, release, status and results:
+- SQLiteWorkQueue: a local SQLite file, for workers on one machine (or a file system with working locks)
+- DirectoryWorkQueue: a shared directory (e.g. NFS), with one file per job, lease and result
+A queue is given as 'sqlite:/path/queue.db' or 'dir:/shared/queue'; a path ending in .db is a SQLite queue.
+"""
+
+import chess.pgn
+import io
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pgn_io import open_pgn, is_pgn_file, annotated_output_path
+
+# lease_seconds: time a worker has to renew the lease of a job before it can be claimed again
+# poll_interval: seconds a worker waits for jobs leased by other workers
+# games_per_job: number of games of a job
+# max_attempts: number of claims of a job (first claim and claims after an expired or released lease) before it fails
+QUEUE_DEFAULTS = {
+    'lease_seconds': 600,
+    'poll_interval': 5.0,
+    'games_per_job': 4,
+    'max_attempts': 3,
+}
+
+# Engine settings of a worker, with the meaning of the arguments of main_stockfish and main_lc0
+ANNOTATOR_DEFAULTS = {
+    'engine': 'stockfish',
+    'engine_path': None,
+    'depth': 25,
+    'weights': None,
+    'nodes': 2500,
+    'time': None,
+    'convergence': None,
+    'continuous': False,
+    'backward': False,
+    'supervisor': None,
+    'syzygy_path': None,
+    'shortcuts': None,
+}
+
+# Function to write a game as the annotators do
+def export_game(game):
+    buffer = io.StringIO()
+    game.accept(chess.pgn.FileExporter(buffer))
+    return buffer.getvalue()
+
+# Function to split the games of the PGN files of a directory into jobs. Each job has the path of its file relative to
+# the directory, the index of its first game in the file and the games as PGN text.
+def split_jobs(input_dir_path, games_per_job):
+    jobs = []
+    for subdir, dirs, files in os.walk(input_dir_path):
+        for file in sorted(files):
+            if not is_pgn_file(file):
+                continue
+            file_path = os.path.join(subdir, file)
+            games = []
+            with open_pgn(file_path) as pgn:
+                while True:
+                    game = chess.pgn.read_game(pgn)
+                    if game is None:
+                        break
+                    games.append(export_game(game))
+            for start in range(0, len(games), games_per_job):
+                jobs.append({'job_id': f"{len(jobs):08d}", 'file': os.path.relpath(file_path, input_dir_path), 'first_game': start,
+                             'games': games[start:start + games_per_job]})
+    return jobs
+
+class SQLiteWorkQueue:
+    def __init__(self, path):
+        self.path = path
+        # Transactions are started explicitly, BEGIN IMMEDIATE makes a claim atomic across processes
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                first_game INTEGER NOT NULL,
+                games TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                token TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+        """)
+
+    def add_jobs(self, jobs):
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT OR IGNORE INTO jobs (job_id, file, first_game, games) VALUES (?, ?, ?, ?)",
+                              [(job['job_id'], job['file'], job['first_game'], json.dumps(job['games'])) for job in jobs])
+        self.conn.execute("COMMIT")
+
+    # Function to claim a pending job or a job with an expired lease, returns the job with its lease token or None.
+    # Jobs that were already claimed max_attempts times are marked failed instead.
+    def claim(self, worker_id, lease_seconds, max_attempts=QUEUE_DEFAULTS['max_attempts']):
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute("UPDATE jobs SET state = 'failed', token = NULL WHERE attempts >= ? AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))",
+                          (max_attempts, now))
+        row = self.conn.execute("SELECT job_id, file, first_game, games FROM jobs WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                                "ORDER BY job_id LIMIT 1", (now,)).fetchone()
+        if row is None:
+            self.conn.execute("COMMIT")
+            return None
+        token = uuid.uuid4().hex
+        self.conn.execute("UPDATE jobs SET state = 'leased', worker = ?, token = ?, lease_expires = ?, attempts = attempts + 1 WHERE job_id = ?",
+                          (worker_id, token, now + lease_seconds, row[0]))
+        self.conn.execute("COMMIT")
+        return {'job_id': row[0], 'file': row[1], 'first_game': row[2], 'games': json.loads(row[3]), 'token': token}
+
+    # Function to extend a lease, returns False if the job was claimed by another worker
+    def renew(self, job_id, token, lease_seconds):
+        cursor = self.conn.execute("UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND token = ? AND state = 'leased'",
+                                   (time.time() + lease_seconds, job_id, token))
+        return cursor.rowcount == 1
+
+    # Function to upload the annotated games of a job, returns False if the job was claimed by another worker
+    def complete(self, job_id, token, result):
+        cursor = self.conn.execute("UPDATE jobs SET state = 'done', result = ?, token = NULL WHERE job_id = ? AND token = ? AND state = 'leased'",
+                                   (json.dumps(result), job_id, token))
+        return cursor.rowcount == 1
+
+    # Give a job back, e.g. after an error, so another worker can claim it
+    def release(self, job_id, token):
+        self.conn.execute("UPDATE jobs SET state = 'pending', token = NULL, lease_expires = NULL WHERE job_id = ? AND token = ?", (job_id, token))
+
+    def status(self):
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0, 'failed': 0}
+        now = time.time()
+        for state, expires in self.conn.execute("SELECT state, lease_expires FROM jobs"):
+            counts['expired' if state == 'leased' and expires < now else state] += 1
+        return counts
+
+    # Function to get the done jobs, as (file, first_game, annotated games)
+    def results(self):
+        return [(file, first_game, json.loads(result)) for file, first_game, result in
+                self.conn.execute("SELECT file, first_game, result FROM jobs WHERE state = 'done' ORDER BY job_id")]
+
+    def close(self):
+        self.conn.close()
+
+class DirectoryWorkQueue:
+    def __init__(self, path):
+        self.path = path
+        for folder in ('jobs', 'leases', 'results'):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def file_path(self, folder, job_id):
+        return os.path.join(self.path, folder, f"{job_id}.json")
+
+    # Write a file atomically, readers on other nodes never see a partial file
+    def write_json(self, path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def job_ids(self):
+        return sorted(name[:-len('.json')] for name in os.listdir(os.path.join(self.path, 'jobs')) if name.endswith('.json'))
+
+    def add_jobs(self, jobs):
+        for job in jobs:
+            if not os.path.exists(self.file_path('jobs', job['job_id'])):
+                self.write_json(self.file_path('jobs', job['job_id']), job)
+
+    # Each change of the lease of a job is a new numbered file in leases/<job_id>/ and the current lease is the one with
+    # the highest number. A change of the lease read as number n creates number n + 1 with os.link, which fails if the
+    # file exists, so of two workers that read the same lease only one can change it, and a change based on an outdated
+    # lease fails. The old files are kept, so a number is never created twice.
+    def lease_folder(self, job_id):
+        return os.path.join(self.path, 'leases', job_id)
+
+    # Function to get the number and the content of the current lease of a job, (-1, None) if it was never claimed
+    def current_lease(self, job_id):
+        try:
+            numbers = [int(name[:-len('.json')]) for name in os.listdir(self.lease_folder(job_id)) if name.endswith('.json')]
+        except FileNotFoundError:
+            return -1, None
+        if not numbers:
+            return -1, None
+        number = max(numbers)
+        return number, self.read_json(os.path.join(self.lease_folder(job_id), f"{number:08d}.json"))
+
+    # Function to write lease number `number` of a job, returns False if another worker wrote it first
+    def write_lease(self, job_id, number, lease):
+        folder = self.lease_folder(job_id)
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = os.path.join(folder, f"{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(lease, f)
+        try:
+            os.link(tmp_path, os.path.join(folder, f"{number:08d}.json"))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    # Function to change the lease of a job if it is still held with token, returns False otherwise
+    def update_lease(self, job_id, token, lease_changes):
+        number, lease = self.current_lease(job_id)
+        if lease is None or lease['token'] != token:
+            return False
+        return self.write_lease(job_id, number + 1, {**lease, **lease_changes})
+
+    def claim(self, worker_id, lease_seconds, max_attempts=QUEUE_DEFAULTS['max_attempts']):
+        for job_id in self.job_ids():
+            if os.path.exists(self.file_path('results', job_id)):
+                continue
+            now = time.time()
+            number, lease = self.current_lease(job_id)
+            if number >= 0 and (lease is None or lease.get('failed') or (lease['token'] is not None and lease['expires'] >= now)):
+                continue
+            attempts = lease['attempts'] if lease is not None else 0
+            if attempts >= max_attempts:
+                self.write_lease(job_id, number + 1, {**lease, 'token': None, 'failed': True})
+                continue
+            token = uuid.uuid4().hex
+            if not self.write_lease(job_id, number + 1, {'worker': worker_id, 'token': token, 'expires': now + lease_seconds, 'attempts': attempts + 1}):
+                continue
+            # The job may have been completed while the lease was created
+            if os.path.exists(self.file_path('results', job_id)):
+                self.release(job_id, token)
+                continue
+            return {**self.read_json(self.file_path('jobs', job_id)), 'token': token}
+        return None
+
+    def renew(self, job_id, token, lease_seconds):
+        return self.update_lease(job_id, token, {'expires': time.time() + lease_seconds})
+
+    # The lease is changed before the result is written, so only the worker that still holds the job writes it
+    def complete(self, job_id, token, result):
+        if not self.update_lease(job_id, token, {}):
+            return False
+        self.write_json(self.file_path('results', job_id), result)
+        return True
+
+    # A released lease keeps the number of attempts of the job
+    def release(self, job_id, token):
+        self.update_lease(job_id, token, {'token': None, 'expires': 0})
+
+    def status(self):
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0, 'failed': 0}
+        now = time.time()
+        for job_id in self.job_ids():
+            if os.path.exists(self.file_path('results', job_id)):
+                counts['done'] += 1
+                continue
+            lease = self.current_lease(job_id)[1]
+            if lease is not None and lease.get('failed'):
+                counts['failed'] += 1
+            elif lease is None or lease['token'] is None:
+                counts['pending'] += 1
+            else:
+                counts['expired' if lease['expires'] < now else 'leased'] += 1
+        return counts
+
+    def results(self):
+        done = []
+        for job_id in self.job_ids():
+            result = self.read_json(self.file_path('results', job_id))
+            if result is not None:
+                job = self.read_json(self.file_path('jobs', job_id))
+                done.append((job['file'], job['first_game'], result))
+        return done
+
+    def close(self):
+        pass
+
+# Function to open a queue from 'sqlite:PATH', 'dir:PATH' or a path (SQLite if it ends in .db)
+def open_work_queue(queue_spec):
+    if queue_spec.startswith('sqlite:'):
+        return SQLiteWorkQueue(queue_spec[len('sqlite:'):])
+    if queue_spec.startswith('dir:'):
+        return DirectoryWorkQueue(queue_spec[len('dir:'):])
+    if queue_spec.endswith('.db'):
+        return SQLiteWorkQueue(queue_spec)
+    return DirectoryWorkQueue(queue_spec)
+
+# Function to make the annotation function of a worker, returns it and the function to call when the worker stops.
+# The engines, tables and shortcuts are opened once per worker, as in main_stockfish and main_lc0.
+def open_annotator(settings):
+    from syzygy_tablebase import open_syzygy
+    from position_shortcuts import open_shortcuts
+    from engine_supervisor import open_supervised_engine
+    tablebase = open_syzygy(settings['syzygy_path'])
+    shortcuts = open_shortcuts(settings['shortcuts'])
+    name = settings['engine']
+    if name == 'stockfish':
+        from stockfish_pgn_annotator import annotate_game_stockfish
+        engine = open_supervised_engine(settings['engine_path'], supervisor=settings['supervisor'], name='stockfish') if settings['continuous'] else None
+        annotate = lambda game: annotate_game_stockfish(game, settings['engine_path'], settings['depth'], settings['convergence'], engine,
+                                                        settings['backward'], settings['supervisor'], tablebase, shortcuts)
+    elif name == 'lc0':
+        from lc0_pgn_annotator import annotate_game_lc0
+        from engine_search import LC0_CONVERGENCE_DEFAULTS
+        convergence = {**LC0_CONVERGENCE_DEFAULTS, **settings['convergence']} if settings['convergence'] is not None else None
+        engine = open_supervised_engine([settings['engine_path'], f"--weights={settings['weights']}"], {"UCI_ShowWDL": True}, settings['supervisor'], name='lc0')
+        annotate = lambda game: annotate_game_lc0(engine, game, settings['time'], settings['nodes'], convergence, settings['continuous'],
+                                                  settings['backward'], tablebase, shortcuts)
+    else:
+        raise ValueError(f"Unknown engine for distributed annotation: {name}")
+
+    def close():
+        if engine is not None:
+            engine.quit()
+        if tablebase is not None:
+            tablebase.report(name)
+            tablebase.close()
+        if shortcuts is not None:
+            shortcuts.report(name)
+    return annotate, close
+
+# Coordinator: add the games of the PGN files in input_dir_path to the queue as jobs of games_per_job games
+def main_submit_jobs(input_dir_path, queue_spec, games_per_job=QUEUE_DEFAULTS['games_per_job']):
+    jobs = split_jobs(input_dir_path, games_per_job)
+    queue = open_work_queue(queue_spec)
+    queue.add_jobs(jobs)
+    print(f"Added {len(jobs)} jobs ({sum(len(job['games']) for job in jobs)} games) to {queue_spec}")
+    queue.close()
+    return len(jobs)
+
+# Worker: claim jobs until the queue is done (or, with wait False, until no job can be claimed) and annotate them with
+# the engine settings (see ANNOTATOR_DEFAULTS). Returns the number of jobs completed by this worker.
+def main_annotation_worker(queue_spec, annotator, lease_seconds=QUEUE_DEFAULTS['lease_seconds'], poll_interval=QUEUE_DEFAULTS['poll_interval'], worker_id=None, wait=True,
+                           max_attempts=QUEUE_DEFAULTS['max_attempts']):
+    settings = {**ANNOTATOR_DEFAULTS, **annotator}
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue = open_work_queue(queue_spec)
+    annotate, close = open_annotator(settings)
+    completed = 0
+    try:
+        while True:
+            job = queue.claim(worker_id, lease_seconds, max_attempts)
+            if job is None:
+                status = queue.status()
+                if not wait or status['pending'] + status['leased'] + status['expired'] == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+            annotated_games = []
+            try:
+                for game_text in job['games']:
+                    game = chess.pgn.read_game(io.StringIO(game_text))
+                    annotate(game)
+                    annotated_games.append(export_game(game))
+                    if not queue.renew(job['job_id'], job['token'], lease_seconds):
+                        break
+            except Exception:
+                queue.release(job['job_id'], job['token'])
+                raise
+            if len(annotated_games) == len(job['games']) and queue.complete(job['job_id'], job['token'], annotated_games):
+                completed += 1
+                print(f"{worker_id}: job {job['job_id']} done ({job['file']}, games {job['first_game'] + 1}-{job['first_game'] + len(annotated_games)})")
+            else:
+                print(f"{worker_id}: lost the lease of job {job['job_id']}, the result was discarded")
+    finally:
+        close()
+        queue.close()
+    return completed
+
+# Run engines workers in parallel processes on this node, each with its own engine. engines None uses the number of
+# engines tuned by engine_tuner.py for the engine of the annotator (1 if it was not tuned). Returns the number of jobs
+# completed by the workers.
+def main_annotation_workers(queue_spec, annotator, engines=None, lease_seconds=QUEUE_DEFAULTS['lease_seconds'], poll_interval=QUEUE_DEFAULTS['poll_interval'],
+                            max_attempts=QUEUE_DEFAULTS['max_attempts']):
+    from engine_search import tuned_engine_config
+    engines = engines or tuned_engine_config(annotator.get('engine', ANNOTATOR_DEFAULTS['engine'])).get('engines', 1)
+    if engines == 1:
+        return main_annotation_worker(queue_spec, annotator, lease_seconds, poll_interval, max_attempts=max_attempts)
+    worker_ids = [f"{socket.gethostname()}-{os.getpid()}-{i}" for i in range(engines)]
+    with ProcessPoolExecutor(max_workers=engines) as executor:
+        futures = [executor.submit(main_annotation_worker, queue_spec, annotator, lease_seconds, poll_interval, worker_id, True, max_attempts) for worker_id in worker_ids]
+        return sum(future.result() for future in futures)
+
+# Coordinator: write the annotated games of each file in their original order, once all jobs are done. Returns False
+# (and writes nothing) if jobs are still pending or leased, or failed.
+def main_collect_results(queue_spec, output_directory):
+    queue = open_work_queue(queue_spec)
+    status = queue.status()
+    if status['pending'] + status['leased'] + status['expired'] > 0:
+        print(f"Jobs not done yet: {status}")
+        queue.close()
+        return False
+    if status['failed'] > 0:
+        print(f"{status['failed']} jobs failed after the maximum number of attempts: {status}")
+        queue.close()
+        return False
+    files = {}
+    for file, first_game, games in queue.results():
+        files.setdefault(file, []).append((first_game, games))
+    for file, parts in files.items():
+        with open(annotated_output_path(file, output_directory), 'w') as annotated_pgn:
+            for first_game, games in sorted(parts):
+                annotated_pgn.write(''.join(games))
+    print(f"Wrote {len(files)} annotated files to {output_directory}")
+    queue.close()
+    return True
+
+if __name__ == "__main__":
+    # Example usage, each step can run on a different machine with access to the queue:
+    queue_spec = 'dir:/shared/annotation_queue'
+    main_submit_jobs('/path/to/PGNs', queue_spec)
+    main_annotation_worker(queue_spec, {'engine': 'stockfish', 'engine_path': '/usr/bin/stockfish', 'depth': 25})
+    main_collect_results(queue_spec, '/path/to/output')
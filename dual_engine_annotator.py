@@ -0,0 +1,86 @@
+"""
+This script annotates each game with Stockfish and Lc0 evaluations in a single pass. Each game is parsed once and
+its positions are sent to both engines concurrently, one thread per engine, so a run takes about as long as the
+slower engine instead of the sum of both. The output PGN carries the Stockfish [%eval] and the Lc0 [%eval_lc0] and
+[%wdl] comments, which are read by pgn_evaluation_fast_analyzer.py and pgn_evaluation_fast_analyzer_lc0.py. The
+comments of the input, such as [%clk], are kept.
+"""
+
+import chess
+import chess.engine
+import chess.pgn
+import instrumentation
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pgn_io import open_pgn, is_pgn_file, write_annotated_game
+from stockfish_pgn_annotator import evaluate_mainline_stockfish, add_stockfish_comments
+from lc0_pgn_annotator import evaluate_mainline_lc0, add_lc0_comments
+from engine_supervisor import open_supervised_engine
+from syzygy_tablebase import open_syzygy
+from position_shortcuts import open_shortcuts, add_shortcut_comments
+
+# The tablebases (see syzygy_tablebase.py) and shortcuts (see position_shortcuts.py) are separate for each engine, as
+# each engine runs in its own thread. The [%shortcut] comments are written from the Stockfish treatments.
+def analyze_game_with_both_engines(stockfish_engine, lc0_engine, file_path, output_directory, input_dir_path, depth, analysis_time, nodes_limit, backward=False,
+                                   stockfish_tablebase=None, lc0_tablebase=None, stockfish_shortcuts=None, lc0_shortcuts=None):
+    with open_pgn(file_path) as pgn_file, ThreadPoolExecutor(max_workers=2) as executor:
+        while True:
+            game = chess.pgn.read_game(pgn_file)
+            if game is None:
+                break
+
+            # Each game is one session for both engines
+            stockfish_future = executor.submit(evaluate_mainline_stockfish, stockfish_engine, game, depth, None, True, backward, stockfish_tablebase, stockfish_shortcuts)
+            lc0_future = executor.submit(evaluate_mainline_lc0, lc0_engine, game, analysis_time, nodes_limit, None, True, backward, lc0_tablebase, lc0_shortcuts)
+            scores = stockfish_future.result()
+            lc0_scores, wdl_scores = lc0_future.result()
+            instrumentation.count('games')
+            instrumentation.count('plies', sum(score is not None for score in scores))
+
+            # The clock and other comments of the input are kept, the Lc0 comments are appended after the [%eval]
+            add_stockfish_comments(game, scores, keep_comments=True)
+            add_lc0_comments(game, lc0_scores, wdl_scores)
+            if stockfish_shortcuts is not None:
+                add_shortcut_comments(game, stockfish_shortcuts.treatments)
+            write_annotated_game(game, file_path, output_directory, input_dir_path)
+
+# Set backward to True to search each game from the last move to the first, supervisor to run both engines under
+# a watchdog (see engine_supervisor.py), syzygy_path to take the results of endgame positions from Syzygy tables and
+# shortcuts, e.g. {}, to skip or shorten the searches of cheap positions
+@instrumentation.timed_stage('annotate_dual')
+def main_dual(input_dir_path, output_directory, stockfish_path, depth, lc0_path, weights_path, analysis_time, nodes_limit, backward=False, supervisor=None, syzygy_path=None, shortcuts=None):
+    stockfish_tablebase, lc0_tablebase = open_syzygy(syzygy_path), open_syzygy(syzygy_path)
+    stockfish_shortcuts, lc0_shortcuts = open_shortcuts(shortcuts), open_shortcuts(shortcuts)
+    with open_supervised_engine(stockfish_path, supervisor=supervisor, name='stockfish') as stockfish_engine, \
+            open_supervised_engine([lc0_path, f"--weights={weights_path}"], {"UCI_ShowWDL": True}, supervisor, name='lc0') as lc0_engine:
+        for subdir, dirs, files in os.walk(input_dir_path):
+            for file in files:
+                if is_pgn_file(file):
+                    file_path = os.path.join(subdir, file)
+                    analyze_game_with_both_engines(stockfish_engine, lc0_engine, file_path, output_directory, input_dir_path, depth, analysis_time, nodes_limit, backward,
+                                                   stockfish_tablebase, lc0_tablebase, stockfish_shortcuts, lc0_shortcuts)
+    if syzygy_path:
+        stockfish_tablebase.report('stockfish')
+        lc0_tablebase.report('lc0')
+        stockfish_tablebase.close()
+        lc0_tablebase.close()
+    if shortcuts is not None:
+        stockfish_shortcuts.report('stockfish')
+        lc0_shortcuts.report('lc0')
+
+if __name__ == "__main__":
+    start_time = time.time()
+    print("Annotating games with Stockfish and Lc0...")
+    input_dir_path = '/path/to/PGNs'
+    output_directory = '/path/to/output'
+    stockfish_path = '/path/to/stockfish'
+    depth = 25
+    lc0_path = '/path/to/lc0'
+    weights_path = '/path/to/weights.pb.gz'
+    analysis_time = None
+    nodes_limit = 20000
+    main_dual(input_dir_path, output_directory, stockfish_path, depth, lc0_path, weights_path, analysis_time, nodes_limit)
+    print("Engine analysis finished")
+    end_time = time.time()
+    print("Script finished in {:.2f} minutes".format((end_time - start_time) / 60.0))
@@ -0,0 +1,238 @@
+"""
+This script contains the engine search used by the annotators. With a convergence setting, the search runs on the
+streaming engine.analysis() iterator and stops early once the score (or the Lc0 WDL) has stayed within a tolerance
+for a number of consecutive depths or node checkpoints. The configured limit is always the hard cap.
+It also includes benchmarks that compare early-stopped searches with full searches on positions from PGN files and
+game-continuous analysis (hash reuse, backward traversal) with independent searches per ply.
+"""
+
+import chess
+import chess.engine
+import chess.pgn
+import instrumentation
+import json
+import os
+import time
+from pgn_io import open_pgn, is_pgn_file
+
+# tolerance: maximum change of the score in pawns (White's point of view) between checkpoints
+# wdl_tolerance: if set and the engine reports WDL, maximum change of the expected score (win + draw/2) instead
+# stable: number of consecutive checkpoints within the tolerance needed to stop
+# min_depth, min_nodes: never stop before the search reached this depth / number of nodes
+# min_nodes_fraction: never stop before the search reached this fraction of the nodes of the limit
+# checkpoint: 'depth' (a new iteration, Stockfish) or 'nodes' (every update with more nodes, Lc0)
+CONVERGENCE_DEFAULTS = {
+    'tolerance': 0.1,
+    'wdl_tolerance': None,
+    'stable': 4,
+    'min_depth': 12,
+    'min_nodes': 0,
+    'min_nodes_fraction': 0.0,
+    'checkpoint': 'depth',
+}
+# Defaults for Lc0, which reports few depths but regular node updates. The first node updates come after a few hundred
+# nodes, so a search does not stop before a quarter of its nodes.
+LC0_CONVERGENCE_DEFAULTS = {
+    'wdl_tolerance': 0.01,
+    'min_depth': 0,
+    'min_nodes_fraction': 0.25,
+    'checkpoint': 'nodes',
+}
+
+# Function to get the value that is checked for convergence from an info dict and its kind: 'wdl' (the expected score)
+# if wdl_tolerance is set and the engine reports WDL, otherwise 'pawns' (the score in pawns)
+def convergence_value(info, settings):
+    if settings['wdl_tolerance'] is not None and info.get('wdl') is not None:
+        wdl = info['wdl'].white()
+        total = wdl.wins + wdl.draws + wdl.losses
+        return 'wdl', (wdl.wins + 0.5 * wdl.draws) / total if total else 0.5
+    return 'pawns', info['score'].white().score(mate_score=10000) / 100.0
+
+# Function to search a position. Without convergence it is the same as engine.analyse(board, limit).
+# Returns the info dict of the search. A supervised engine (see engine_supervisor.py) runs the search itself, with a
+# timeout and restarts.
+def search_position(engine, board, limit, convergence=None, **kwargs):
+    if hasattr(engine, 'supervised_search'):
+        return engine.supervised_search(board, limit, convergence, **kwargs)
+    if convergence is None:
+        return engine.analyse(board, limit, **kwargs)
+    settings = {**CONVERGENCE_DEFAULTS, **convergence}
+    min_nodes = max(settings['min_nodes'], settings['min_nodes_fraction'] * (limit.nodes or 0))
+    tolerances = {'wdl': settings['wdl_tolerance'], 'pawns': settings['tolerance']}
+    previous_kind, previous_value, previous_checkpoint = None, None, None
+    stable = 0
+    with engine.analysis(board, limit, **kwargs) as analysis:
+        for info in analysis:
+            # Only complete iterations count, not bounds from aspiration windows or currmove updates
+            if 'score' not in info or 'pv' not in info or info.get('lowerbound') or info.get('upperbound'):
+                continue
+            checkpoint = info.get('depth', 0) if settings['checkpoint'] == 'depth' else info.get('nodes', 0)
+            if previous_checkpoint is not None and checkpoint <= previous_checkpoint:
+                continue
+            kind, value = convergence_value(info, settings)
+            # An expected score is only compared with an expected score and a pawn score with a pawn score
+            if kind == previous_kind and abs(value - previous_value) <= tolerances[kind]:
+                stable += 1
+            else:
+                stable = 0
+            previous_kind, previous_value, previous_checkpoint = kind, value, checkpoint
+            if stable >= settings['stable'] and info.get('depth', 0) >= settings['min_depth'] and info.get('nodes', 0) >= min_nodes:
+                instrumentation.count('early_stops')
+                analysis.stop()
+                break
+        analysis.wait()
+        return analysis.info
+
+# Default path of the engine configuration saved by engine_tuner.py
+ENGINE_CONFIG_PATH = 'engine_config.json'
+# Engine names and configuration files already reported as used
+reported_configs = set()
+
+# Function to get the tuned configuration of an engine ('stockfish' or 'lc0'), {} if it was not tuned. A tuned
+# configuration is only used when it is asked for, with config_path or the environment variable WCC_ENGINE_CONFIG
+# (set by the --engine-config option of main.py), and its use is reported once per engine.
+def tuned_engine_config(name, config_path=None):
+    config_path = config_path or os.environ.get('WCC_ENGINE_CONFIG')
+    if not name or not config_path:
+        return {}
+    if not os.path.exists(config_path):
+        raise FileNotFoundError(f"Engine configuration {config_path} not found")
+    with open(config_path) as f:
+        config = json.load(f).get(name, {})
+    if config and (name, config_path) not in reported_configs:
+        reported_configs.add((name, config_path))
+        print(f"Using the tuned {name} configuration from {config_path}: {config.get('engines', 1)} engines with {config.get('options', {})}")
+    return config
+
+# Function to open an engine, engine_command is a path or a list such as [lc0_path, '--weights=...']
+def open_engine(engine_command, options=None):
+    engine = chess.engine.SimpleEngine.popen_uci(engine_command)
+    if options:
+        engine.configure(options)
+    return engine
+
+# Function to collect up to max_positions positions from the mainlines of the PGN files in a directory
+def sample_positions(pgn_dir, max_positions, every_nth_ply=1):
+    positions = []
+    for dirpath, dirnames, filenames in os.walk(pgn_dir):
+        for filename in sorted(filenames):
+            if not is_pgn_file(filename):
+                continue
+            with open_pgn(os.path.join(dirpath, filename)) as pgn:
+                while len(positions) < max_positions:
+                    game = chess.pgn.read_game(pgn)
+                    if game is None:
+                        break
+                    board = game.board()
+                    for ply, move in enumerate(game.mainline_moves()):
+                        board.push(move)
+                        if ply % every_nth_ply == 0 and not board.is_game_over():
+                            positions.append(board.copy(stack=False))
+                            if len(positions) >= max_positions:
+                                break
+            if len(positions) >= max_positions:
+                return positions
+    return positions
+
+# Compare early-stopped searches with full searches on a benchmark set of positions. Two engine processes are used,
+# so the hash of one search mode does not help the other. Returns and prints the time saved and the deviations.
+def main_convergence_benchmark(pgn_dir, engine_command, limit, convergence, max_positions=200, every_nth_ply=3, options=None):
+    positions = sample_positions(pgn_dir, max_positions, every_nth_ply)
+    settings = {**CONVERGENCE_DEFAULTS, **convergence}
+    full_seconds, early_seconds = 0.0, 0.0
+    score_diffs, wdl_diffs, full_depths, early_depths = [], [], [], []
+    early_stops = 0
+    full_engine = open_engine(engine_command, options)
+    early_engine = open_engine(engine_command, options)
+    try:
+        for board in positions:
+            start = time.perf_counter()
+            full = full_engine.analyse(board, limit)
+            full_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            early = search_position(early_engine, board, limit, convergence)
+            early_seconds += time.perf_counter() - start
+            full_depths.append(full.get('depth', 0))
+            early_depths.append(early.get('depth', 0))
+            if early.get('depth', 0) < full.get('depth', 0) or early.get('nodes', 0) < full.get('nodes', 0):
+                early_stops += 1
+            score_diffs.append(abs(full['score'].white().score(mate_score=10000) - early['score'].white().score(mate_score=10000)) / 100.0)
+            if full.get('wdl') is not None and early.get('wdl') is not None:
+                wdl_diffs.append(abs(full['wdl'].white().expectation() - early['wdl'].white().expectation()))
+    finally:
+        full_engine.quit()
+        early_engine.quit()
+    n = len(positions)
+    report = {
+        'positions': n,
+        'full_seconds': round(full_seconds, 2),
+        'early_seconds': round(early_seconds, 2),
+        'time_saved_pct': round(100 * (1 - early_seconds / full_seconds), 1) if full_seconds else 0.0,
+        'early_stop_rate': round(early_stops / n, 3) if n else 0.0,
+        'avg_depth_full': round(sum(full_depths) / n, 2) if n else 0.0,
+        'avg_depth_early': round(sum(early_depths) / n, 2) if n else 0.0,
+        'mean_abs_score_diff': round(sum(score_diffs) / n, 3) if n else 0.0,
+        'max_abs_score_diff': round(max(score_diffs), 3) if score_diffs else 0.0,
+        'within_tolerance_rate': round(sum(diff <= settings['tolerance'] for diff in score_diffs) / n, 3) if n else 0.0,
+    }
+    if wdl_diffs:
+        report['mean_abs_expectation_diff'] = round(sum(wdl_diffs) / len(wdl_diffs), 4)
+        report['max_abs_expectation_diff'] = round(max(wdl_diffs), 4)
+        # Searches that converge on the WDL (Lc0) are checked against the WDL tolerance, not the pawn tolerance
+        if settings['wdl_tolerance'] is not None:
+            report['within_tolerance_rate'] = round(sum(diff <= settings['wdl_tolerance'] for diff in wdl_diffs) / len(wdl_diffs), 3)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    return report
+
+# Compare the time to a fixed limit per game of the previous annotators with the game-continuous modes:
+# - engine_per_game: a new engine for each game, searched without a game (the previous Stockfish annotator), the start
+#   of the engine is included in the time
+# - one_engine: one engine for all games, searched without a game (the previous Lc0 annotator), python-chess sends no
+#   ucinewgame, so the hash is kept from ply to ply and from game to game
+# - continuous: one engine, each game is one session (ucinewgame, which clears the hash, once per game)
+# - continuous_backward: as continuous, with each game searched from the last move to the first
+# For Stockfish most of the gain comes from reusing the engine across games; for Lc0, continuous clears the hash once
+# per game, which the previous annotator did not.
+def main_session_benchmark(pgn_dir, engine_command, limit, max_games=5, options=None):
+    games = []
+    for dirpath, dirnames, filenames in os.walk(pgn_dir):
+        for filename in sorted(filenames):
+            if is_pgn_file(filename) and len(games) < max_games:
+                with open_pgn(os.path.join(dirpath, filename)) as pgn:
+                    while len(games) < max_games:
+                        game = chess.pgn.read_game(pgn)
+                        if game is None:
+                            break
+                        games.append(game)
+    report = {}
+    for mode in ['engine_per_game', 'one_engine', 'continuous', 'continuous_backward']:
+        engine = open_engine(engine_command, options) if mode != 'engine_per_game' else None
+        seconds = 0.0
+        try:
+            for game in games:
+                boards = [node.board() for node in game.mainline()]
+                if mode == 'continuous_backward':
+                    boards.reverse()
+                start = time.perf_counter()
+                game_engine = open_engine(engine_command, options) if mode == 'engine_per_game' else engine
+                try:
+                    for board in boards:
+                        game_engine.analyse(board, limit, game=game if mode.startswith('continuous') else None)
+                finally:
+                    if mode == 'engine_per_game':
+                        game_engine.quit()
+                seconds += time.perf_counter() - start
+        finally:
+            if engine is not None:
+                engine.quit()
+        report[mode] = round(seconds / len(games), 3) if games else 0.0
+        print(f"{mode}: {report[mode]} seconds per game")
+    return report
+
+if __name__ == "__main__":
+    # Example usage:
+    pgn_dir = '/path/to/PGNs'
+    stockfish_path = '/path/to/stockfish'
+    convergence = {'tolerance': 0.1, 'stable': 4, 'min_depth': 12}
+    main_convergence_benchmark(pgn_dir, stockfish_path, chess.engine.Limit(depth=25), convergence)
@@ -0,0 +1,132 @@
+"""
+This script supervises the engine processes of the annotators. Every search runs with a wall-clock timeout. If the
+engine hangs, crashes or a search fails, the engine process is killed and restarted with the same command and
+options, and the position is searched again, up to a bounded number of retries. Each failure is written to a JSON
+lines log, so a long run neither stops at the first broken engine nor silently scores the rest of the run as 0.0.
+"""
+
+import chess.engine
+import instrumentation
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from engine_search import open_engine, search_position, tuned_engine_config
+
+# position_timeout: maximum wall-clock seconds for one search, None for no timeout
+# max_retries: number of times a failed position is searched again, each time with a restarted engine
+# failure_log: path of the JSON lines file the failures are appended to, None to only print them
+SUPERVISOR_DEFAULTS = {
+    'position_timeout': 60.0,
+    'max_retries': 2,
+    'failure_log': None,
+}
+
+# Raised when a position still fails after max_retries restarts
+class EngineFailure(Exception):
+    pass
+
+# An engine process with a watchdog. It can be used wherever an engine from chess.engine.SimpleEngine.popen_uci is
+# passed to search_position (see engine_search.py) or engine.analyse.
+class EngineSupervisor:
+    def __init__(self, engine_command, options=None, position_timeout=60.0, max_retries=2, failure_log=None, name=None):
+        self.engine_command = engine_command
+        self.options = options
+        self.position_timeout = position_timeout
+        self.max_retries = max_retries
+        self.failure_log = failure_log
+        self.name = name or (engine_command[0] if isinstance(engine_command, list) else engine_command)
+        self.restarts = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.engine = None
+        self.executor = None
+        self.start()
+
+    def start(self):
+        self.engine = open_engine(self.engine_command, self.options)
+        # The searches run in a separate thread, so a hanging engine can be detected and killed
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    # Kill the engine process without waiting for it to answer
+    def kill(self):
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def restart(self):
+        self.kill()
+        self.start()
+        self.restarts += 1
+        instrumentation.count('engine_restarts')
+
+    def log_failure(self, board, attempt, error, action):
+        self.failures += 1
+        instrumentation.count('engine_failures')
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'engine': self.name,
+            'fen': board.fen(),
+            'attempt': attempt,
+            'error': f"{type(error).__name__}: {error}",
+            'action': action,
+        }
+        print(f"Engine {self.name} failed on {entry['fen']} (attempt {attempt}): {entry['error']}, {action}")
+        if self.failure_log:
+            with open(self.failure_log, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    # Search a position with the timeout, restarting the engine and retrying on failure
+    def supervised_search(self, board, limit, convergence=None, **kwargs):
+        for attempt in range(1, self.max_retries + 2):
+            future = self.executor.submit(search_position, self.engine, board, limit, convergence, **kwargs)
+            try:
+                return future.result(timeout=self.position_timeout)
+            except Exception as e:
+                if isinstance(e, TimeoutError):
+                    self.timeouts += 1
+                    instrumentation.count('engine_timeouts')
+                    e = TimeoutError(f"no result after {self.position_timeout} seconds")
+                if attempt > self.max_retries:
+                    self.log_failure(board, attempt, e, 'gave up')
+                    self.restart()
+                    raise EngineFailure(f"{self.name} failed {attempt} times on {board.fen()}") from e
+                self.log_failure(board, attempt, e, 'restarted')
+                self.restart()
+
+    def analyse(self, board, limit, **kwargs):
+        return self.supervised_search(board, limit, None, **kwargs)
+
+    def quit(self):
+        if self.engine is not None:
+            try:
+                self.engine.quit()
+            except Exception:
+                pass
+        self.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.quit()
+
+# Function to open an engine, supervised if supervisor settings (see SUPERVISOR_DEFAULTS) are given. If a tuned
+# configuration is in use (see tuned_engine_config), its options for the engine name (e.g. Threads and Hash) are used
+# unless options sets them.
+def open_supervised_engine(engine_command, options=None, supervisor=None, name=None):
+    options = {**tuned_engine_config(name).get('options', {}), **(options or {})} or None
+    if supervisor is None:
+        return open_engine(engine_command, options)
+    return EngineSupervisor(engine_command, options, name=name, **{**SUPERVISOR_DEFAULTS, **supervisor})
+
+if __name__ == "__main__":
+    # Example usage:
+    stockfish_path = '/path/to/stockfish'
+    supervisor = {'position_timeout': 30, 'max_retries': 2, 'failure_log': 'engine_failures.jsonl'}
+    with open_supervised_engine(stockfish_path, supervisor=supervisor, name='stockfish') as engine:
+        info = engine.analyse(chess.Board(), chess.engine.Limit(depth=20))
+        print(info['score'])
+        print(f"restarts: {engine.restarts}, timeouts: {engine.timeouts}, failures: {engine.failures}")
@@ -0,0 +1,125 @@
+"""
+This script finds the engine configuration with the most positions per second on the machine. Combinations of the
+number of engines run in parallel, Threads and Hash (Stockfish) or Threads, Backend and MinibatchSize (Lc0) are
+benchmarked on a sample of positions from the PGN files of the corpus, at the fixed depth or number of nodes of the
+annotation, so every configuration searches to the same quality. Each configuration starts its own engines, so the
+hash of one does not help another. The best configuration is saved to engine_config.json (see ENGINE_CONFIG_PATH of
+engine_search.py). When it is selected with --engine-config or WCC_ENGINE_CONFIG, the annotators open their engines
+with its options, and distributed workers run its number of engines unless told otherwise.
+"""
+
+import chess.engine
+import instrumentation
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from engine_search import open_engine, search_position, sample_positions, ENGINE_CONFIG_PATH
+
+# positions: number of positions of the benchmark
+# every_nth_ply: take every n-th ply of the games
+# engines, threads: candidate numbers of engines and of threads per engine (None: the powers of two up to cores)
+# hash: candidate Hash sizes in MB per engine (Stockfish)
+# backends, minibatch: candidate Backend and MinibatchSize options (Lc0, None: the engine default)
+# cores: number of cores the engines may use together (None: all)
+# max_hash_total: maximum Hash of all engines together in MB
+TUNE_DEFAULTS = {
+    'positions': 40,
+    'every_nth_ply': 3,
+    'engines': None,
+    'threads': None,
+    'hash': [16, 64, 256],
+    'backends': [None],
+    'minibatch': [None],
+    'cores': None,
+    'max_hash_total': 4096,
+}
+
+# Function to get the powers of two up to limit
+def powers_of_two(limit):
+    return [2 ** i for i in range(limit.bit_length()) if 2 ** i <= limit]
+
+# Function to list the configurations to benchmark, each with the number of engines and the UCI options of an engine
+def candidate_configs(name, settings):
+    cores = settings['cores'] or os.cpu_count() or 1
+    engine_counts = settings['engines'] or powers_of_two(cores)
+    thread_counts = settings['threads'] or powers_of_two(cores)
+    configs = []
+    for engines, threads in itertools.product(engine_counts, thread_counts):
+        if engines * threads > cores:
+            continue
+        if name == 'stockfish':
+            for hash_size in settings['hash']:
+                if engines * hash_size <= settings['max_hash_total']:
+                    configs.append({'engines': engines, 'options': {'Threads': threads, 'Hash': hash_size}})
+        else:
+            for backend, minibatch in itertools.product(settings['backends'], settings['minibatch']):
+                options = {'Threads': threads, 'Backend': backend, 'MinibatchSize': minibatch}
+                configs.append({'engines': engines, 'options': {key: value for key, value in options.items() if value is not None}})
+    return configs
+
+# Function to search the positions with the engines of a configuration, the positions are shared out among the engines
+# and searched in parallel. Returns the positions per second.
+def measure_config(engine_command, base_options, config, positions, limit):
+    engines = [open_engine(engine_command, {**base_options, **config['options']}) for _ in range(config['engines'])]
+    try:
+        def search_all(i):
+            for board in positions[i::len(engines)]:
+                instrumentation.record_search(search_position(engines[i], board, limit))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+            list(executor.map(search_all, range(len(engines))))
+        return len(positions) / (time.perf_counter() - start)
+    finally:
+        for engine in engines:
+            engine.quit()
+
+# Function to save the configuration of an engine, the configurations of the other engines in the file are kept
+def save_engine_config(name, config, config_path=None):
+    config_path = config_path or ENGINE_CONFIG_PATH
+    saved = {}
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            saved = json.load(f)
+    saved[name] = config
+    with open(config_path, 'w') as f:
+        json.dump(saved, f, indent=4)
+
+# Benchmark the configurations of an engine ('stockfish' or 'lc0') on positions from the PGN files in pgn_dir and save
+# the fastest to config_path (default ENGINE_CONFIG_PATH). engine_command is a path or a list such as
+# [lc0_path, '--weights=...']; limit is the fixed quality, e.g. chess.engine.Limit(depth=20) or Limit(nodes=2500).
+# settings: see TUNE_DEFAULTS. Returns the results sorted from the fastest.
+@instrumentation.timed_stage('tune_engine')
+def main_tune_engine(pgn_dir, name, engine_command, limit, settings=None, config_path=None):
+    settings = {**TUNE_DEFAULTS, **(settings or {})}
+    positions = sample_positions(pgn_dir, settings['positions'], settings['every_nth_ply'])
+    if not positions:
+        print(f"No positions found in {pgn_dir}")
+        return []
+    base_options = {'UCI_ShowWDL': True} if name == 'lc0' else {}
+    results = []
+    for config in candidate_configs(name, settings):
+        try:
+            positions_per_second = measure_config(engine_command, base_options, config, positions, limit)
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+            print(f"Skipping {config}: {e}")
+            continue
+        results.append({**config, 'positions_per_second': round(positions_per_second, 2)})
+        print(f"{config['engines']} x {config['options']}: {positions_per_second:.2f} positions/s")
+    if not results:
+        return results
+    results.sort(key=lambda result: result['positions_per_second'], reverse=True)
+    best = results[0]
+    limit_settings = {key: value for key, value in (('depth', limit.depth), ('nodes', limit.nodes), ('time', limit.time)) if value is not None}
+    save_engine_config(name, {**best, 'limit': limit_settings, 'positions': len(positions)}, config_path)
+    print(f"Best: {best['engines']} engines with {best['options']} ({best['positions_per_second']} positions/s), saved to {config_path or ENGINE_CONFIG_PATH}")
+    print(f"Use it with python main.py --engine-config {config_path or ENGINE_CONFIG_PATH} ... or WCC_ENGINE_CONFIG={config_path or ENGINE_CONFIG_PATH}")
+    return results
+
+if __name__ == "__main__":
+    # Example usage:
+    pgn_dir = '/path/to/WCC_matches/Stockfish'
+    main_tune_engine(pgn_dir, 'stockfish', '/usr/bin/stockfish', chess.engine.Limit(depth=20), {'hash': [64, 256]})
+    main_tune_engine(pgn_dir, 'lc0', ['/usr/bin/lc0', '--weights=/path/to/weights.pb.gz'], chess.engine.Limit(nodes=2500),
+                     {'backends': ['cuda-fp16', 'cuda'], 'minibatch': [128, 256]})
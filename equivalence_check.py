@@ -0,0 +1,451 @@
+"""
+This script checks that the optimized modes of the pipeline reproduce the numbers of the reference implementations. The
+reference is gi_and_gpl and calculate_acpl of the analyzers (per game) and main_stats on the CSV of main_json_to_csv
+(per player). Each optimized mode is run side by side with the reference on generated games and on real PGN files:
+- per game: the unified analyzer (both families) and the compact corpus metrics
+- per file: the sharded parallel analysis, the streamed CSV of game_stream.py and the CSV of the compact corpus
+- per player: main_stats on a game store and on the CSV of the compact corpus
+The generated games are synthetic games (see synthetic_pgn_generator.py), part of them mutated into edge cases: missing
+annotations, mate scores, extreme evaluations, unknown results, missing Elo and very short games. Values may differ by
+one unit of the rounding of the output (sums in another order can round the other way), larger differences are
+failures. A failing game of a per-game mode is shrunk to a minimal game that still fails: the shortest failing prefix
+of its moves, then without the annotations and headers that are not needed. It runs offline without any engine and is
+part of the benchmark suite (see benchmark_suite.py).
+"""
+
+import chess
+import chess.pgn
+import io
+import json
+import math
+import os
+import random
+import re
+import pandas as pd
+from pgn_io import is_pgn_file, is_compressed, open_pgn
+from game_metrics import extract_game_details
+from synthetic_pgn_generator import random_move_sequence, annotated_movetext, game_headers
+
+# games: number of generated games
+# seed: seed of the generated games
+# mutation_rate: fraction of the generated games turned into edge cases
+# pgn_dirs: directories with real PGN files, each analyzed as one folder of the pipeline (None: the folders of WCC_matches)
+# configurations: scoring settings each mode is checked with
+# workers: worker processes of the sharded analysis
+# max_failures: failing games per mode kept in the report
+EQUIVALENCE_DEFAULTS = {
+    'games': 200,
+    'seed': 0,
+    'mutation_rate': 0.3,
+    'pgn_dirs': None,
+    'configurations': [
+        {'wdl_values': [1, 0.5, 0], 'weighted': False},
+        {'wdl_values': [1, 0.5, 0], 'weighted': True},
+        {'wdl_values': [3, 1.25, 0], 'weighted': False},
+    ],
+    'workers': 2,
+    'max_failures': 5,
+}
+
+PLUS_MIN_PLUS_SEC = [90, 30, 30]
+
+# Rounding of the outputs by key suffix (the first match counts), the keys of other numbers must be equal. The player
+# stats are all rounded to 2 decimals.
+ROUNDING_UNITS = [('gi_permove', 0.1), ('missed_points_permove', 0.0001), ('gi_raw', 0.01), ('gi', 0.1), ('missed_points', 0.01), ('acpl', 0.01)]
+PLAYER_STATS_UNIT = 0.01
+
+EVAL_PATTERN = re.compile(r'\[%eval [^\]]+\]')
+WDL_PATTERN = re.compile(r'\[%wdl \[[^\]]*\]\]')
+ANNOTATION_PATTERN = re.compile(r'\[%\w+ (?:\[[^\]]*\]|[^\]])*\]')
+
+# Function to get the mainline of a game as a list of (move, comment), without the variations
+def game_plies(game):
+    return [(node.move, node.comment) for node in game.mainline()]
+
+# Function to build a game from its headers and mainline plies
+def build_game(headers, plies):
+    game = chess.pgn.Game(headers)
+    node = game
+    for move, comment in plies:
+        node = node.add_variation(move, comment=comment)
+    return game
+
+# Edge cases of the generated games, each changes a game in place
+def drop_annotations(rng, game):
+    for node in game.mainline():
+        if rng.random() < 0.3:
+            node.comment = (EVAL_PATTERN if rng.random() < 0.5 else WDL_PATTERN).sub('', node.comment).strip()
+
+def mate_scores(rng, game):
+    nodes = list(game.mainline())
+    for node in rng.sample(nodes, min(3, len(nodes))):
+        node.comment = EVAL_PATTERN.sub(f"[%eval #{rng.choice([-1, 1]) * rng.randint(1, 20)}]", node.comment)
+
+def extreme_evaluations(rng, game):
+    nodes = list(game.mainline())
+    for node in rng.sample(nodes, min(3, len(nodes))):
+        node.comment = EVAL_PATTERN.sub(f"[%eval {rng.uniform(-200, 200):.2f}]", node.comment)
+
+def unknown_result(rng, game):
+    game.headers['Result'] = '*'
+
+def missing_elo(rng, game):
+    game.headers.pop(rng.choice(['WhiteElo', 'BlackElo']), None)
+
+def short_game(rng, game):
+    plies = game_plies(game)
+    node = game
+    for move, comment in plies[:rng.randint(1, 4)]:
+        node = node.variations[0]
+    node.variations = []
+
+MUTATIONS = [drop_annotations, mate_scores, extreme_evaluations, unknown_result, missing_elo, short_game]
+
+# Function to generate games with annotations as the annotators write them, part of them mutated into edge cases
+def generated_games(n_games, seed, mutation_rate):
+    rng = random.Random(seed)
+    games = []
+    for game_index in range(n_games):
+        san_moves, alternatives = random_move_sequence(rng, min_plies=2, max_plies=120)
+        movetext, result = annotated_movetext(rng, san_moves, alternatives, PLUS_MIN_PLUS_SEC)
+        game = chess.pgn.read_game(io.StringIO(f"{game_headers(rng, game_index, 20, 1886 + game_index % 139, result)}\n\n{movetext} {result}\n\n"))
+        if rng.random() < mutation_rate:
+            rng.choice(MUTATIONS)(rng, game)
+        games.append(game)
+    return games
+
+WCC_MATCHES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'WCC_matches')
+
+# Function to list the folders of the matches in this repository, e.g. WCC_matches/Stockfish/1886. The pipeline runs
+# each folder on its own (the JSON files are named after the PGN files, which repeat across the folders).
+def match_folders(matches_dir=WCC_MATCHES_DIR):
+    if not os.path.isdir(matches_dir):
+        return []
+    return [os.path.join(matches_dir, engine, folder) for engine in sorted(os.listdir(matches_dir)) if os.path.isdir(os.path.join(matches_dir, engine))
+            for folder in sorted(os.listdir(os.path.join(matches_dir, engine))) if os.path.isdir(os.path.join(matches_dir, engine, folder))]
+
+# Function to read the games of the PGN files of a directory (searched recursively)
+def read_games(pgn_dir):
+    games = []
+    for dirpath, dirnames, filenames in os.walk(pgn_dir):
+        for filename in sorted(filenames):
+            if is_pgn_file(filename):
+                with open_pgn(os.path.join(dirpath, filename)) as pgn:
+                    while True:
+                        game = chess.pgn.read_game(pgn)
+                        if game is None:
+                            break
+                        games.append(game)
+    return games
+
+# Function to flatten the metrics and counts of a game into one dict
+def metrics_dict(metrics, counts):
+    return {**metrics, **{f'counts.{key}': value for key, value in counts.items()}}
+
+# Reference and optimized per-game implementations. Each returns the metrics and counts of a game, None if the game has
+# no annotations for it.
+def reference_stockfish(game, wdl_values, weighted):
+    from pgn_evaluation_fast_analyzer import extract_pawn_evals_from_pgn, stockfish_metrics
+    game_result, game_details, WhiteElo, BlackElo = extract_game_details(game, unknown_result='...')
+    pawns_list = extract_pawn_evals_from_pgn(game)
+    if pawns_list is None or len(pawns_list) < 2:
+        return None
+    return metrics_dict(*stockfish_metrics(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted))
+
+def reference_lc0(game, wdl_values, weighted):
+    from pgn_evaluation_fast_analyzer_lc0 import extract_pawn_evals_from_pgn, lc0_metrics
+    game_result, game_details, WhiteElo, BlackElo = extract_game_details(game)
+    pawns_list, nodes_list, time_list, wdl_list = extract_pawn_evals_from_pgn(game)
+    if pawns_list is None or len(pawns_list) < 2:
+        return None
+    return metrics_dict(*lc0_metrics(pawns_list, nodes_list, time_list, wdl_list, game_result, WhiteElo, BlackElo, wdl_values, PLUS_MIN_PLUS_SEC, weighted))
+
+def unified_family(game, wdl_values, weighted, family):
+    from pgn_evaluation_unified_analyzer import analyze_game_unified, METRIC_FAMILIES
+    game_data = analyze_game_unified(game, wdl_values, PLUS_MIN_PLUS_SEC, weighted, families=(family,))
+    prefix = f"{METRIC_FAMILIES[family]['prefix']}_"
+    if game_data is None or f'{prefix}counts' not in game_data:
+        return None
+    metrics = {key[len(prefix):]: value for key, value in game_data.items() if key.startswith(prefix) and key != f'{prefix}counts'}
+    return metrics_dict(metrics, game_data[f'{prefix}counts'])
+
+def unified_stockfish(game, wdl_values, weighted):
+    return unified_family(game, wdl_values, weighted, 'stockfish')
+
+def unified_lc0(game, wdl_values, weighted):
+    return unified_family(game, wdl_values, weighted, 'lc0')
+
+def corpus_stockfish(game, wdl_values, weighted):
+    from compact_corpus import CorpusBuilder, corpus_stockfish_metrics
+    builder = CorpusBuilder()
+    builder.add_game(game)
+    result = corpus_stockfish_metrics(builder.corpus(), 0, wdl_values, weighted)
+    return metrics_dict(*result) if result is not None else None
+
+# Per-game modes: the reference and the optimized implementation
+GAME_MODES = {
+    'unified_stockfish': (reference_stockfish, unified_stockfish),
+    'unified_lc0': (reference_lc0, unified_lc0),
+    'compact_corpus': (reference_stockfish, corpus_stockfish),
+}
+
+# Function to get the rounding unit of a key
+def rounding_unit(key):
+    for suffix, unit in ROUNDING_UNITS:
+        if key.endswith(suffix):
+            return unit
+    return 0
+
+# Function to check that two values are equal up to the rounding unit
+def values_match(reference, optimized, unit):
+    numbers = (int, float)
+    if isinstance(reference, numbers) and isinstance(optimized, numbers) and not isinstance(reference, bool) and not isinstance(optimized, bool):
+        if math.isnan(reference) or math.isnan(optimized):
+            return math.isnan(reference) and math.isnan(optimized)
+        return abs(reference - optimized) <= unit * (1 + 1e-9) + 1e-12
+    return reference == optimized
+
+# Function to list the differences of two dicts as (key, reference value, optimized value), unit gives the rounding
+# unit of a key
+def dict_differences(reference, optimized, unit=rounding_unit):
+    if reference is None or optimized is None:
+        return [] if reference is optimized else [('game', reference is not None, optimized is not None)]
+    return [(key, reference.get(key), optimized.get(key)) for key in sorted(set(reference) | set(optimized))
+            if not values_match(reference.get(key), optimized.get(key), unit(key))]
+
+# Function to run an implementation, an exception becomes the result so the same error in both is no difference
+def run_safely(function, *args):
+    try:
+        return function(*args)
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+# Function to compare the reference and the optimized implementation of a mode on a game
+def game_differences(mode, game, configuration):
+    reference, optimized = GAME_MODES[mode]
+    args = (game, configuration['wdl_values'], configuration['weighted'])
+    return dict_differences(run_safely(reference, *args), run_safely(optimized, *args))
+
+# Function to shrink a failing game: the shortest prefix of its mainline that fails, then without the annotations and
+# the headers that are not needed to fail. Returns the game unchanged if it only fails with its variations.
+def shrink_game(game, fails):
+    headers, plies = dict(game.headers), game_plies(game)
+    if not fails(build_game(headers, plies)):
+        return game
+    for n in range(1, len(plies)):
+        if fails(build_game(headers, plies[:n])):
+            plies = plies[:n]
+            break
+    for i in range(len(plies)):
+        trial = plies[:i] + [(plies[i][0], '')] + plies[i + 1:]
+        if plies[i][1] and fails(build_game(headers, trial)):
+            plies = trial
+            continue
+        # Keep the comment, but without the annotations that are not needed
+        for annotation in ANNOTATION_PATTERN.findall(plies[i][1]):
+            trial = plies[:i] + [(plies[i][0], ' '.join(plies[i][1].replace(annotation, '').split()))] + plies[i + 1:]
+            if fails(build_game(headers, trial)):
+                plies = trial
+    for name in list(headers):
+        trial = {key: value for key, value in headers.items() if key != name}
+        if fails(build_game(trial, plies)):
+            headers = trial
+    return build_game(headers, plies)
+
+# Function to check the per-game modes on games, returns the number of checked games and the failures of each mode
+def check_games(games, source, configurations, max_failures):
+    checked, failures = {}, {}
+    for configuration in configurations:
+        for mode in GAME_MODES:
+            for i, game in enumerate(games):
+                checked[mode] = checked.get(mode, 0) + 1
+                differences = game_differences(mode, game, configuration)
+                if not differences:
+                    continue
+                failures.setdefault(mode, [])
+                if len(failures[mode]) >= max_failures:
+                    failures[mode].append(None)
+                    continue
+                minimal = shrink_game(game, lambda candidate: bool(game_differences(mode, candidate, configuration)))
+                failures[mode].append({'source': source, 'game': i + 1, **configuration, 'differences': differences,
+                                       'minimal_differences': game_differences(mode, minimal, configuration), 'minimal_pgn': str(minimal)})
+    return checked, failures
+
+# Function to compare the records of the games of a file, or the errors that stopped the analysis of the file
+def records_differences(reference, optimized):
+    if isinstance(reference, dict) or isinstance(optimized, dict):
+        return [] if reference == optimized else [('file', reference if isinstance(reference, dict) else 'ok', optimized if isinstance(optimized, dict) else 'ok')]
+    differences = [('games', len(reference), len(optimized))] if len(reference) != len(optimized) else []
+    for i, (a, b) in enumerate(zip(reference, optimized)):
+        differences.extend((f'{i + 1}.{key}', x, y) for key, x, y in dict_differences(a, b))
+    return differences
+
+# Function to compare two tables of rows up to the rounding unit of the columns. The rows are matched after sorting
+# both tables by key_columns, as the modes may write the games of the files in a different order.
+def table_differences(reference, optimized, key_columns, unit=rounding_unit):
+    if reference is None or optimized is None:
+        return [] if reference is optimized else [('table', reference is not None, optimized is not None)]
+    if len(reference) != len(optimized):
+        return [('rows', len(reference), len(optimized))]
+    columns = sorted(set(reference.columns) | set(optimized.columns))
+    missing = [column for column in columns if column not in reference.columns or column not in optimized.columns]
+    if missing:
+        return [('columns', [c for c in missing if c in reference.columns], [c for c in missing if c in optimized.columns])]
+    key_columns = [column for column in key_columns if column in columns]
+    reference = reference[columns].sort_values(key_columns, kind='stable').reset_index(drop=True)
+    optimized = optimized[columns].sort_values(key_columns, kind='stable').reset_index(drop=True)
+    differences = []
+    for column in columns:
+        for i, (a, b) in enumerate(zip(reference[column].tolist(), optimized[column].tolist())):
+            if not values_match(a, b, unit(column)) and not (pd.isna(a) and pd.isna(b)):
+                differences.append((f'{i}.{column}', a, b))
+    return differences
+
+# Key columns that identify the games of a table
+GAME_KEY_COLUMNS = ['Event', 'Site', 'Date', 'Round', 'White', 'Black', 'white_gi', 'black_gi']
+
+# Function to read a CSV written by a mode, None if the mode wrote no file
+def read_table(path):
+    from csv_to_player_stats import read_csv
+    return read_csv(path) if os.path.exists(path) else None
+
+# Function to check the per-file and per-player modes on the PGN files of a directory. Returns the number of checks and
+# the failures of each mode.
+def check_directory(pgn_dir, work_dir, source, configurations, workers, max_failures):
+    from game_stream import analyze_fn_for, iter_pgn_records, TableSink
+    from pgn_sharding import iter_pgn_sharded
+    from pgn_evaluation_fast_analyzer import main_analyze
+    from pgn_evaluation_fast_analyzer_lc0 import main_analyze_lc0
+    from pgn_evaluation_unified_analyzer import main_analyze_unified
+    from json_to_csv_converter import main_json_to_csv
+    from csv_to_player_stats import main_stats
+    from compact_corpus import build_corpus, analyze_corpus
+    checked, failures = {}, {}
+
+    def record(mode, differences, **details):
+        checked[mode] = checked.get(mode, 0) + 1
+        if differences:
+            failures.setdefault(mode, [])
+            failures[mode].append({'source': source, **details, 'differences': differences[:20]} if len(failures[mode]) < max_failures else None)
+
+    pgn_files = sorted(os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(pgn_dir)
+                       for filename in filenames if is_pgn_file(filename) and not is_compressed(filename))
+    corpus = build_corpus(pgn_dir)
+    for n, configuration in enumerate(configurations):
+        wdl_values, weighted = configuration['wdl_values'], configuration['weighted']
+        run_dir = os.path.join(work_dir, f'configuration_{n}')
+        # Sharded analysis in small byte ranges, so even small files are split among the workers
+        for engine in ('stockfish', 'lc0'):
+            analyze_fn = analyze_fn_for(engine, wdl_values, PLUS_MIN_PLUS_SEC, weighted)
+            for pgn_file_path in pgn_files:
+                chunk_bytes = max(1, os.path.getsize(pgn_file_path) // (4 * workers))
+                reference = run_safely(lambda: list(iter_pgn_records(pgn_file_path, analyze_fn)))
+                optimized = run_safely(lambda: list(iter_pgn_sharded(pgn_file_path, analyze_fn, workers, chunk_bytes=chunk_bytes, min_shard_bytes=0)))
+                record(f'sharded_{engine}', records_differences(reference, optimized), file=pgn_file_path, **configuration)
+        # Reference CSV and player stats: main_analyze, main_json_to_csv and main_stats
+        reference_dir = os.path.join(run_dir, 'reference')
+        if run_safely(main_analyze, pgn_dir, os.path.join(reference_dir, 'json'), wdl_values, weighted) is not None:
+            # The reference cannot analyze the files (see the sharded checks for the error), nothing to compare with
+            continue
+        main_json_to_csv(os.path.join(reference_dir, 'json'), reference_dir, 'reference')
+        reference_csv = os.path.join(reference_dir, 'aggregated_game_data_reference.csv')
+        reference_table = read_table(reference_csv)
+        if reference_table is not None:
+            run_safely(main_stats, reference_csv, reference_dir, 'reference')
+        reference_stats = read_table(os.path.join(reference_dir, 'player_stats_reference.csv'))
+        # Streamed CSV of each analyzer, compared with main_json_to_csv on the JSON files of the analyzer
+        for engine in ('stockfish', 'lc0', 'both'):
+            if engine == 'stockfish':
+                engine_reference_table = reference_table
+            else:
+                engine_dir = os.path.join(run_dir, f'reference_{engine}')
+                analyze = main_analyze_lc0 if engine == 'lc0' else main_analyze_unified
+                if run_safely(analyze, pgn_dir, os.path.join(engine_dir, 'json'), wdl_values, PLUS_MIN_PLUS_SEC, weighted) is not None:
+                    continue
+                main_json_to_csv(os.path.join(engine_dir, 'json'), engine_dir, 'reference')
+                engine_reference_table = read_table(os.path.join(engine_dir, 'aggregated_game_data_reference.csv'))
+            stream_csv = os.path.join(run_dir, f'stream_{engine}.csv')
+            analyze_fn = analyze_fn_for(engine, wdl_values, PLUS_MIN_PLUS_SEC, weighted)
+            # Small chunks, so the columns of later games are added to the header of the rows already written
+            with TableSink(stream_csv, chunk_size=7) as sink:
+                for pgn_file_path in sorted(os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(pgn_dir)
+                                            for filename in filenames if is_pgn_file(filename)):
+                    for game_data in iter_pgn_records(pgn_file_path, analyze_fn):
+                        sink.write(game_data)
+            stream_table = read_table(stream_csv) if os.path.getsize(stream_csv) else None
+            record(f'stream_table_{engine}', table_differences(engine_reference_table, stream_table, GAME_KEY_COLUMNS), **configuration)
+        # CSV and player stats of the compact corpus
+        corpus_dir = os.path.join(run_dir, 'corpus')
+        os.makedirs(corpus_dir, exist_ok=True)
+        corpus_table = analyze_corpus(corpus, wdl_values, weighted)
+        corpus_csv = os.path.join(corpus_dir, 'aggregated_game_data_corpus.csv')
+        if len(corpus_table):
+            corpus_table.to_csv(corpus_csv, index=False)
+            run_safely(main_stats, corpus_csv, corpus_dir, 'corpus')
+        record('corpus_table', table_differences(reference_table, read_table(corpus_csv), GAME_KEY_COLUMNS), **configuration)
+        record('corpus_stats', table_differences(reference_stats, read_table(os.path.join(corpus_dir, 'player_stats_corpus.csv')), ['Player'],
+                                                 lambda column: PLAYER_STATS_UNIT), **configuration)
+        # Player stats of a game store
+        store_dir = os.path.join(run_dir, 'store')
+        store_path = os.path.join(store_dir, 'games.db')
+        if os.path.exists(store_path):
+            os.remove(store_path)
+        os.makedirs(store_dir, exist_ok=True)
+        if run_safely(main_analyze, pgn_dir, None, wdl_values, weighted, 1, store_path) is None and reference_table is not None:
+            run_safely(main_stats, store_path, store_dir, 'store', 'stockfish')
+        record('store_stats', table_differences(reference_stats, read_table(os.path.join(store_dir, 'player_stats_store.csv')), ['Player'],
+                                                lambda column: PLAYER_STATS_UNIT), **configuration)
+    return checked, failures
+
+# Function to add the checks and failures of a run to the totals
+def merge_results(totals, checked, failures):
+    for mode, n in checked.items():
+        totals.setdefault(mode, {'checked': 0, 'failed': 0, 'failures': []})
+        totals[mode]['checked'] += n
+    for mode, mode_failures in failures.items():
+        totals[mode]['failed'] += len(mode_failures)
+        totals[mode]['failures'].extend(failure for failure in mode_failures if failure is not None)
+
+# Run the optimized modes side by side with the reference implementations on generated games and on the PGN files of
+# settings['pgn_dirs'], and write equivalence_report.json to work_dir. settings: see EQUIVALENCE_DEFAULTS. Returns the
+# report with the number of checks and failures of each mode, and the failing (shrunk) games.
+def main_equivalence_check(work_dir, settings=None):
+    unknown = sorted(set(settings or {}) - set(EQUIVALENCE_DEFAULTS))
+    if unknown:
+        raise ValueError(f"Unknown equivalence check settings: {unknown}")
+    settings = {**EQUIVALENCE_DEFAULTS, **(settings or {})}
+    configurations, max_failures = settings['configurations'], settings['max_failures']
+    generated_dir = os.path.join(work_dir, 'generated', 'PGNs')
+    os.makedirs(generated_dir, exist_ok=True)
+    games = generated_games(settings['games'], settings['seed'], settings['mutation_rate'])
+    # The file of the per-file checks only has the games the reference pipeline can process, one game it stops on would
+    # stop the whole file: a single evaluated move (the per-move stats divide by zero) or an unknown result (main_stats
+    # cannot sum the results). The per-game checks include all games.
+    configuration = configurations[0]
+    with open(os.path.join(generated_dir, 'generated.pgn'), 'w') as f:
+        for game in games:
+            results = [run_safely(reference, game, configuration['wdl_values'], configuration['weighted']) for reference in (reference_stockfish, reference_lc0)]
+            if game.headers.get('Result') in ('1-0', '0-1', '1/2-1/2') and not any(result is not None and 'error' in result for result in results):
+                f.write(f"{game}\n\n")
+    pgn_dirs = settings['pgn_dirs'] if settings['pgn_dirs'] is not None else match_folders()
+    sources = [('generated', generated_dir)] + [(pgn_dir, pgn_dir) for pgn_dir in pgn_dirs if os.path.isdir(pgn_dir)]
+    report = {}
+    for n, (source, pgn_dir) in enumerate(sources):
+        merge_results(report, *check_games(games if source == 'generated' else read_games(pgn_dir), source, configurations, max_failures))
+        merge_results(report, *check_directory(pgn_dir, os.path.join(work_dir, f'source_{n}'), source, configurations, settings['workers'], max_failures))
+    for mode, result in report.items():
+        result['status'] = 'ok' if result['failed'] == 0 else 'DIFFERENT'
+        print(f"{mode:<24} {result['checked']:>8} checks  {result['failed']:>6} failures  {result['status']}")
+    with open(os.path.join(work_dir, 'equivalence_report.json'), 'w') as f:
+        json.dump(report, f, indent=4, default=str)
+    return report
+
+if __name__ == "__main__":
+    # Example usage:
+    work_dir = '/path/to/benchmarks/equivalence'
+    # Each PGN directory is one folder of the pipeline, e.g. a match of WCC_matches
+    report = main_equivalence_check(work_dir, {'games': 500, 'pgn_dirs': ['/path/to/WCC_matches/Stockfish/1886', '/path/to/WCC_matches/Lc0/1886']})
+    for mode, result in report.items():
+        for failure in result['failures']:
+            print(mode, failure['differences'][:3])
+            print(failure.get('minimal_pgn', ''))
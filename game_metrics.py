@@ -0,0 +1,210 @@
+"""
+This script contains the functions shared by the analyzers: reading the %eval, %wdl and %clk annotations of a node,
+building the per-ply lists from them, the game details from the headers, ACPL, expected values, GI by result and the
+normalized and Elo-adjusted GI. pgn_evaluation_fast_analyzer.py (Stockfish), pgn_evaluation_fast_analyzer_lc0.py (Lc0)
+and pgn_evaluation_unified_analyzer.py (both in one pass) use them, so the formulas are defined once.
+"""
+
+import chess
+import re
+from datetime import timedelta
+
+# Function to extract the evaluation from a node
+def extract_eval_from_node(node):
+    node_evaluation = node.eval()
+    if node_evaluation:
+        cp_value = node_evaluation.pov(chess.WHITE).score(mate_score=10000) / 100.0
+        return cp_value
+    else:
+        return None
+
+# Function to extract the WDL from a node's comment
+def extract_wdl_from_node(node):
+    comment = node.comment
+    wdl_annotation = re.search(r'\[%wdl \[([\d\.]+), ([\d\.]+), ([\d\.]+)\]\]', comment)
+    if wdl_annotation:
+        win_prob = float(wdl_annotation.group(1))
+        draw_prob = float(wdl_annotation.group(2))
+        loss_prob = float(wdl_annotation.group(3))
+        return [win_prob, draw_prob, loss_prob]
+    else:
+        return None
+
+# Function to extract time from a node
+def extract_time_from_node(node):
+    # This attempts to find the [%clk hh:mm:ss] annotation within the node's comment
+    comment = node.comment  # Extract the comment from the node
+    time_annotation = re.search(r'\[%clk (\d+:\d+:\d+)\]', comment)
+    if time_annotation:
+        # Extract the time string from the regex match group
+        time_string = time_annotation.group(1)
+        # Optionally, convert the time string to a datetime.timedelta object for further manipulation
+        hours, minutes, seconds = map(int, time_string.split(':'))
+        return timedelta(hours=hours, minutes=minutes, seconds=seconds)
+    else:
+        return None
+
+# Function to build the Stockfish list of evaluations from the evaluations of the mainline nodes (None if missing).
+# Nodes without an evaluation are skipped and the initial value is the first evaluation.
+def stockfish_pawns_list(evals):
+    # set the initial value to 0
+    pawns_list = [0]
+    for eval_value in evals:
+        if eval_value is not None:
+            pawns_list.append(eval_value)
+    if len(pawns_list) > 1:
+        pawns_list[0] = pawns_list[1]
+    return pawns_list if pawns_list else None
+
+# Function to build the Lc0 lists (evaluations, nodes, clocks and WDLs) from the annotations of the mainline nodes.
+# Missing values are filled with the previous one.
+def lc0_lists(game, nodes, evals, wdls, clocks):
+    pawns_list = [0]
+    wdl_list = []
+    nodes_list = [game]  # Start with the root node
+    time_list = [timedelta(seconds=0)]
+    for node, eval_value, wdl_value, time_value in zip(nodes, evals, wdls, clocks):
+        if eval_value is not None:
+            pawns_list.append(eval_value)
+        else:
+            # Append the previous evaluation if the current evaluation is None
+            pawns_list.append(pawns_list[-1])
+        if wdl_value is not None:
+            wdl_list.append(wdl_value)
+        else:
+            # Append the previous WDL if the current WDL is None
+            if len(wdl_list) > 0:
+                wdl_list.append(wdl_list[-1])
+            else:
+                wdl_list.append([0.33, 0.34, 0.33])  # Default values
+        nodes_list.append(node)
+        if time_value is not None:
+            time_list.append(time_value)
+        else:
+            if len(time_list) > 1 and time_list[-2] is not None:
+                # Append the previous time of the same player if the current time is None
+                time_list.append(time_list[-2])
+            else:
+                # list is empty, so continue the loop
+                continue
+    # Handle the case where there is only one evaluation
+    if len(pawns_list) > 1:
+        pawns_list[0] = pawns_list[1]
+    if len(time_list) == 1:
+        time_list = None
+    return pawns_list if pawns_list else None, nodes_list if nodes_list else None, time_list if time_list else None, wdl_list if wdl_list else None
+
+# Function to get the result, the details and the Elo ratings of a game from its headers.
+# unknown_result is used for WhiteResult and BlackResult if the game has no result.
+def extract_game_details(game, unknown_result=None):
+    game_result = game.headers.get('Result', None)
+    if game_result == '1-0':
+        whiteResult = 1
+        blackResult = 0
+    elif game_result == '0-1':
+        whiteResult = 0
+        blackResult = 1
+    elif game_result == '1/2-1/2':
+        whiteResult = 0.5
+        blackResult = 0.5
+    else:
+        whiteResult = unknown_result
+        blackResult = unknown_result
+    # Further game details
+    game_details = {
+        "White": game.headers.get("White", None),
+        "Black": game.headers.get("Black", None),
+        "Event": game.headers.get("Event", None),
+        "Site": game.headers.get("Site", None),
+        "Round": game.headers.get("Round", None),
+        "WhiteElo": game.headers.get("WhiteElo", None),
+        "BlackElo": game.headers.get("BlackElo", None),
+        "WhiteResult": whiteResult,
+        "BlackResult": blackResult,
+        "Date": game.headers.get("Date", None),
+    }
+    # Get the ELO ratings of the players as integers
+    WhiteElo = int(game.headers.get("WhiteElo", None)) if game.headers.get("WhiteElo", None) else None
+    BlackElo = int(game.headers.get("BlackElo", None)) if game.headers.get("BlackElo", None) else None
+    return game_result, game_details, WhiteElo, BlackElo
+
+# Function to calculate the ACPL for both players
+def calculate_acpl(pawns_list):
+    white_losses, black_losses = [], []
+    for i in range(1, len(pawns_list)):
+        centipawn_loss = 100*(pawns_list[i] - pawns_list[i - 1])
+        if i % 2 == 1:  # White's turn
+            white_losses.append(-centipawn_loss)
+        else:  # Black's turn
+            black_losses.append(centipawn_loss)
+    white_acpl = sum(white_losses) / len(white_losses) if white_losses else 0
+    black_acpl = sum(black_losses) / len(black_losses) if black_losses else 0
+    return white_acpl, black_acpl
+
+def calculate_gi_by_result(white_gpl, black_gpl, game_result, wdl_values, postmove_exp_white, postmove_exp_black):
+    win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
+    # Calculate GI based on game result
+    if game_result == '1/2-1/2':
+        white_gi = draw_value - white_gpl
+        black_gi = draw_value - black_gpl
+    elif game_result == '1-0':
+        white_gi = win_value - white_gpl
+        black_gi = loss_value - black_gpl
+    elif game_result == '0-1':
+        black_gi = win_value - black_gpl
+        white_gi = loss_value - white_gpl
+    else:
+        white_gi = postmove_exp_white - white_gpl
+        black_gi = postmove_exp_black - black_gpl
+    # Normalize GI scores to the standard 1,0.5,0 scoring system.
+    white_gi = white_gi / win_value
+    black_gi = black_gi / win_value
+    return white_gi, black_gi
+
+# Function to calculate the time a player spent on the move at index i of the WDL list, from the clock times.
+# Returns None without clock times.
+def move_time_diff(i, time_list, plus_min_plus_sec):
+    if time_list is None:
+        return None
+    # Calculate the time difference between the current move and the same player's previous move
+    total_min, plus_min, plus_sec = plus_min_plus_sec[0], plus_min_plus_sec[1], plus_min_plus_sec[2]
+    if i > 2 and i < len(time_list):
+        if time_list[i].total_seconds() < time_list[i-2].total_seconds() + plus_sec:
+            # time_diff gives the time the player spent on the move
+            time_diff = time_list[i-2] + timedelta(seconds=plus_sec) - time_list[i]
+        else:
+            # it means that there was a time addition after the move, so plus_min should be added
+            time_diff = time_list[i-2] + timedelta(minutes=plus_min) + timedelta(seconds=plus_sec) - time_list[i]
+        # Handle the case where the time difference is negative
+        if time_diff.total_seconds() < 0:
+            # time_diff must be the absolute value of the time difference
+            time_diff = abs(time_diff)
+    else:
+        # set default value of time_diff 0 seconds as a timedelta object
+        time_diff = timedelta(seconds=0)
+    return time_diff
+
+# Function to calculate the expected value of a position
+def calculate_expected_value(win_prob, draw_prob, loss_prob, turn, wdl_values):
+    win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
+    if turn == "White":
+        expected_value_white = win_prob * win_value + draw_prob * draw_value
+        expected_value_black = loss_prob * win_value + draw_prob * draw_value
+    else:
+        expected_value_white = loss_prob * win_value + draw_prob * draw_value
+        expected_value_black = win_prob * win_value + draw_prob * draw_value
+    return expected_value_white, expected_value_black
+
+# Calculate normalized GI score
+def calculate_normalized_gi(gi):
+    # set a and b for normalized_gi = a + b *gi
+    a, b = 157.57, 18.55
+    return a  + b* gi
+
+# Adjust the GI score with respect to the opponent's rating
+def calculate_adjusted_gi(gi, opponent_elo, reference_elo):
+    return gi - (1 - 2 * expected_score(opponent_elo, reference_elo)) * abs(gi)
+
+# Adjust the GI score with respect to the opponent's rating
+def expected_score(opponent_elo, reference_elo):
+    return 1 / (1 + 10 ** ((reference_elo - opponent_elo) / 400))
@@ -0,0 +1,222 @@
+"""
+This script stores analyzed games in an embedded SQLite database, as an alternative to the per-file JSON outputs and
+the aggregated CSV. The database has three tables:
+- games: the headers and metrics of each game (one row per game and engine), with the other counts as JSON
+- plies: the evaluation, WDL and clock of each ply
+- blunder_positions: the blunder and critical positions found by the Lc0 analyzer
+Games are keyed by a hash of their headers and moves, so analyzing a game again updates its rows and new games are
+added in one transaction per batch of STORE_BATCH_SIZE games without rewriting the rest. The player_games view has one row per player and
+game, and player_aggregates computes the sums, counts, medians and variances of main_stats with SQL.
+"""
+
+import chess.pgn
+import hashlib
+import json
+import sqlite3
+from game_metrics import extract_eval_from_node, extract_wdl_from_node, extract_time_from_node
+
+# File extensions of game stores, e.g. for main_stats
+GAME_STORE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Number of games the analyzers upsert in one transaction, so the records of a large file are not all kept in memory
+STORE_BATCH_SIZE = 1000
+
+# Metric columns of the games table, as written by the analyzers
+GAME_METRIC_COLUMNS = ['white_gi', 'black_gi', 'white_gi_permove', 'black_gi_permove', 'white_gi_raw', 'black_gi_raw',
+                       'white_missed_points', 'black_missed_points', 'white_missed_points_permove', 'black_missed_points_permove',
+                       'white_acpl', 'black_acpl', 'white_move_number', 'black_move_number']
+
+# Header columns of the games table
+GAME_HEADER_COLUMNS = ['White', 'Black', 'Event', 'Site', 'Round', 'Date', 'WhiteElo', 'BlackElo', 'WhiteResult', 'BlackResult']
+
+GAME_STORE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS games (
+    game_hash TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    source_file TEXT,
+    white_player TEXT,
+    black_player TEXT,
+    {', '.join(f'{column} TEXT' for column in GAME_HEADER_COLUMNS[:6])},
+    WhiteElo INTEGER, BlackElo INTEGER, WhiteResult REAL, BlackResult REAL,
+    {', '.join(f'{column} REAL' for column in GAME_METRIC_COLUMNS)},
+    counts TEXT,
+    PRIMARY KEY (game_hash, engine)
+);
+CREATE INDEX IF NOT EXISTS games_white_player ON games (white_player);
+CREATE INDEX IF NOT EXISTS games_black_player ON games (black_player);
+CREATE INDEX IF NOT EXISTS games_date ON games (Date);
+CREATE INDEX IF NOT EXISTS games_event ON games (Event);
+CREATE INDEX IF NOT EXISTS games_engine ON games (engine);
+CREATE TABLE IF NOT EXISTS plies (
+    game_hash TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    ply INTEGER NOT NULL,
+    move TEXT,
+    eval REAL,
+    wdl_win REAL, wdl_draw REAL, wdl_loss REAL,
+    clock REAL,
+    PRIMARY KEY (game_hash, engine, ply)
+);
+CREATE TABLE IF NOT EXISTS blunder_positions (
+    game_hash TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    turn TEXT,
+    fen TEXT,
+    move_number INTEGER,
+    move TEXT,
+    prev_move TEXT,
+    time_diff TEXT,
+    exp_point_loss REAL
+);
+CREATE INDEX IF NOT EXISTS blunder_positions_game ON blunder_positions (game_hash, engine);
+CREATE VIEW IF NOT EXISTS player_games AS
+    SELECT game_hash, engine, Date, Event, white_player AS player, 'white' AS colour, white_gi AS gi, white_gi_raw AS gi_raw,
+           white_missed_points AS missed_points, white_acpl AS acpl, white_move_number AS moves, WhiteResult AS result,
+           WhiteElo AS elo, BlackElo AS opponent_elo FROM games
+    UNION ALL
+    SELECT game_hash, engine, Date, Event, black_player AS player, 'black' AS colour, black_gi AS gi, black_gi_raw AS gi_raw,
+           black_missed_points AS missed_points, black_acpl AS acpl, black_move_number AS moves, BlackResult AS result,
+           BlackElo AS elo, WhiteElo AS opponent_elo FROM games;
+"""
+
+# Function to hash a game from its Seven Tag Roster and moves, the same game gives the same hash in every file
+def game_hash(game):
+    headers = '\n'.join(f"{tag}={game.headers.get(tag, '')}" for tag in chess.pgn.TAG_ROSTER)
+    moves = ' '.join(move.uci() for move in game.mainline_moves())
+    return hashlib.sha1(f"{headers}\n{moves}".encode('utf-8')).hexdigest()
+
+# Function to get the rows of the plies table of a game: ply, move, evaluation, WDL and clock in seconds
+def ply_rows(game):
+    rows = []
+    for ply, node in enumerate(game.mainline(), start=1):
+        wdl = extract_wdl_from_node(node) or [None, None, None]
+        clock = extract_time_from_node(node)
+        rows.append((ply, node.move.uci(), extract_eval_from_node(node), *wdl, clock.total_seconds() if clock is not None else None))
+    return rows
+
+# Function to analyze a game with analyze_fn (e.g. analyze_game) and add what the store needs, returns None if the
+# game was skipped. Runs in the workers of iter_pgn_sharded, so only picklable values are returned.
+def analyze_game_record(game, analyze_fn):
+    game_data = analyze_fn(game)
+    if game_data is None:
+        return None
+    return {'game_hash': game_hash(game), 'plies': ply_rows(game), 'game_data': game_data}
+
+# Function to convert a value to a number for a REAL column, None if it is not a number (e.g. the result '...')
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Function to check whether a path is a game store
+def is_game_store(path):
+    return str(path).lower().endswith(GAME_STORE_EXTENSIONS)
+
+class GameStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(GAME_STORE_SCHEMA)
+
+    # Insert or update the records of analyze_game_record in one transaction
+    def upsert_games(self, records, engine, source_file=None):
+        # Imported here so the analyzers do not load pandas with json_to_csv_converter
+        from json_to_csv_converter import extract_full_name
+        columns = ['game_hash', 'engine', 'source_file', 'white_player', 'black_player'] + GAME_HEADER_COLUMNS + GAME_METRIC_COLUMNS + ['counts']
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns[2:])
+        game_sql = f"INSERT INTO games ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) ON CONFLICT (game_hash, engine) DO UPDATE SET {updates}"
+        with self.conn:
+            for record in records:
+                game_data, key = record['game_data'], record['game_hash']
+                counts = dict(game_data.get('counts', {}))
+                positions = [('blunder', position) for position in counts.pop('blunder_positions', [])]
+                positions += [('critical', position) for position in counts.pop('critical_positions', [])]
+                values = [key, engine, source_file, extract_full_name(game_data.get('White')), extract_full_name(game_data.get('Black'))]
+                values += [game_data.get(column) for column in GAME_HEADER_COLUMNS[:6]]
+                values += [to_number(game_data.get(column)) for column in GAME_HEADER_COLUMNS[6:] + GAME_METRIC_COLUMNS]
+                values.append(json.dumps(counts))
+                self.conn.execute(game_sql, values)
+                # The plies and positions of a game are replaced as a whole
+                self.conn.execute("DELETE FROM plies WHERE game_hash = ? AND engine = ?", (key, engine))
+                self.conn.execute("DELETE FROM blunder_positions WHERE game_hash = ? AND engine = ?", (key, engine))
+                self.conn.executemany("INSERT INTO plies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(key, engine, *row) for row in record['plies']])
+                self.conn.executemany("INSERT INTO blunder_positions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      [(key, engine, kind, p.get('turn'), p.get('fen'), p.get('move_number'), p.get('move'), p.get('prev_move'),
+                                        p.get('time_diff'), p.get('exp_point_loss')) for kind, p in positions])
+        return len(records)
+
+    # Function to build the WHERE clause of the player_games view for the given filters
+    def player_games_filter(self, engine=None, event=None, date_from=None, date_to=None):
+        conditions, params = ['player IS NOT NULL'], []
+        for condition, value in (('engine = ?', engine), ('Event = ?', event), ('Date >= ?', date_from), ('Date <= ?', date_to)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return ' AND '.join(conditions), params
+
+    # Function to calculate, per player, the sums, counts, medians and sample variances used by main_stats. Missing
+    # values are skipped as in pandas. Dates are compared as PGN strings, e.g. date_from='1921.01.01'.
+    def player_aggregates(self, engine=None, event=None, date_from=None, date_to=None):
+        import pandas as pd
+        where, params = self.player_games_filter(engine, event, date_from, date_to)
+        sums_sql = f"""
+            SELECT player AS Player,
+                   SUM(colour = 'white') AS White_games, SUM(colour = 'black') AS Black_games, COUNT(*) AS total_game_count,
+                   TOTAL(moves) AS total_moves,
+                   TOTAL(CASE WHEN colour = 'white' THEN result END) AS white_result_sum,
+                   TOTAL(CASE WHEN colour = 'black' THEN result END) AS black_result_sum,
+                   TOTAL(gi) AS total_gi_sum, TOTAL(gi_raw) AS total_gi_raw_sum,
+                   TOTAL(missed_points) AS total_missed_points_sum, TOTAL(acpl) AS total_acpl_sum,
+                   TOTAL(CASE WHEN colour = 'white' THEN gi END) AS white_gi_sum,
+                   TOTAL(CASE WHEN colour = 'black' THEN gi END) AS black_gi_sum,
+                   TOTAL(CASE WHEN colour = 'white' THEN missed_points END) AS white_missed_points_sum,
+                   TOTAL(CASE WHEN colour = 'black' THEN missed_points END) AS black_missed_points_sum,
+                   TOTAL(CASE WHEN colour = 'white' THEN acpl END) AS white_acpl_sum,
+                   TOTAL(CASE WHEN colour = 'black' THEN acpl END) AS black_acpl_sum,
+                   TOTAL(opponent_elo) AS sum_opponent_elo,
+                   COALESCE(AVG(CASE WHEN colour = 'white' THEN elo END), 0) AS avg_elo_white,
+                   COALESCE(AVG(CASE WHEN colour = 'black' THEN elo END), 0) AS avg_elo_black
+            FROM player_games WHERE {where} GROUP BY player"""
+        aggregates = pd.read_sql_query(sums_sql, self.conn, params=params)
+        for value in ['gi', 'gi_raw', 'missed_points', 'acpl']:
+            # The median is the mean of the one or two middle values of the sorted values of each player
+            stats_sql = f"""
+                WITH ranked AS (
+                    SELECT player, {value} AS x,
+                           ROW_NUMBER() OVER (PARTITION BY player ORDER BY {value}) AS rank,
+                           COUNT(*) OVER (PARTITION BY player) AS n,
+                           AVG({value}) OVER (PARTITION BY player) AS mean
+                    FROM player_games WHERE {where} AND {value} IS NOT NULL)
+                SELECT player AS Player,
+                       AVG(CASE WHEN rank IN ((n + 1) / 2, (n + 2) / 2) THEN x END) AS {value}_median,
+                       CASE WHEN MAX(n) > 1 THEN SUM((x - mean) * (x - mean)) / (MAX(n) - 1) END AS {value}_var
+                FROM ranked GROUP BY player"""
+            aggregates = pd.merge(aggregates, pd.read_sql_query(stats_sql, self.conn, params=params), on='Player', how='left')
+        return aggregates
+
+    # Function to get one row per player and game with the values resampled by bootstrap_intervals in csv_to_player_stats.py
+    def player_games(self, engine=None, event=None, date_from=None, date_to=None):
+        import pandas as pd
+        where, params = self.player_games_filter(engine, event, date_from, date_to)
+        sql = f"SELECT player AS Player, gi, missed_points, result, opponent_elo FROM player_games WHERE {where}"
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Function to open a game store, or None if no path is given
+def open_game_store(path):
+    return GameStore(path) if path else None
+
+if __name__ == "__main__":
+    # Example usage:
+    with GameStore('/path/to/games.db') as store:
+        print(store.player_aggregates(engine='stockfish').head())
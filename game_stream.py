@@ -0,0 +1,230 @@
+"""
+This script contains the streaming analysis API. The games of the PGN files are analyzed one by one (or by shards of
+pgn_sharding.py in worker processes) and their records are yielded in game order as soon as they are computed, so
+memory does not grow with the size of the files and downstream stages can start on the first records while the
+analysis continues. The records are written by sinks that flush continuously:
+- JSONObjectWriter: the JSON file of the analyzers ({"1": {...}, "2": {...}}), written game by game with the same
+  bytes as json.dump(aggregated_data, f, indent=4)
+- NDJSONSink: one JSON line per game, readable with read_ndjson while it is written
+- TableSink: the rows of the aggregated game data CSV (as json_to_csv_converter.py), written in chunks of rows
+"""
+
+import chess.pgn
+import csv
+import json
+import os
+from functools import partial
+from pgn_io import open_pgn, is_pgn_file, is_compressed
+from pgn_sharding import iter_pgn_sharded
+
+# Function to yield the records of the games of a PGN file in game order. analyze_fn returns None for games that are
+# skipped. With workers != 1 (None for all cores), large uncompressed files are analyzed in worker processes.
+def iter_pgn_records(pgn_file_path, analyze_fn, workers=1):
+    if workers != 1 and not is_compressed(pgn_file_path):
+        yield from iter_pgn_sharded(pgn_file_path, analyze_fn, workers)
+        return
+    with open_pgn(pgn_file_path) as pgn:
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            record = analyze_fn(game)
+            if record is not None:
+                yield record
+
+# Function to yield (PGN file path, record) for the games of all PGN files in a directory (searched recursively)
+def iter_analyzed_games(input_pgn_dir, analyze_fn, workers=1):
+    for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
+        for filename in sorted(filenames):
+            if is_pgn_file(filename):
+                pgn_file_path = os.path.join(dirpath, filename)
+                for record in iter_pgn_records(pgn_file_path, analyze_fn, workers):
+                    yield pgn_file_path, record
+
+# Function to get the per-game analysis function of an engine: 'stockfish', 'lc0' or 'both' (all metric families of
+# pgn_evaluation_unified_analyzer.py)
+def analyze_fn_for(engine, wdl_values, plus_min_plus_sec, weighted):
+    if engine == 'stockfish':
+        from pgn_evaluation_fast_analyzer import analyze_game
+        return partial(analyze_game, wdl_values=wdl_values, weighted=weighted)
+    if engine == 'lc0':
+        from pgn_evaluation_fast_analyzer_lc0 import analyze_game_lc0
+        return partial(analyze_game_lc0, wdl_values=wdl_values, plus_min_plus_sec=plus_min_plus_sec, weighted=weighted)
+    from pgn_evaluation_unified_analyzer import analyze_game_unified
+    return partial(analyze_game_unified, wdl_values=wdl_values, plus_min_plus_sec=plus_min_plus_sec, weighted=weighted)
+
+# Writes the JSON object of the analyzers one game at a time. The file is only created with the first game, as the
+# analyzers do not write files without games. The games are written to a temporary file that replaces the file at path
+# on close, so a run that is interrupted leaves the previous file (or none) instead of an incomplete JSON object.
+class JSONObjectWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = None
+
+    def write(self, key, game_data):
+        # The entry as json.dump(..., indent=4) formats it inside the object
+        entry = json.dumps({key: game_data}, indent=4)[2:-2]
+        if self.file is None:
+            self.file = open(self.tmp_path, 'w')
+            self.file.write('{\n')
+        else:
+            self.file.write(',\n')
+        self.file.write(entry)
+
+    def close(self):
+        if self.file is not None:
+            self.file.write('\n}')
+            self.file.close()
+            self.file = None
+            os.replace(self.tmp_path, self.path)
+
+    # Function to stop writing without replacing the file at path
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+# Writes one JSON line per game and flushes every flush_every games, so a reader sees the records of a run in progress
+# and a run that dies leaves its records up to the last flush
+class NDJSONSink:
+    def __init__(self, path, flush_every=1):
+        self.file = open(path, 'w')
+        self.flush_every = flush_every
+        self.pending = 0
+
+    def write(self, game_data):
+        self.file.write(json.dumps(game_data) + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.file.flush()
+            self.pending = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Function to flatten a record into a row of the aggregated game data CSV, as json_normalize and extract_full_name in
+# json_to_csv_converter.py
+def flatten_record(game_data, prefix=''):
+    row = {}
+    for key, value in game_data.items():
+        if isinstance(value, dict):
+            row.update(flatten_record(value, f'{prefix}{key}.'))
+        else:
+            row[f'{prefix}{key}'] = value
+    return row
+
+# Writes the rows of the aggregated game data CSV in chunks of chunk_size games. The columns are those of all rows in
+# order of appearance, as in the CSV of json_to_csv_converter.py, and missing values are written as empty. The games of
+# 'both' do not all have the same columns (e.g. no sf_ columns without [%eval]), so when a chunk has new columns, the
+# rows written so far are rewritten with the new header.
+class TableSink:
+    def __init__(self, path, chunk_size=1000):
+        # Imported here so streaming to JSON does not load pandas with json_to_csv_converter
+        from json_to_csv_converter import extract_full_name
+        self.extract_full_name = extract_full_name
+        self.path = path
+        self.file = open(path, 'w', newline='')
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.fieldnames = []
+
+    def write(self, game_data):
+        row = flatten_record(game_data)
+        row['White'], row['Black'] = self.extract_full_name(row.get('White', '')), self.extract_full_name(row.get('Black', ''))
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        known, new_columns = set(self.fieldnames), []
+        for row in self.rows:
+            for key in row:
+                if key not in known:
+                    known.add(key)
+                    new_columns.append(key)
+        if new_columns:
+            self.add_columns(new_columns)
+        csv.DictWriter(self.file, fieldnames=self.fieldnames, restval='').writerows(self.rows)
+        self.file.flush()
+        self.rows = []
+
+    # Function to add columns to the header, the rows written so far get empty values in the new columns
+    def add_columns(self, new_columns):
+        written = self.fieldnames
+        self.fieldnames = written + new_columns
+        self.file.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', newline='') as tmp:
+            writer = csv.DictWriter(tmp, fieldnames=self.fieldnames, restval='')
+            writer.writeheader()
+            if written:
+                with open(self.path, newline='') as f:
+                    writer.writerows(csv.DictReader(f))
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a', newline='')
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Function to read the records of an NDJSON file, a last line that is still being written is skipped
+def read_ndjson(path):
+    with open(path) as f:
+        for line in f:
+            if line.endswith('\n'):
+                yield json.loads(line)
+
+# Analyze the PGN files in input_pgn_dir with the engine's analyzer ('stockfish', 'lc0' or 'both') and stream the
+# records to an NDJSON file and/or an aggregated game data CSV written in chunks. Returns the number of games.
+def main_analyze_stream(input_pgn_dir, engine, wdl_values, plus_min_plus_sec, weighted, ndjson_path=None, table_path=None, workers=1, chunk_size=1000):
+    analyze_fn = analyze_fn_for(engine, wdl_values, plus_min_plus_sec, weighted)
+    sinks = []
+    for path, sink in ((ndjson_path, NDJSONSink), (table_path, partial(TableSink, chunk_size=chunk_size))):
+        if path is not None:
+            output_dir = os.path.dirname(path)
+            if output_dir and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            sinks.append(sink(path))
+    n_games = 0
+    try:
+        for pgn_file_path, game_data in iter_analyzed_games(input_pgn_dir, analyze_fn, workers):
+            for sink in sinks:
+                sink.write(game_data)
+            n_games += 1
+    finally:
+        for sink in sinks:
+            sink.close()
+    print(f"Streamed {n_games} games")
+    return n_games
+
+if __name__ == "__main__":
+    # Example usage:
+    input_pgn_dir = '/path/to/WCC_matches/Stockfish'
+    main_analyze_stream(input_pgn_dir, 'stockfish', [1, 0.5, 0], [90, 30, 30], True, 'Stats/games.ndjson', 'Stats/aggregated_game_data_all.csv')
+    for game_data in read_ndjson('Stats/games.ndjson'):
+        print(game_data['White'], game_data['Black'], game_data['white_gi'], game_data['black_gi'])
@@ -0,0 +1,205 @@
+"""
+This script collects performance metrics of a pipeline run: wall and CPU time per stage, games/sec, plies/sec,
+engine nodes/sec and depth reached, cache hit rates and peak memory. It is switched off by default; call enable()
+or set the environment variable WCC_METRICS=1. When it is off, every hook returns after a single flag check.
+The results are written as a JSON run report and optionally as a Prometheus text file.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+enabled = os.environ.get('WCC_METRICS', '0') not in ('', '0', 'false', 'False')
+
+# Per-stage metrics, e.g. stages['analyze'] = {'calls': 1, 'wall_seconds': 2.1, 'cpu_seconds': 2.0, 'counters': {...}}
+stages = {}
+# Names of the currently running stages, counters are added to the innermost one
+stage_stack = []
+run_start = time.time()
+# The counters are updated from several threads (e.g. the two engines of dual_engine_annotator.py), the lock is
+# reentrant because record_search and merge call count
+lock = threading.RLock()
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+def disable():
+    enable(False)
+
+# Function to clear all collected metrics
+def reset():
+    global run_start
+    stages.clear()
+    stage_stack.clear()
+    run_start = time.time()
+
+def get_stage(name):
+    if name not in stages:
+        stages[name] = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'counters': {}}
+    return stages[name]
+
+# Function to get the counters of the innermost running stage
+def current_counters():
+    return get_stage(stage_stack[-1] if stage_stack else 'other')['counters']
+
+# Context manager to time a stage of the pipeline
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    stage_stack.append(name)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        stage_stack.pop()
+        with lock:
+            metrics = get_stage(name)
+            metrics['calls'] += 1
+            metrics['wall_seconds'] += time.perf_counter() - wall_start
+            metrics['cpu_seconds'] += time.process_time() - cpu_start
+
+# Decorator to time a whole entry point (e.g. main_analyze) as a stage
+def timed_stage(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Function to add a value to a counter of the current stage (e.g. 'games', 'plies')
+def count(name, value=1):
+    if not enabled:
+        return
+    with lock:
+        counters = current_counters()
+        counters[name] = counters.get(name, 0) + value
+
+# Function to record the statistics of an engine search (the info dict returned by engine.analyse)
+def record_search(info):
+    if not enabled:
+        return
+    with lock:
+        count('engine_searches')
+        count('engine_nodes', info.get('nodes', 0))
+        count('engine_time', info.get('time', 0.0))
+        depth = info.get('depth')
+        if depth is not None:
+            count('engine_depth_sum', depth)
+            counters = current_counters()
+            counters['engine_depth_max'] = max(counters.get('engine_depth_max', 0), depth)
+
+# Function to record a cache lookup, the hit rate is reported per cache name
+def cache_lookup(name, hit):
+    if not enabled:
+        return
+    count(f'cache_{name}_hits' if hit else f'cache_{name}_misses')
+
+# Function to get the counters of the current stage, used to send the counts of worker processes to the parent
+def snapshot():
+    if not enabled:
+        return {}
+    with lock:
+        return dict(current_counters())
+
+# Function to add the counters collected in a worker process to the current stage
+def merge(counters):
+    if not enabled:
+        return
+    with lock:
+        for name, value in counters.items():
+            if name == 'engine_depth_max':
+                current = current_counters()
+                current[name] = max(current.get(name, 0), value)
+            else:
+                count(name, value)
+
+# Function to get the peak resident set size in MB of this process and of its finished child processes
+def peak_rss_mb():
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return round(own, 1), round(children, 1)
+
+# Function to build the run report with derived rates
+def build_report():
+    report_stages = {}
+    for name, metrics in stages.items():
+        counters = metrics['counters']
+        wall = metrics['wall_seconds']
+        entry = {
+            'calls': metrics['calls'],
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(metrics['cpu_seconds'], 4),
+            **{key: round(value, 4) if isinstance(value, float) else value for key, value in counters.items()},
+        }
+        if wall > 0:
+            for counter, rate in [('games', 'games_per_sec'), ('plies', 'plies_per_sec')]:
+                if counter in counters:
+                    entry[rate] = round(counters[counter] / wall, 2)
+        if counters.get('engine_time'):
+            entry['engine_nodes_per_sec'] = round(counters.get('engine_nodes', 0) / counters['engine_time'], 1)
+        if counters.get('engine_searches'):
+            entry['engine_depth_avg'] = round(counters.get('engine_depth_sum', 0) / counters['engine_searches'], 2)
+        for counter in counters:
+            if counter.startswith('cache_') and counter.endswith('_hits'):
+                cache = counter[len('cache_'):-len('_hits')]
+                hits, misses = counters[counter], counters.get(f'cache_{cache}_misses', 0)
+                entry[f'cache_{cache}_hit_rate'] = round(hits / (hits + misses), 4) if hits + misses else None
+        report_stages[name] = entry
+    peak_rss, peak_rss_children = peak_rss_mb()
+    times = os.times()
+    return {
+        'run_seconds': round(time.time() - run_start, 2),
+        'cpu_seconds': round(times.user + times.system, 2),
+        'children_cpu_seconds': round(times.children_user + times.children_system, 2),
+        'peak_rss_mb': peak_rss,
+        'peak_rss_children_mb': peak_rss_children,
+        'stages': report_stages,
+    }
+
+# Function to write the report in the Prometheus text exposition format
+def write_prometheus(report, prometheus_path):
+    lines = []
+    for key in ['run_seconds', 'cpu_seconds', 'children_cpu_seconds', 'peak_rss_mb', 'peak_rss_children_mb']:
+        if report[key] is not None:
+            lines.append(f'# TYPE wcc_{key} gauge')
+            lines.append(f'wcc_{key} {report[key]}')
+    metric_names = sorted({key for entry in report['stages'].values() for key in entry})
+    for key in metric_names:
+        lines.append(f'# TYPE wcc_stage_{key} gauge')
+        for name, entry in report['stages'].items():
+            if entry.get(key) is not None:
+                lines.append(f'wcc_stage_{key}{{stage="{name}"}} {entry[key]}')
+    with open(prometheus_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+# Function to write the JSON run report and, if a path is given, the Prometheus text file
+def write_report(json_path, prometheus_path=None):
+    report = build_report()
+    directory = os.path.dirname(json_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    if prometheus_path:
+        write_prometheus(report, prometheus_path)
+    return report
@@ -3,6 +3,7 @@ containing the following columns:
 - White, Black, WhiteElo, BlackElo, WhiteResult, BlackResult, gi, gpl, acpl, white_move_number, black_move_number
 """
 
+import instrumentation
 import json
 import os
 import pandas as pd
@@ -60,6 +61,7 @@ def process_json_file(json_file_path, data_list):
     except Exception as e:
         print(f'Error processing {json_file_path}: {e}')
 
+@instrumentation.timed_stage('json_to_csv')
 def main_json_to_csv(directory_path, csv_output_dir, folder):
     data_list = []
 
@@ -75,6 +77,7 @@ def main_json_to_csv(directory_path, csv_output_dir, folder):
         return
 
     data_frame = pd.concat(data_list, ignore_index=True)
+    instrumentation.count('games', len(data_frame))
 
     # Ensure the output directory exists
     if not os.path.exists(csv_output_dir):
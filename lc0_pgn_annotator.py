@@ -1,93 +1,152 @@
 import chess
 import chess.engine
 import chess.pgn
+import instrumentation
 import os
-from pathlib import Path
+from pgn_io import open_pgn, is_pgn_file, write_annotated_game
+from engine_search import search_position, LC0_CONVERGENCE_DEFAULTS
+from engine_supervisor import open_supervised_engine
+from syzygy_tablebase import open_syzygy, tablebase_eval, tablebase_wdl_probabilities
+from position_shortcuts import open_shortcuts, add_shortcut_comments
 import time
 
-def analyze_game_with_lc0(engine, file_path, output_directory, input_dir_path, analysis_time, nodes_limit):
-    with open(file_path) as pgn_file:
+# Function to evaluate a position with Lc0, returns the evaluation in pawns and the WDL probabilities from White's point of view,
+# or None if the engine failed, so the position gets no comment instead of a made-up score.
+# If tablebase is given (see syzygy_tablebase.py), positions in the tables get their exact result without a search.
+def evaluate_position_lc0(engine, board, game, analysis_time, nodes_limit, convergence=None, game_session=False, tablebase=None):
+    # Check if the game is over before analyzing
+    if board.is_game_over():
+        print("Game over detected. Skipping analysis for this position.")
+        result = game.headers.get("Result", "*")
+        if result == "1-0":
+            evaluation = 100  # White won
+        elif result == "0-1":
+            evaluation = -100  # Black won
+        else:
+            evaluation = 0  # Draw
+        return evaluation, ([1.0, 0.0, 0.0] if result == "1-0" else
+                            [0.0, 0.0, 1.0] if result == "0-1" else
+                            [0.0, 1.0, 0.0])
+
+    if tablebase is not None:
+        wdl = tablebase.probe(board)
+        if wdl is not None:
+            return tablebase_eval(wdl), tablebase_wdl_probabilities(wdl)
+
+    start = time.perf_counter()
+    try:
+        result = search_position(engine, board, chess.engine.Limit(nodes=nodes_limit, time=analysis_time), convergence, game=game if game_session else None)
+        instrumentation.record_search(result)
+        if tablebase is not None:
+            tablebase.record_search(time.perf_counter() - start)
+    except Exception as e:
+        print(f"Engine analysis failed for position:\n{board}\nError: {e}")
+        return None
+
+    # Extract score and WDL probabilities
+    evaluation = None
+    score = result["score"].relative
+    if isinstance(score, chess.engine.Cp):
+        evaluation = score.score() / 100.0
+        if not board.turn:
+            evaluation *= -1
+    elif isinstance(score, chess.engine.Mate):
+        if score.mate() > 0:
+            # Side to move can deliver mate
+            evaluation = 100 if board.turn == chess.WHITE else -100
+        else:
+            # Opponent can deliver mate
+            evaluation = -100 if board.turn == chess.WHITE else 100
+    wdl = result.get("wdl")
+    if wdl:
+        wins, draws, losses = wdl
+        total = wins + draws + losses
+        win_prob = wins / total if total else 0
+        draw_prob = draws / total if total else 0
+        loss_prob = losses / total if total else 0
+        wdl_probabilities = [win_prob, draw_prob, loss_prob]
+
+        # Reverse WDL probabilities if it's Black's turn
+        if not board.turn:
+            wdl_probabilities = wdl_probabilities[::-1]
+    else:
+        wdl_probabilities = [0.0, 0.0, 0.0]
+    return evaluation, wdl_probabilities
+
+# Function to evaluate the mainline of a game up to the first position where the game is over.
+# If game_session is True, the game is one engine session (ucinewgame only before the first search), and if backward
+# is True, the positions are searched from the last move to the first. If shortcuts is given (see position_shortcuts.py),
+# finished and repeated positions are not searched and positions with a single legal reply are searched with fewer
+# nodes; the treatment of each ply is kept in shortcuts.treatments.
+# Returns the evaluations and the WDL probabilities of each ply, both None for a ply that the engine could not search.
+def evaluate_mainline_lc0(engine, game, analysis_time, nodes_limit, convergence=None, game_session=False, backward=False, tablebase=None, shortcuts=None):
+    boards = []
+    for node in game.mainline():
+        boards.append(node.board())
+        if boards[-1].is_game_over():
+            break  # Stop analysis as the game is over
+    evaluations = [None] * len(boards)
+    if shortcuts is not None:
+        shortcuts.new_game(len(boards))
+    order = range(len(boards) - 1, -1, -1) if backward else range(len(boards))
+    for i in order:
+        if shortcuts is None:
+            evaluations[i] = evaluate_position_lc0(engine, boards[i], game, analysis_time, nodes_limit, convergence, game_session, tablebase)
+            continue
+        treatment, result = shortcuts.classify(i, boards[i])
+        if result is not None:
+            evaluations[i] = result
+            continue
+        time_limit, nodes = analysis_time, nodes_limit
+        if treatment == 'forced':
+            time_limit, nodes = shortcuts.reduced(analysis_time, 0.01), shortcuts.reduced(nodes_limit)
+        hits = tablebase.hits if tablebase is not None else 0
+        evaluations[i] = evaluate_position_lc0(engine, boards[i], game, time_limit, nodes, convergence, game_session, tablebase)
+        if tablebase is not None and tablebase.hits > hits:
+            shortcuts.treatments[i] = 'tablebase'
+        elif evaluations[i] is not None:
+            shortcuts.store(boards[i], evaluations[i])
+    # A failed search, or one without a score, leaves the ply without a result
+    evaluations = [evaluation if evaluation is not None and evaluation[0] is not None else (None, None) for evaluation in evaluations]
+    scores = [evaluation for evaluation, wdl in evaluations]
+    wdl_scores = [wdl for evaluation, wdl in evaluations]
+    return scores, wdl_scores
+
+def analyze_game_with_lc0(engine, file_path, output_directory, input_dir_path, analysis_time, nodes_limit, convergence=None, continuous=False, backward=False, tablebase=None, shortcuts=None):
+    with open_pgn(file_path) as pgn_file:
         while True:
             game = chess.pgn.read_game(pgn_file)
             if game is None:
                 break
 
-            scores = []
-            wdl_scores = []
-            node = game
-            while node and node.variations:
-                next_node = node.variations[0]
-                board = next_node.board()
-
-                # Check if the game is over before analyzing
-                if board.is_game_over():
-                    print("Game over detected. Skipping analysis for this position.")
-                    result = game.headers.get("Result", "*")
-                    if result == "1-0":
-                        evaluation = 100  # White won
-                    elif result == "0-1":
-                        evaluation = -100  # Black won
-                    else:
-                        evaluation = 0  # Draw
-                    scores.append(evaluation)
-                    wdl_scores.append([1.0, 0.0, 0.0] if result == "1-0" else 
-                                      [0.0, 0.0, 1.0] if result == "0-1" else 
-                                      [0.0, 1.0, 0.0])
-                    break  # Stop analysis as the game is over
-
-                try:
-                    result = engine.analyse(board, chess.engine.Limit(nodes=nodes_limit, time=analysis_time))
-                except Exception as e:
-                    print(f"Engine analysis failed for position:\n{board}\nError: {e}")
-                    scores.append(0.0)
-                    wdl_scores.append([0.0, 0.0, 0.0])
-                    node = next_node
-                    continue
-
-                # Extract score and WDL probabilities
-                score = result["score"].relative
-                if isinstance(score, chess.engine.Cp):
-                    evaluation = score.score() / 100.0
-                    if not board.turn:
-                        evaluation *= -1
-                    scores.append(evaluation)
-                elif isinstance(score, chess.engine.Mate):
-                    if score.mate() > 0:
-                        # Side to move can deliver mate
-                        evaluation = 100 if board.turn == chess.WHITE else -100
-                    else:
-                        # Opponent can deliver mate
-                        evaluation = -100 if board.turn == chess.WHITE else 100
-                    scores.append(evaluation)
-                wdl = result.get("wdl")
-                if wdl:
-                    wins, draws, losses = wdl
-                    total = wins + draws + losses
-                    win_prob = wins / total if total else 0
-                    draw_prob = draws / total if total else 0
-                    loss_prob = losses / total if total else 0
-                    wdl_probabilities = [win_prob, draw_prob, loss_prob]
-
-                    # Reverse WDL probabilities if it's Black's turn
-                    if not board.turn:
-                        wdl_probabilities = wdl_probabilities[::-1]
-
-                    wdl_scores.append(wdl_probabilities)
-                else:
-                    wdl_scores.append([0.0, 0.0, 0.0])
-
-                node = next_node
-
+            annotate_game_lc0(engine, game, analysis_time, nodes_limit, convergence, continuous, backward, tablebase, shortcuts)
             if game:
-                annotate_game_with_scores_lc0(game, scores, wdl_scores, file_path, output_directory, input_dir_path)
-
-
-def annotate_game_with_scores_lc0(game, scores, wdl_scores, file_path, output_directory, input_dir_path):
+                write_annotated_game(game, file_path, output_directory, input_dir_path)
+
+# Function to evaluate a game and add the comments to it, without writing it. Used for each game of
+# analyze_game_with_lc0 and by the workers of distributed_annotation.py.
+def annotate_game_lc0(engine, game, analysis_time, nodes_limit, convergence=None, continuous=False, backward=False, tablebase=None, shortcuts=None):
+    scores, wdl_scores = evaluate_mainline_lc0(engine, game, analysis_time, nodes_limit, convergence, continuous, backward, tablebase, shortcuts)
+    instrumentation.count('games')
+    instrumentation.count('plies', sum(score is not None for score in scores))
+    add_lc0_comments(game, scores, wdl_scores)
+    if shortcuts is not None:
+        add_shortcut_comments(game, shortcuts.treatments)
+
+def annotate_game_with_scores_lc0(game, scores, wdl_scores, file_path, output_directory, input_dir_path, shortcuts=None):
+    add_lc0_comments(game, scores, wdl_scores)
+    if shortcuts is not None:
+        add_shortcut_comments(game, shortcuts.treatments)
+    write_annotated_game(game, file_path, output_directory, input_dir_path)
+
+# Function to add the [%eval_lc0] and [%wdl] comments to the mainline, after any existing comment. Plies without a
+# score (None) get no comment.
+def add_lc0_comments(game, scores, wdl_scores):
     node = game
     score_index = 0
     while node and node.variations:
         next_node = node.variations[0]
-        if score_index < len(scores):
+        if score_index < len(scores) and scores[score_index] is not None:
             eval_comment = f"[%eval_lc0 {scores[score_index]}]"
             wdl_comment = f"[%wdl [{wdl_scores[score_index][0]:.2f}, {wdl_scores[score_index][1]:.2f}, {wdl_scores[score_index][2]:.2f}]]"
             existing_comment = next_node.comment
@@ -95,25 +154,33 @@ def annotate_game_with_scores_lc0(game, scores, wdl_scores, file_path, output_di
         node = next_node
         score_index += 1
 
-    relative_path = Path(file_path).relative_to(input_dir_path)
-    dest_folder = Path(output_directory) / relative_path.parent
-    dest_folder.mkdir(parents=True, exist_ok=True)
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    output_file_path = dest_folder / f"{base_name}_annotated.pgn"
-
-    with open(output_file_path, 'a') as annotated_pgn:
-        exporter = chess.pgn.FileExporter(annotated_pgn)
-        game.accept(exporter)
-
 
-def main_lc0(input_dir_path, output_directory, lc0_path, weights_path, analysis_time, nodes_limit):
-    with chess.engine.SimpleEngine.popen_uci([lc0_path, f"--weights={weights_path}"]) as engine:
-        engine.configure({"UCI_ShowWDL": True})
+# Set convergence, e.g. {'wdl_tolerance': 0.01, 'stable': 4}, to stop a search early once the WDL is stable
+# (see engine_search.py). nodes_limit and analysis_time remain the maximum.
+# Set continuous to True to analyze each game as one engine session, and backward to True to search each game from
+# the last move to the first.
+# Set supervisor, e.g. {'position_timeout': 60, 'max_retries': 2, 'failure_log': 'engine_failures.jsonl'}, to restart
+# Lc0 when a search hangs or fails (see engine_supervisor.py). A position that still fails after the retries gets no
+# comment.
+# Set syzygy_path to a directory of Syzygy tables to take the results of endgame positions from the tables, and
+# shortcuts, e.g. {} for the defaults of position_shortcuts.py, to skip or shorten the searches of cheap positions.
+@instrumentation.timed_stage('annotate_lc0')
+def main_lc0(input_dir_path, output_directory, lc0_path, weights_path, analysis_time, nodes_limit, convergence=None, continuous=False, backward=False, supervisor=None, syzygy_path=None, shortcuts=None):
+    if convergence is not None:
+        convergence = {**LC0_CONVERGENCE_DEFAULTS, **convergence}
+    tablebase = open_syzygy(syzygy_path)
+    shortcuts = open_shortcuts(shortcuts)
+    with open_supervised_engine([lc0_path, f"--weights={weights_path}"], {"UCI_ShowWDL": True}, supervisor, name='lc0') as engine:
         for subdir, dirs, files in os.walk(input_dir_path):
             for file in files:
-                if file.endswith(".pgn"):
+                if is_pgn_file(file):
                     file_path = os.path.join(subdir, file)
-                    analyze_game_with_lc0(engine, file_path, output_directory, input_dir_path, analysis_time, nodes_limit)
+                    analyze_game_with_lc0(engine, file_path, output_directory, input_dir_path, analysis_time, nodes_limit, convergence, continuous, backward, tablebase, shortcuts)
+    if tablebase is not None:
+        tablebase.report('lc0')
+        tablebase.close()
+    if shortcuts is not None:
+        shortcuts.report('lc0')
 
 if __name__ == "__main__":
     start_time = time.time()
@@ -0,0 +1,197 @@
+"""
+This script follows a live match. It watches a growing broadcast PGN file, or a directory into which PGN files are
+dropped, and checks it every few seconds. When a file changed, its games are read again and compared with the moves
+already seen: only the new plies are searched, by one Stockfish engine that stays open for the whole match (and keeps
+its hash for each game), and a corrected move makes the plies from that move on be searched again. The stats of the
+changed games are calculated as by pgn_evaluation_fast_analyzer.py, and the match outputs are written again:
+- {folder}.json with the stats of each game, in the format of the analyzers
+- {folder}_annotated.pgn with the evaluations of all games
+- aggregated_game_data_{folder}.csv, player_stats_{folder}.csv and summary_stats_{folder}.csv
+Games in progress count with their current expected score as their result for the GI, their Points are empty until
+they finish. The moves and evaluations are saved to live_state_{folder}.json, so a restarted watch does not search the
+plies again.
+"""
+
+import chess
+import chess.pgn
+import json
+import os
+import time
+import pandas as pd
+from pgn_io import open_pgn, is_pgn_file
+from engine_supervisor import open_supervised_engine
+from stockfish_pgn_annotator import search_evaluation, add_stockfish_comments
+from pgn_evaluation_fast_analyzer import analyze_game
+from json_to_csv_converter import extract_full_name
+from csv_to_player_stats import read_csv, player_stats_from_csv, PLAYER_STATS_COLUMNS
+from summary_stats import generate_summary_stats
+
+# depth: search depth of the new plies
+# poll_interval: seconds between checks of the watched files
+WATCH_DEFAULTS = {
+    'depth': 20,
+    'poll_interval': 1.0,
+}
+
+# Headers that identify a game of the broadcast, the other headers (e.g. Result) may change during the game
+GAME_KEY_HEADERS = ['Event', 'Site', 'Date', 'Round', 'White', 'Black']
+
+# Function to get the key of a game of the broadcast
+def game_key(game):
+    return '|'.join(game.headers.get(header, '') for header in GAME_KEY_HEADERS)
+
+# Function to write a file through a temporary file, so readers never see a partial file. write is called with the
+# path of the temporary file.
+def replace_file(path, write):
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+# The games of a live match with their moves, evaluations and stats
+class LiveMatch:
+    def __init__(self, engine, output_dir, folder, wdl_values, weighted, settings):
+        self.engine = engine
+        self.output_dir = output_dir
+        self.folder = folder
+        self.wdl_values = wdl_values
+        self.weighted = weighted
+        self.settings = settings
+        self.state_path = os.path.join(output_dir, f'live_state_{folder}.json')
+        # key -> {'moves', 'evaluations', 'headers'}, in the order the games were first seen
+        self.games = {}
+        # key -> (game data, annotated PGN) of the games analyzed since the start
+        self.results = {}
+        self.signatures = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.games = json.load(f)
+
+    # Function to find the PGN files that changed since the last check
+    def changed_files(self, watch_path):
+        if os.path.isfile(watch_path):
+            paths = [watch_path]
+        else:
+            paths = [os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(watch_path)
+                     for filename in sorted(filenames) if is_pgn_file(filename)]
+        changed = []
+        output_dir = os.path.abspath(self.output_dir)
+        for path in paths:
+            # Skip the annotated PGN if the outputs are written into the watched directory
+            if os.path.abspath(path).startswith(output_dir + os.sep):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if self.signatures.get(path) != signature:
+                self.signatures[path] = signature
+                changed.append(path)
+        return changed
+
+    # Function to update the games of a PGN file, returns the number of changed games and of searched plies
+    def update_file(self, path):
+        changed, searched = 0, 0
+        with open_pgn(path) as pgn:
+            while True:
+                game = chess.pgn.read_game(pgn)
+                if game is None:
+                    break
+                game_searches = self.update_game(game)
+                if game_searches is not None:
+                    changed += 1
+                    searched += game_searches
+        return changed, searched
+
+    # Function to search the new plies of a game and calculate its stats. Returns the number of searched plies, or
+    # None if the game did not change.
+    def update_game(self, game):
+        key = game_key(game)
+        moves = [move.uci() for move in game.mainline_moves()]
+        headers = dict(game.headers)
+        known = self.games.get(key, {'moves': [], 'evaluations': [], 'headers': {}})
+        if known['moves'] == moves and known['headers'] == headers and key in self.results:
+            return None
+        # The plies after the last known move, or after a corrected move
+        start = 0
+        while start < min(len(moves), len(known['moves'])) and moves[start] == known['moves'][start]:
+            start += 1
+        evaluations = known['evaluations'][:start]
+        board = game.board()
+        for i, move in enumerate(game.mainline_moves()):
+            board.push(move)
+            if i >= start:
+                evaluations.append(search_evaluation(self.engine, board, self.settings['depth'], game=key))
+        self.games[key] = {'moves': moves, 'evaluations': evaluations, 'headers': headers}
+        add_stockfish_comments(game, evaluations)
+        self.results[key] = (analyze_game(game, self.wdl_values, self.weighted), str(game))
+        return len(moves) - start
+
+    # Function to write the outputs of the match from the games analyzed so far
+    def write_outputs(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        results = [self.results[key] for key in self.games if key in self.results]
+        all_data = {key_counter: game_data for key_counter, game_data in enumerate((game_data for game_data, pgn in results if game_data is not None), start=1)}
+        replace_file(self.state_path, lambda path: write_text(path, json.dumps(self.games)))
+        replace_file(os.path.join(self.output_dir, f'{self.folder}.json'), lambda path: write_text(path, json.dumps(all_data, indent=4)))
+        replace_file(os.path.join(self.output_dir, f'{self.folder}_annotated.pgn'), lambda path: write_text(path, ''.join(pgn + '\n\n' for game_data, pgn in results)))
+        if not all_data:
+            return
+        rows = []
+        for game_data in all_data.values():
+            row = {**game_data, 'White': extract_full_name(game_data['White']), 'Black': extract_full_name(game_data['Black'])}
+            if row['WhiteResult'] == '...':
+                # Games in progress have no points yet
+                row['WhiteResult'], row['BlackResult'] = None, None
+            rows.append(row)
+        csv_all_games_path = os.path.join(self.output_dir, f'aggregated_game_data_{self.folder}.csv')
+        replace_file(csv_all_games_path, lambda path: pd.json_normalize(rows).to_csv(path, index=False))
+        player_stats = player_stats_from_csv(read_csv(csv_all_games_path)).round(2)[PLAYER_STATS_COLUMNS]
+        player_stats = player_stats.sort_values(by='avg_gi', ascending=False)
+        replace_file(os.path.join(self.output_dir, f'player_stats_{self.folder}.csv'), lambda path: player_stats.to_csv(path, index=False))
+        replace_file(os.path.join(self.output_dir, f'summary_stats_{self.folder}.csv'), lambda path: generate_summary_stats(player_stats, path))
+
+    # Function to check the watched files once, returns the number of changed games
+    def poll(self, watch_path):
+        start_time = time.time()
+        changed, searched = 0, 0
+        for path in self.changed_files(watch_path):
+            try:
+                file_changed, file_searched = self.update_file(path)
+            except (OSError, ValueError) as e:
+                print(f"Error processing {path}: {e}")
+                continue
+            changed += file_changed
+            searched += file_searched
+        if changed:
+            self.write_outputs()
+            print(f"{time.strftime('%H:%M:%S')} updated {changed} games, {searched} new plies searched, stats written in {time.time() - start_time:.1f} seconds")
+        return changed
+
+# Watch watch_path (a PGN file or a directory searched recursively) and keep the stats of its games in output_dir up
+# to date. Runs until interrupted, or checks once if once is True. settings: see WATCH_DEFAULTS. supervisor: see
+# engine_supervisor.py.
+def main_live_watch(watch_path, output_dir, folder, stockfish_path, wdl_values, weighted, settings=None, supervisor=None, once=False):
+    settings = {**WATCH_DEFAULTS, **(settings or {})}
+    with open_supervised_engine(stockfish_path, supervisor=supervisor, name='stockfish') as engine:
+        match = LiveMatch(engine, output_dir, folder, wdl_values, weighted, settings)
+        print(f"Watching {watch_path}, {len(match.games)} games in {match.state_path}")
+        try:
+            while True:
+                match.poll(watch_path)
+                if once:
+                    break
+                time.sleep(settings['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+    return match
+
+if __name__ == "__main__":
+    # Example usage:
+    watch_path = '/path/to/broadcast/round.pgn'
+    output_dir = '/path/to/broadcast/Stats'
+    main_live_watch(watch_path, output_dir, 'wcc_live', '/usr/bin/stockfish', [1, 0.5, 0], True, {'depth': 20})
@@ -1,103 +1,509 @@
-# Main function for the Fast GI calculator
-from pgn_evaluation_fast_analyzer import main_analyze
-from pgn_evaluation_fast_analyzer_lc0 import main_analyze_lc0
-from stockfish_pgn_annotator import main_stockfish
-from lc0_pgn_annotator import main_lc0
-from csv_to_player_stats import main_stats
-from summary_stats import main_summary_stats
-from json_to_csv_converter import main_json_to_csv
-from wcc_stats import process_chess_data
-import time
+"""
+Command line interface for the Fast GI calculator.
+
+    python main.py annotate --engine stockfish --input PGNs --output PGNs --engine-path /usr/bin/stockfish --depth 25
+    python main.py annotate --engine both --input PGNs --output PGNs --engine-path stockfish --lc0-path lc0 --weights w.pb.gz
+    python main.py distribute submit --queue dir:/shared/queue --input PGNs
+    python main.py distribute work --queue dir:/shared/queue --engine stockfish --engine-path /usr/bin/stockfish --depth 25
+    python main.py distribute collect --queue dir:/shared/queue --output PGNs
+    python main.py analyze --engine stockfish --input PGNs --output JSONs --workers 4
+    python main.py analyze --engine both --input PGNs --output JSONs
+    python main.py to-csv --input JSONs --output Stats --name 1886
+    python main.py stats --input Stats/aggregated_game_data_1886.csv --output Stats --name 1886
+    python main.py analyze --engine stockfish --input PGNs --output JSONs --store games.db
+    python main.py stats --input games.db --engine stockfish --output Stats --name all
+    python main.py stats --input Stats/aggregated_game_data_1886.csv --output Stats --name 1886 --bootstrap 10000 --workers 0
+    python main.py summary --input Stats/player_stats_1886.csv --output Stats --name 1886
+    python main.py plot --input Stats
+    python main.py serve --input JSONs --port 8765
+    python main.py timeseries --input JSONs --output Stats/player_series.json --last-games 10 --last-months 12
+    python main.py corpus build --input WCC_matches/Stockfish --corpus corpus
+    python main.py corpus analyze --corpus corpus --output Stats --name all --weighted
+    python main.py preview --input NewEvent --output Stats --name new_event --engine-path /usr/bin/stockfish --depth 10 --step 4
+    python main.py watch --input broadcast/round.pgn --output Stats --name wcc_live --engine-path /usr/bin/stockfish --depth 20
+    python main.py tune --engine stockfish --input PGNs --engine-path /usr/bin/stockfish --depth 20
+    python main.py stream --engine stockfish --input PGNs --ndjson Stats/games.ndjson --table Stats/aggregated_game_data_all.csv
+    python main.py upgrade --engine lc0 --input WCC_matches/Lc0 --engine-path /usr/bin/lc0 --weights w.pb.gz --nodes 20000 --report upgrade.csv
+    python main.py sweep --input WCC_matches/Stockfish --output Stats --name all --configurations sweep.json
+    python main.py pipeline --input WCC_matches/Stockfish
+
+Options can also be read from a JSON file with --config. Top-level keys apply to every subcommand and a section
+named after a subcommand (e.g. {"analyze": {"workers": 4}}) applies to that subcommand only. Flags on the command
+line override the config file. The modules of each subcommand (pandas, matplotlib, python-chess) are only imported
+when that subcommand runs, so e.g. 'analyze' does not pay for pandas and matplotlib at start-up.
+"""
+
+import argparse
+import json
 import os
+import sys
+import time
+
+import instrumentation
+
+# Function to check that required options were given on the command line or in the config file
+def require(parser, args, *names):
+    missing = ['--' + name.replace('_', '-') for name in names if getattr(args, name, None) is None]
+    if missing:
+        parser.error(f"the following arguments are required: {', '.join(missing)}")
+
+# Function to build the early stopping setting of the annotators from the --converge-* options
+def engine_convergence(args):
+    if args.converge_tolerance is None:
+        return None
+    convergence = {'stable': args.converge_stable}
+    if args.engine == 'stockfish':
+        convergence.update({'tolerance': args.converge_tolerance, 'min_depth': args.converge_min_depth})
+    else:
+        convergence['wdl_tolerance'] = args.converge_tolerance
+    return convergence
+
+# Function to build the watchdog setting of the annotators from the --supervise options
+def engine_supervisor(args):
+    if not args.supervise:
+        return None
+    return {'position_timeout': args.position_timeout, 'max_retries': args.max_retries, 'failure_log': args.failure_log}
+
+# Function to build the cheap-position setting of the annotators from the --shortcuts options
+def engine_shortcuts(args):
+    if not args.shortcuts:
+        return None
+    return {'forced_budget': args.forced_budget}
+
+def run_annotate(parser, args):
+    require(parser, args, 'input', 'output', 'engine_path')
+    if args.engine == 'stockfish':
+        from stockfish_pgn_annotator import main_stockfish
+        main_stockfish(args.input, args.output, args.engine_path, args.depth, engine_convergence(args), args.continuous, args.backward, engine_supervisor(args), args.syzygy_path, engine_shortcuts(args))
+    elif args.engine == 'both':
+        require(parser, args, 'lc0_path', 'weights')
+        from dual_engine_annotator import main_dual
+        main_dual(args.input, args.output, args.engine_path, args.depth, args.lc0_path, args.weights, args.time, args.nodes, args.backward, engine_supervisor(args), args.syzygy_path, engine_shortcuts(args))
+    else:
+        require(parser, args, 'weights')
+        from lc0_pgn_annotator import main_lc0
+        main_lc0(args.input, args.output, args.engine_path, args.weights, args.time, args.nodes, engine_convergence(args), args.continuous, args.backward, engine_supervisor(args), args.syzygy_path, engine_shortcuts(args))
+
+# Distributed annotation: 'submit' the games of --input as jobs, run a 'work'er on any node, 'collect' the annotated
+# files into --output once all jobs are done, or show the 'status' of the queue
+def run_distribute(parser, args):
+    require(parser, args, 'queue')
+    import distributed_annotation
+    if args.action == 'submit':
+        require(parser, args, 'input')
+        distributed_annotation.main_submit_jobs(args.input, args.queue, args.games_per_job)
+    elif args.action == 'work':
+        require(parser, args, 'engine_path')
+        if args.engine == 'both':
+            parser.error("distributed annotation supports --engine stockfish or lc0")
+        if args.engine == 'lc0':
+            require(parser, args, 'weights')
+        annotator = {'engine': args.engine, 'engine_path': args.engine_path, 'depth': args.depth, 'weights': args.weights, 'nodes': args.nodes,
+                     'time': args.time, 'convergence': engine_convergence(args), 'continuous': args.continuous, 'backward': args.backward,
+                     'supervisor': engine_supervisor(args), 'syzygy_path': args.syzygy_path, 'shortcuts': engine_shortcuts(args)}
+        distributed_annotation.main_annotation_workers(args.queue, annotator, args.engines, args.lease_seconds, args.poll_interval, args.max_attempts)
+    elif args.action == 'collect':
+        require(parser, args, 'output')
+        distributed_annotation.main_collect_results(args.queue, args.output)
+    else:
+        print(distributed_annotation.open_work_queue(args.queue).status())
+
+def run_analyze(parser, args):
+    require(parser, args, 'input')
+    output = args.output or args.input
+    if args.engine == 'stockfish':
+        from pgn_evaluation_fast_analyzer import main_analyze
+        main_analyze(args.input, output, args.wdl_values, args.weighted, args.workers, store=args.store)
+    elif args.engine == 'both':
+        # The game store keeps the rows of one analyzer, the unified rows have no place in it
+        if args.store:
+            parser.error("--store needs --engine stockfish or lc0")
+        from pgn_evaluation_unified_analyzer import main_analyze_unified
+        main_analyze_unified(args.input, output, args.wdl_values, args.plus_min_plus_sec, args.weighted, workers=args.workers)
+    else:
+        from pgn_evaluation_fast_analyzer_lc0 import main_analyze_lc0
+        main_analyze_lc0(args.input, output, args.wdl_values, args.plus_min_plus_sec, args.weighted, args.workers, store=args.store)
+
+def run_to_csv(parser, args):
+    require(parser, args, 'input', 'output', 'name')
+    from json_to_csv_converter import main_json_to_csv
+    main_json_to_csv(args.input, args.output, args.name)
+
+def run_stats(parser, args):
+    require(parser, args, 'input', 'output', 'name')
+    from csv_to_player_stats import main_stats
+    bootstrap = None
+    if args.bootstrap:
+        bootstrap = {'resamples': args.bootstrap, 'confidence': args.confidence, 'workers': args.workers}
+    main_stats(args.input, args.output, args.name, engine=args.engine, bootstrap=bootstrap)
+
+def run_summary(parser, args):
+    require(parser, args, 'input', 'output', 'name')
+    from summary_stats import main_summary_stats
+    main_summary_stats(args.input, args.output, args.name)
+
+def run_plot(parser, args):
+    require(parser, args, 'input')
+    from wcc_stats import process_chess_data
+    process_chess_data(args.input)
+
+def run_serve(parser, args):
+    require(parser, args, 'input')
+    from stats_service import main_stats_service
+    main_stats_service(args.input, args.host, args.port, args.prefix, args.reload_interval)
+
+def run_timeseries(parser, args):
+    require(parser, args, 'input', 'output')
+    from player_timeseries import main_player_timeseries
+    main_player_timeseries(args.input, args.output, {'last_games': args.last_games, 'last_months': args.last_months}, args.prefix)
+
+# Compact corpus: 'build' a memory-mappable corpus from the annotated PGN files of --input, or 'analyze' it into
+# aggregated_game_data_NAME.csv with the Stockfish stats
+def run_corpus(parser, args):
+    require(parser, args, 'corpus')
+    import compact_corpus
+    if args.action == 'build':
+        require(parser, args, 'input')
+        compact_corpus.main_build_corpus(args.input, args.corpus)
+    else:
+        require(parser, args, 'output', 'name')
+        compact_corpus.main_analyze_corpus(args.corpus, args.output, args.name, args.wdl_values, args.weighted)
+
+# Quick estimate of the player stats of unannotated games, with error bounds
+def run_preview(parser, args):
+    require(parser, args, 'input', 'output', 'name', 'engine_path')
+    from preview_mode import main_preview
+    settings = {'depth': args.depth, 'step': args.step, 'swing': args.swing, 'check_fraction': args.check_fraction,
+                'reference_depth': args.reference_depth, 'confidence': args.confidence}
+    main_preview(args.input, args.output, args.name, args.engine_path, args.wdl_values, args.weighted, settings, engine_supervisor(args))
+
+# Follow a live broadcast and keep its annotations and stats up to date
+def run_watch(parser, args):
+    require(parser, args, 'input', 'output', 'name', 'engine_path')
+    from live_watch import main_live_watch
+    settings = {'depth': args.depth, 'poll_interval': args.poll_interval}
+    main_live_watch(args.input, args.output, args.name, args.engine_path, args.wdl_values, args.weighted, settings, engine_supervisor(args), args.once)
+
+# Benchmark engine configurations on positions of --input and save the fastest for the annotators
+def run_tune(parser, args):
+    require(parser, args, 'input', 'engine_path')
+    import chess.engine
+    from engine_tuner import main_tune_engine
+    if args.engine == 'both':
+        parser.error("tune supports --engine stockfish or lc0")
+    settings = {'positions': args.positions, 'engines': args.engine_counts, 'threads': args.threads, 'hash': args.hash,
+                'backends': args.backends, 'minibatch': args.minibatch, 'cores': args.cores}
+    if args.engine == 'stockfish':
+        main_tune_engine(args.input, 'stockfish', args.engine_path, chess.engine.Limit(depth=args.depth), settings, args.config_output)
+    else:
+        require(parser, args, 'weights')
+        main_tune_engine(args.input, 'lc0', [args.engine_path, f"--weights={args.weights}"], chess.engine.Limit(nodes=args.nodes), settings, args.config_output)
+
+# Stream the per-game records of the analyzers to NDJSON and/or a chunked aggregated game data CSV
+def run_stream(parser, args):
+    require(parser, args, 'input')
+    if args.ndjson is None and args.table is None:
+        parser.error("stream needs --ndjson and/or --table")
+    from game_stream import main_analyze_stream
+    main_analyze_stream(args.input, args.engine, args.wdl_values, args.plus_min_plus_sec, args.weighted, args.ndjson, args.table, args.workers, args.chunk_size)
+
+# Search the plies near the thresholds or with large swings again at a higher budget and rewrite their annotations
+def run_upgrade(parser, args):
+    require(parser, args, 'input', 'engine_path')
+    from annotation_upgrade import main_upgrade_annotations
+    if args.engine == 'lc0' and not args.dry_run:
+        require(parser, args, 'weights')
+    settings = {'margin': args.margin, 'swing': args.swing, 'depth': args.depth, 'nodes': args.nodes}
+    main_upgrade_annotations(args.input, args.engine, args.engine_path, args.wdl_values, args.weighted, settings, args.weights,
+                             engine_supervisor(args), args.report, args.dry_run)
+
+# Stockfish stats of the games of --input under several scoring configurations, parsed once
+def run_sweep(parser, args):
+    require(parser, args, 'input', 'output', 'name')
+    from parameter_sweep import main_sweep, load_configurations
+    configurations = load_configurations(args.configurations) if args.configurations is not None else None
+    main_sweep(args.input, args.output, args.name, configurations)
 
-start_time = time.time()
-
-# WCC_matches folder contains a few games. You can download all games from Lichess or from another website and analyze them by setting games_annotated = False 
-# the main function will run the Fast GI calculator for each PGN file in the directory.
-input_main_pgn_dir = '/workspaces/World-Chess-Championships/WCC_matches'
-for folder in os.listdir(input_main_pgn_dir): 
-    # Set a variable folder_name store the folder name, note that "folder" is NOT the name.
-
-    # Set the input and output directories for the Fast GI calculator
-    input_pgn_dir = os.path.join(input_main_pgn_dir, folder)    
-
-    # Skip the file if it is not a directory
-    if not os.path.isdir(input_pgn_dir) or folder == 'Stats':
-        continue
-
-    # If the games are annotated with Stockfish evaluations, set this to True. Otherwise, set it to False.
-    games_annotated = True
-
-    # Set the engine Leela Chess Zero or Stockfish
-    engine = 'Stockfish'
-
-    if not games_annotated:
-        print(f"Annotating games with {engine}...")
-        # Set the dir paths for the PGN files and the output directory
-        input_dir_path = input_pgn_dir
-        output_directory = input_pgn_dir
-        # set the path to the Stockfish executable
-        # e.g.: 'C:\...\stockfish-windows-x86-64-avx2\stockfish\stockfish-windows-x86-64-avx2.exe'
-        # stockfish_path = '/home/linuxbrew/.linuxbrew/bin/stockfish'
-        if engine == 'Stockfish':
-            engine_path = '/home/linuxbrew/.linuxbrew/bin/stockfish'
-            DEPTH = 25
-            weights_path = None
-            main_stockfish(input_dir_path, output_directory, engine_path, DEPTH)
-        else: # Leela Chess Zero
-            engine_path = '/opt/homebrew/Cellar/lc0/0.31.2/libexec/lc0'
-            weights_path = '/opt/homebrew/Cellar/lc0/0.31.2/libexec/42850.pb.gz'
-            DEPTH = 10
-            main_lc0(input_dir_path, output_directory, lc0_path, weights_path, analysis_time=0.1)
-        # Call the main function to annotate the games
-        print(f"{engine} analysis finished")
-
-    # Change the output directory if needed
-    output_json_dir = input_pgn_dir
+# Run the whole pipeline for each folder (e.g. one folder per year) in the input directory
+def run_pipeline(parser, args):
+    require(parser, args, 'input')
+    if args.annotate:
+        require(parser, args, 'engine_path')
+    from pgn_evaluation_fast_analyzer import main_analyze
+    from pgn_evaluation_fast_analyzer_lc0 import main_analyze_lc0
+    from json_to_csv_converter import main_json_to_csv
+    from csv_to_player_stats import main_stats
+    from summary_stats import main_summary_stats
+
+    input_main_pgn_dir = args.input
     # Define Stats directory inside the input PGN directory
-    output_stats_dir = os.path.join(input_main_pgn_dir, 'Stats')
-
-    # Set whether the game intelligence (GI0 score should be weighted by opponent's Elo. For WCC, it's set False.
-    weighted = False
-    # Input win, draw, and loss values. Standard FIDE: [1, 0.5, 0]. Norway Chess: [3, 1.25, 0] (will be normalized by 1/3; Armageddon score added manually).
-    # In case of Norway Chess with Armageddon (weighted: False)
-    wdl_values = [1, 0.5, 0]
-    # Enter total_min, +minutes after certain moves (usually 40) and plus secs after each move. Many WCC games are not annotated with time control.
-    plus_min_plus_sec = [90, 30, 30]
-    if engine == 'Stockfish':
-        main_analyze(input_pgn_dir, output_json_dir, wdl_values, weighted)
-    else: # Leela Chess Zero
-        main_analyze_lc0(input_pgn_dir, output_json_dir, wdl_values, plus_min_plus_sec, weighted)
-
-    # Set the input and output directories for the JSON to CSV converter
-    json_input_dir = output_json_dir
-    # Define the output CSV directory inside the input PGN directory, call is 'Stats'
-    csv_output_dir = output_stats_dir
-    main_json_to_csv(json_input_dir, csv_output_dir, folder)
-
-    # Set the input and output directories for the player stats 
-    # If multiple CSVs set input_dir, otherwise, set csv_all_games_path 
-    # input_dir = "..."
-    # Export the output CSV file in the 'Stats' directory: csv_output_dir/aggregated_game_data.csv
-    csv_all_games_path = os.path.join(csv_output_dir, f'aggregated_game_data_{folder}.csv')
-    player_stats_output_dir = csv_output_dir
-    main_stats(csv_all_games_path, player_stats_output_dir, folder)
-
-    # Summarize the player stats
-    player_stats_output_path = os.path.join(player_stats_output_dir, f'player_stats_{folder}.csv')
-    main_summary_stats(player_stats_output_path, player_stats_output_dir, folder)
-
-# Process all WCC games and plot the average missed points per year
-process_chess_data(output_stats_dir)
-
-# Now process JSON files altogether to create an overall player stats CSV
-json_input_dir = input_main_pgn_dir
-main_json_to_csv(json_input_dir, csv_output_dir, 'all')
-
-# Set the input and output directories for the player stats
-csv_all_games_path = os.path.join(csv_output_dir, 'aggregated_game_data_all.csv')
-player_stats_output_dir = csv_output_dir
-main_stats(csv_all_games_path, player_stats_output_dir, 'all')
-
-end_time = time.time()
-print("Script finished in {:.2f} minutes".format((end_time - start_time) / 60.0))
+    output_stats_dir = args.output or os.path.join(input_main_pgn_dir, 'Stats')
+    for folder in sorted(os.listdir(input_main_pgn_dir)):
+        input_pgn_dir = os.path.join(input_main_pgn_dir, folder)
+        # Skip the file if it is not a directory
+        if not os.path.isdir(input_pgn_dir) or folder == 'Stats':
+            continue
+        if args.annotate:
+            print(f"Annotating games with {args.engine}...")
+            run_annotate(parser, argparse.Namespace(**{**vars(args), 'input': input_pgn_dir, 'output': input_pgn_dir}))
+            print(f"{args.engine} analysis finished")
+        # The JSON files are written next to the PGN files. Games annotated with both engines are analyzed with the Lc0 WDL.
+        output_json_dir = input_pgn_dir
+        if args.engine == 'stockfish':
+            main_analyze(input_pgn_dir, output_json_dir, args.wdl_values, args.weighted, args.workers)
+        else:
+            main_analyze_lc0(input_pgn_dir, output_json_dir, args.wdl_values, args.plus_min_plus_sec, args.weighted, args.workers)
+        main_json_to_csv(output_json_dir, output_stats_dir, folder)
+        csv_all_games_path = os.path.join(output_stats_dir, f'aggregated_game_data_{folder}.csv')
+        main_stats(csv_all_games_path, output_stats_dir, folder)
+        player_stats_output_path = os.path.join(output_stats_dir, f'player_stats_{folder}.csv')
+        main_summary_stats(player_stats_output_path, output_stats_dir, folder)
+
+    if args.plot:
+        # Process all WCC games and plot the average missed points per year
+        from wcc_stats import process_chess_data
+        process_chess_data(output_stats_dir)
+
+    # Now process JSON files altogether to create an overall player stats CSV
+    main_json_to_csv(input_main_pgn_dir, output_stats_dir, 'all')
+    main_stats(os.path.join(output_stats_dir, 'aggregated_game_data_all.csv'), output_stats_dir, 'all')
+
+def add_engine_options(subparser):
+    subparser.add_argument('--engine', choices=['stockfish', 'lc0', 'both'], default='stockfish', help="engine the games are (to be) annotated with, 'both' annotates with Stockfish and Lc0 in one pass")
+    subparser.add_argument('--engine-path', help='path to the engine executable (Stockfish for --engine both)')
+    subparser.add_argument('--lc0-path', help='path to the Lc0 executable for --engine both')
+    subparser.add_argument('--depth', type=int, default=25, help='Stockfish search depth')
+    subparser.add_argument('--weights', help='path to the Lc0 weights file')
+    subparser.add_argument('--nodes', type=int, default=2500, help='Lc0 nodes per position')
+    subparser.add_argument('--time', type=float, default=None, help='Lc0 seconds per position')
+    subparser.add_argument('--converge-tolerance', type=float, default=None, help='stop a search early once the score (pawns) or, for Lc0, the expected score has changed by at most this for --converge-stable checkpoints')
+    subparser.add_argument('--converge-stable', type=int, default=4, help='number of stable depths/node checkpoints needed to stop early')
+    subparser.add_argument('--continuous', action='store_true', help='keep one engine and analyze each game as one session, reusing the hash from ply to ply')
+    subparser.add_argument('--backward', action='store_true', help='search each game from the last move to the first')
+    subparser.add_argument('--converge-min-depth', type=int, default=12, help='never stop a Stockfish search before this depth')
+    subparser.add_argument('--supervise', action='store_true', help='run the engines under a watchdog that restarts them when a search hangs or fails')
+    subparser.add_argument('--position-timeout', type=float, default=60.0, help='with --supervise, maximum seconds per position')
+    subparser.add_argument('--max-retries', type=int, default=2, help='with --supervise, retries of a failed position with a restarted engine')
+    subparser.add_argument('--syzygy-path', help='directory of Syzygy tables, endgame positions in the tables are not searched by the engine')
+    subparser.add_argument('--shortcuts', action='store_true', help='do not search finished and repeated positions, search positions with a single legal reply with a smaller budget')
+    subparser.add_argument('--forced-budget', type=float, default=0.1, help='with --shortcuts, fraction of the depth/nodes used for a position with a single legal reply')
+    subparser.add_argument('--failure-log', help='with --supervise, JSON lines file the engine failures are appended to')
+
+def add_analyze_options(subparser):
+    # Standard FIDE: 1 0.5 0. Norway Chess: 3 1.25 0 (will be normalized by 1/3)
+    subparser.add_argument('--wdl-values', type=float, nargs=3, default=[1, 0.5, 0], metavar=('WIN', 'DRAW', 'LOSS'))
+    subparser.add_argument('--weighted', action='store_true', help="weight GI by the opponent's Elo")
+    subparser.add_argument('--plus-min-plus-sec', type=int, nargs=3, default=[90, 30, 30], metavar=('TOTAL_MIN', 'PLUS_MIN', 'PLUS_SEC'), help='time control, used for the Lc0 clock stats')
+    subparser.add_argument('--workers', type=int, default=1, help='processes per PGN file (0 = all cores)')
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='main.py', description='World Chess Championships: annotate games and compute GI, missed points and player stats.')
+    parser.add_argument('--config', help='JSON file with default options')
+    parser.add_argument('--metrics', action='store_true', help='collect performance metrics and write a run report')
+    parser.add_argument('--metrics-report', default='run_report.json', help='path of the JSON run report (a .prom file is written next to it)')
+    parser.add_argument('--engine-config', help='engine configuration saved by tune, its options are used for the engines (default: $WCC_ENGINE_CONFIG, none if unset)')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+
+    annotate = subparsers.add_parser('annotate', help='annotate PGN files with Stockfish or Lc0 evaluations')
+    annotate.add_argument('--input', help='directory with PGN files')
+    annotate.add_argument('--output', help='directory for the annotated PGN files')
+    add_engine_options(annotate)
+    annotate.set_defaults(handler=run_annotate)
+
+    distribute = subparsers.add_parser('distribute', help='annotate on several machines through a shared work queue')
+    distribute.add_argument('action', choices=['submit', 'work', 'collect', 'status'], help='submit the games as jobs, run a worker, write the annotated files, or show the queue')
+    distribute.add_argument('--queue', help="work queue: 'sqlite:queue.db' or 'dir:/shared/queue'")
+    distribute.add_argument('--input', help='with submit, directory with PGN files')
+    distribute.add_argument('--output', help='with collect, directory for the annotated PGN files')
+    distribute.add_argument('--games-per-job', type=int, default=4, help='with submit, games per job')
+    distribute.add_argument('--lease-seconds', type=float, default=600, help='with work, seconds before an unrenewed job can be claimed by another worker')
+    distribute.add_argument('--poll-interval', type=float, default=5.0, help='with work, seconds between checks for jobs leased by other workers')
+    distribute.add_argument('--max-attempts', type=int, default=3, help='with work, number of claims of a job before it is marked failed')
+    distribute.add_argument('--engines', type=int, help='with work, number of workers with their own engine on this node (default: the tuned number, see tune)')
+    add_engine_options(distribute)
+    distribute.set_defaults(handler=run_distribute)
+
+    analyze = subparsers.add_parser('analyze', help='compute GI, missed points and ACPL of annotated PGN files')
+    analyze.add_argument('--input', help='directory with annotated PGN files')
+    analyze.add_argument('--output', help='directory for the JSON files (default: the input directory)')
+    analyze.add_argument('--engine', choices=['stockfish', 'lc0', 'both'], default='stockfish', help="use the Stockfish %%eval or the Lc0 %%wdl annotations, 'both' computes the Stockfish, Lc0 and clock stats in one pass (columns prefixed sf_, lc0_, clock_)")
+    analyze.add_argument('--store', help="SQLite file (.db) the games, plies and blunder positions are also upserted into (stockfish and lc0 engines)")
+    add_analyze_options(analyze)
+    analyze.set_defaults(handler=run_analyze)
+
+    to_csv = subparsers.add_parser('to-csv', help='convert the JSON files of a directory to one CSV file')
+    to_csv.add_argument('--input', help='directory with JSON files')
+    to_csv.add_argument('--output', help='directory for aggregated_game_data_NAME.csv')
+    to_csv.add_argument('--name', help='name used in the output file name, e.g. the year')
+    to_csv.set_defaults(handler=run_to_csv)
+
+    stats = subparsers.add_parser('stats', help='compute player stats from an aggregated game data CSV')
+    stats.add_argument('--input', help='aggregated_game_data CSV file, or a game store (.db) written by analyze --store')
+    stats.add_argument('--engine', choices=['stockfish', 'lc0'], help='with a game store, use the games of this analyzer')
+    stats.add_argument('--output', help='directory for player_stats_NAME.csv')
+    stats.add_argument('--name', help='name used in the output file name')
+    stats.add_argument('--bootstrap', type=int, metavar='RESAMPLES', help='add bootstrap confidence intervals of avg_gi, avg_missed_points and TPR with this many resamples')
+    stats.add_argument('--confidence', type=float, default=0.95, help='with --bootstrap, level of the intervals')
+    stats.add_argument('--workers', type=int, default=1, help='with --bootstrap, processes (0 = all cores)')
+    stats.set_defaults(handler=run_stats)
+
+    summary = subparsers.add_parser('summary', help='summarize a player stats CSV')
+    summary.add_argument('--input', help='player_stats CSV file')
+    summary.add_argument('--output', help='directory for summary_stats_NAME.csv')
+    summary.add_argument('--name', help='name used in the output file name')
+    summary.set_defaults(handler=run_summary)
+
+    plot = subparsers.add_parser('plot', help='plot the average missed points per year')
+    plot.add_argument('--input', help='Stats directory with player_stats_YEAR.csv files')
+    plot.set_defaults(handler=run_plot)
+
+    serve = subparsers.add_parser('serve', help='answer player stats queries over HTTP from the JSON files of a directory')
+    serve.add_argument('--input', help='directory with the JSON files of the analyzers (searched recursively)')
+    serve.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    serve.add_argument('--port', type=int, default=8765, help='port to listen on')
+    serve.add_argument('--prefix', choices=['sf', 'lc0'], help="read the sf_ or lc0_ metrics of 'analyze --engine both' output")
+    serve.add_argument('--reload-interval', type=float, default=5.0, help='seconds between checks for new or changed JSON files')
+    serve.set_defaults(handler=run_serve)
+
+    timeseries = subparsers.add_parser('timeseries', help='update the rolling per-player metrics with new or changed JSON files')
+    timeseries.add_argument('--input', help='directory with the JSON files of the analyzers (searched recursively)')
+    timeseries.add_argument('--output', help='JSON file with the per-player series, updated in place')
+    timeseries.add_argument('--last-games', type=int, default=10, help='size of the games window')
+    timeseries.add_argument('--last-months', type=int, default=12, help='size of the months window')
+    timeseries.add_argument('--prefix', choices=['sf', 'lc0'], help="read the sf_ or lc0_ metrics of 'analyze --engine both' output")
+    timeseries.set_defaults(handler=run_timeseries)
+
+    corpus = subparsers.add_parser('corpus', help='build a compact corpus of annotated games, or compute the Stockfish stats of one')
+    corpus.add_argument('action', choices=['build', 'analyze'], help='build the corpus from PGN files, or write the aggregated game data CSV of the corpus')
+    corpus.add_argument('--corpus', help='corpus directory')
+    corpus.add_argument('--input', help='with build, directory with Stockfish-annotated PGN files (searched recursively)')
+    corpus.add_argument('--output', help='with analyze, directory for aggregated_game_data_NAME.csv')
+    corpus.add_argument('--name', help='with analyze, name used in the output file name')
+    add_analyze_options(corpus)
+    corpus.set_defaults(handler=run_corpus)
+
+    preview = subparsers.add_parser('preview', help='estimate the player stats of unannotated games from a sample of low-depth searches')
+    preview.add_argument('--input', help='directory with PGN files (searched recursively)')
+    preview.add_argument('--output', help='directory for aggregated_game_data_preview_NAME.csv and player_stats_preview_NAME.csv')
+    preview.add_argument('--name', help='name used in the output file names')
+    preview.add_argument('--engine-path', help='path to the Stockfish executable')
+    preview.add_argument('--depth', type=int, default=10, help='search depth of the sampled plies')
+    preview.add_argument('--step', type=int, default=4, help='search every STEP-th ply')
+    preview.add_argument('--swing', type=float, default=0.1, help='search all plies between two samples whose expected scores differ by more than this')
+    preview.add_argument('--check-fraction', type=float, default=0.1, help='fraction of the games searched at every ply to estimate the error bounds')
+    preview.add_argument('--reference-depth', type=int, help='search depth of the check games, e.g. 25 to include the error of the low depth in the bounds')
+    preview.add_argument('--confidence', type=float, default=0.95, help='level of the error bounds')
+    preview.add_argument('--supervise', action='store_true', help='run the engine under a watchdog that restarts it when a search hangs or fails')
+    preview.add_argument('--position-timeout', type=float, default=60.0, help='with --supervise, maximum seconds per position')
+    preview.add_argument('--max-retries', type=int, default=2, help='with --supervise, retries of a failed position with a restarted engine')
+    preview.add_argument('--failure-log', help='with --supervise, JSON lines file the engine failures are appended to')
+    add_analyze_options(preview)
+    preview.set_defaults(handler=run_preview)
+
+    watch = subparsers.add_parser('watch', help='follow a growing broadcast PGN and update the annotations and stats of its games')
+    watch.add_argument('--input', help='broadcast PGN file, or directory into which PGN files are dropped')
+    watch.add_argument('--output', help='directory for the annotated games, the JSON file and the stats CSV files')
+    watch.add_argument('--name', help='name used in the output file names')
+    watch.add_argument('--engine-path', help='path to the Stockfish executable')
+    watch.add_argument('--depth', type=int, default=20, help='search depth of the new plies')
+    watch.add_argument('--poll-interval', type=float, default=1.0, help='seconds between checks of the input')
+    watch.add_argument('--once', action='store_true', help='check the input once and exit')
+    watch.add_argument('--supervise', action='store_true', help='run the engine under a watchdog that restarts it when a search hangs or fails')
+    watch.add_argument('--position-timeout', type=float, default=60.0, help='with --supervise, maximum seconds per position')
+    watch.add_argument('--max-retries', type=int, default=2, help='with --supervise, retries of a failed position with a restarted engine')
+    watch.add_argument('--failure-log', help='with --supervise, JSON lines file the engine failures are appended to')
+    add_analyze_options(watch)
+    watch.set_defaults(handler=run_watch)
+
+    tune = subparsers.add_parser('tune', help='find the engine count, Threads, Hash (or Lc0 backend and minibatch) with the most positions per second')
+    tune.add_argument('--input', help='directory with PGN files the benchmark positions are taken from')
+    tune.add_argument('--config-output', help='engine configuration file (default: engine_config.json)')
+    tune.add_argument('--positions', type=int, default=40, help='number of benchmark positions')
+    tune.add_argument('--engine-counts', type=int, nargs='+', help='candidate numbers of parallel engines (default: powers of two up to the cores)')
+    tune.add_argument('--threads', type=int, nargs='+', help='candidate Threads per engine (default: powers of two up to the cores)')
+    tune.add_argument('--hash', type=int, nargs='+', default=[16, 64, 256], help='candidate Hash sizes in MB (Stockfish)')
+    tune.add_argument('--backends', nargs='+', default=[None], help='candidate Lc0 backends, e.g. cuda-fp16 cuda eigen')
+    tune.add_argument('--minibatch', type=int, nargs='+', default=[None], help='candidate Lc0 MinibatchSize values')
+    tune.add_argument('--cores', type=int, help='cores the engines may use together (default: all)')
+    add_engine_options(tune)
+    tune.set_defaults(handler=run_tune)
+
+    stream = subparsers.add_parser('stream', help='analyze annotated PGN files and stream the game records as they are computed')
+    stream.add_argument('--input', help='directory with annotated PGN files (searched recursively)')
+    stream.add_argument('--engine', choices=['stockfish', 'lc0', 'both'], default='stockfish', help="use the Stockfish, the Lc0 or, with 'both', all analyzers")
+    stream.add_argument('--ndjson', help='NDJSON file with one record per game, flushed after each game')
+    stream.add_argument('--table', help='aggregated game data CSV, written in chunks of --chunk-size games')
+    stream.add_argument('--chunk-size', type=int, default=1000, help='games per chunk of the CSV')
+    add_analyze_options(stream)
+    stream.set_defaults(handler=run_stream)
+
+    upgrade = subparsers.add_parser('upgrade', help='search the plies near the blunder, mistake and inaccuracy thresholds again and rewrite their annotations in place')
+    upgrade.add_argument('--input', help='directory with annotated PGN files (searched recursively), rewritten in place')
+    upgrade.add_argument('--engine', choices=['stockfish', 'lc0'], default='stockfish', help='engine the games were annotated with')
+    upgrade.add_argument('--engine-path', help='path to the engine executable')
+    upgrade.add_argument('--weights', help='path to the Lc0 weights file')
+    upgrade.add_argument('--depth', type=int, default=30, help='Stockfish search depth of the selected plies')
+    upgrade.add_argument('--nodes', type=int, default=20000, help='Lc0 nodes of the selected plies')
+    upgrade.add_argument('--margin', type=float, default=0.02, help='select a move whose expected point loss is within this of a threshold')
+    upgrade.add_argument('--swing', type=float, default=0.3, help='select a move whose expected point loss or gain is at least this')
+    upgrade.add_argument('--report', help='CSV file with the plies upgraded and the stats before and after for each game')
+    upgrade.add_argument('--dry-run', action='store_true', help='only count the plies that would be searched')
+    upgrade.add_argument('--supervise', action='store_true', help='run the engine under a watchdog that restarts it when a search hangs or fails')
+    upgrade.add_argument('--position-timeout', type=float, default=60.0, help='with --supervise, maximum seconds per position')
+    upgrade.add_argument('--max-retries', type=int, default=2, help='with --supervise, retries of a failed position with a restarted engine')
+    upgrade.add_argument('--failure-log', help='with --supervise, JSON lines file the engine failures are appended to')
+    add_analyze_options(upgrade)
+    upgrade.set_defaults(handler=run_upgrade)
+
+    sweep = subparsers.add_parser('sweep', help='compute the Stockfish stats under several scoring configurations in one pass')
+    sweep.add_argument('--input', help='directory with Stockfish-annotated PGN files (searched recursively), or a corpus directory (see corpus build)')
+    sweep.add_argument('--output', help='directory for sweep_game_data_NAME.csv and sweep_player_stats_NAME.csv')
+    sweep.add_argument('--name', help='name used in the output file names')
+    sweep.add_argument('--configurations', help='JSON file with a list of configurations, e.g. [{"name": "norway", "wdl_values": [3, 1.25, 0], "weighted": true, "thresholds": [0.05, 0.2, 0.5]}] (default: standard, Norway Chess, weighted and strict thresholds)')
+    sweep.set_defaults(handler=run_sweep)
+
+    pipeline = subparsers.add_parser('pipeline', help='run analyze, to-csv, stats and summary for each folder of a directory')
+    pipeline.add_argument('--input', help='directory with one folder of PGN files per match, e.g. WCC_matches/Stockfish')
+    pipeline.add_argument('--output', help='Stats directory (default: INPUT/Stats)')
+    pipeline.add_argument('--annotate', action='store_true', help='annotate the games with the engine first')
+    pipeline.add_argument('--plot', action='store_true', help='plot the average missed points per year')
+    add_engine_options(pipeline)
+    add_analyze_options(pipeline)
+    pipeline.set_defaults(handler=run_pipeline)
+    return parser, subparsers.choices
+
+# Function to load a JSON config file and use it as the defaults of the subcommands
+def apply_config(config_path, subparsers):
+    with open(config_path) as f:
+        config = json.load(f)
+    for command, subparser in subparsers.items():
+        known = {action.dest for action in subparser._actions}
+        defaults = {key.replace('-', '_'): value for key, value in config.items() if not isinstance(value, dict)}
+        defaults.update({key.replace('-', '_'): value for key, value in config.get(command, {}).items()})
+        subparser.set_defaults(**{key: value for key, value in defaults.items() if key in known})
+
+def main(argv=None):
+    parser, subparsers = build_parser()
+    args = parser.parse_args(argv)
+    if args.config:
+        apply_config(args.config, subparsers)
+        args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    if getattr(args, 'workers', 1) == 0:
+        args.workers = None
+    if args.metrics:
+        instrumentation.enable()
+    if args.engine_config:
+        # Set in the environment, so the worker processes use it too
+        os.environ['WCC_ENGINE_CONFIG'] = args.engine_config
+    start_time = time.time()
+    args.handler(subparsers[args.command], args)
+    if instrumentation.enabled:
+        instrumentation.write_report(args.metrics_report, os.path.splitext(args.metrics_report)[0] + '.prom')
+    if args.command == 'pipeline':
+        print("Script finished in {:.2f} minutes".format((time.time() - start_time) / 60.0))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
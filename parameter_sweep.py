@@ -0,0 +1,115 @@
+"""
+This script calculates the Stockfish stats of the same games under several scoring configurations in one run, e.g. the
+standard wdl_values [1, 0.5, 0] and Norway Chess [3, 1.25, 0], weighted and unweighted GI, and other blunder, mistake
+and inaccuracy thresholds. Instead of a main_analyze and main_stats run per configuration, each game is parsed once into
+a compact corpus (see compact_corpus.py) and the expected values of all configurations are calculated for the game in
+one array operation (corpus_metrics_sweep), so a sweep of ten configurations costs about as much as a single run. The
+outputs have one row per configuration and game or player, keyed by the name of the configuration:
+- sweep_game_data_{folder}.csv: the aggregated game data (as json_to_csv_converter.py) of each configuration
+- sweep_player_stats_{folder}.csv: the player stats (as csv_to_player_stats.py) of each configuration
+"""
+
+import instrumentation
+import json
+import os
+import pandas as pd
+from compact_corpus import CompactCorpus, build_corpus, corpus_metrics_sweep, corpus_game_details
+from json_to_csv_converter import extract_full_name
+from csv_to_player_stats import read_csv, player_stats_from_csv, PLAYER_STATS_COLUMNS, save_to_csv
+
+# Configurations of the sweep: name, wdl_values, weighted and optionally thresholds (inaccuracy, mistake and blunder
+# thresholds of the expected point loss, default those of pgn_evaluation_fast_analyzer.py)
+SWEEP_CONFIGURATIONS = [
+    {'name': 'standard', 'wdl_values': [1, 0.5, 0], 'weighted': False},
+    {'name': 'standard_weighted', 'wdl_values': [1, 0.5, 0], 'weighted': True},
+    {'name': 'norway', 'wdl_values': [3, 1.25, 0], 'weighted': False},
+    {'name': 'norway_weighted', 'wdl_values': [3, 1.25, 0], 'weighted': True},
+    {'name': 'strict_thresholds', 'wdl_values': [1, 0.5, 0], 'weighted': False, 'thresholds': [0.03, 0.1, 0.3]},
+]
+
+# Function to get the name of a configuration, made from its settings if it has none
+def configuration_name(configuration):
+    if configuration.get('name'):
+        return configuration['name']
+    name = f"wdl_{'_'.join(str(value) for value in configuration['wdl_values'])}"
+    if configuration['weighted']:
+        name += '_weighted'
+    if configuration.get('thresholds'):
+        name += f"_thresholds_{'_'.join(str(value) for value in configuration['thresholds'])}"
+    return name
+
+# Function to read the configurations of a sweep from a JSON file with a list of configurations
+def load_configurations(path):
+    with open(path) as f:
+        configurations = json.load(f)
+    for configuration in configurations:
+        configuration.setdefault('weighted', False)
+    return configurations
+
+# Function to load a saved corpus, or build one from the PGN files of a directory
+def load_or_build_corpus(input_path):
+    if os.path.exists(os.path.join(input_path, 'corpus.json')):
+        return CompactCorpus.load(input_path)
+    return build_corpus(input_path)
+
+# Function to calculate the rows of the aggregated game data of all configurations, the games of each configuration
+# are in corpus order
+@instrumentation.timed_stage('sweep')
+def sweep_corpus(corpus, configurations):
+    names = [configuration_name(configuration) for configuration in configurations]
+    rows = {name: [] for name in names}
+    for i in range(corpus.n_games):
+        results = corpus_metrics_sweep(corpus, i, configurations)
+        if results is None:
+            continue
+        details = corpus_game_details(corpus, i)
+        details['White'], details['Black'] = extract_full_name(details['White']), extract_full_name(details['Black'])
+        for name, (metrics, counts) in zip(names, results):
+            rows[name].append({'configuration': name, **metrics, **details, **{f'counts.{key}': value for key, value in counts.items()}})
+    instrumentation.count('games', len(rows[names[0]]) if names else 0)
+    return pd.DataFrame([row for name in names for row in rows[name]])
+
+# Function to calculate the player stats of each configuration from the sweep game data, with the settings of the
+# configuration in the first columns
+def sweep_player_stats(games, configurations):
+    tables = []
+    for configuration in configurations:
+        name = configuration_name(configuration)
+        player_stats = player_stats_from_csv(games[games['configuration'] == name]).round(2)[PLAYER_STATS_COLUMNS]
+        player_stats = player_stats.sort_values(by='avg_gi', ascending=False)
+        player_stats.insert(0, 'configuration', name)
+        player_stats.insert(1, 'wdl_values', ' '.join(str(value) for value in configuration['wdl_values']))
+        player_stats.insert(2, 'weighted', configuration['weighted'])
+        player_stats.insert(3, 'thresholds', ' '.join(str(value) for value in configuration.get('thresholds') or []))
+        tables.append(player_stats)
+    return pd.concat(tables, ignore_index=True)
+
+# Calculate the Stockfish stats of the games of input_path (a directory with annotated PGN files, searched
+# recursively, or a corpus saved by main_build_corpus) under each configuration (default SWEEP_CONFIGURATIONS) and
+# write sweep_game_data_{folder}.csv and sweep_player_stats_{folder}.csv to stats_output_dir. Returns the player stats.
+def main_sweep(input_path, stats_output_dir, folder, configurations=None):
+    configurations = configurations or SWEEP_CONFIGURATIONS
+    names = [configuration_name(configuration) for configuration in configurations]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The configurations of a sweep need different names: {names}")
+    corpus = load_or_build_corpus(input_path)
+    games = sweep_corpus(corpus, configurations)
+    if games.empty:
+        print(f"No annotated games found in {input_path}")
+        return None
+    if not os.path.exists(stats_output_dir):
+        os.makedirs(stats_output_dir)
+    # The player stats are calculated from the written CSV, so the headers are parsed as in main_stats
+    games_path = os.path.join(stats_output_dir, f'sweep_game_data_{folder}.csv')
+    games.to_csv(games_path, index=False)
+    player_stats = sweep_player_stats(read_csv(games_path), configurations)
+    save_to_csv(player_stats, os.path.join(stats_output_dir, f'sweep_player_stats_{folder}.csv'))
+    print(f"{len(games) // len(configurations)} games under {len(configurations)} configurations saved to {stats_output_dir}")
+    return player_stats
+
+if __name__ == "__main__":
+    # Example usage:
+    input_path = '/path/to/WCC_matches/Stockfish'
+    stats_output_dir = '/path/to/Stats'
+    main_sweep(input_path, stats_output_dir, 'all')
+    main_sweep(input_path, stats_output_dir, 'norway', [{'wdl_values': [3, 1.25, 0], 'weighted': weighted} for weighted in (False, True)])
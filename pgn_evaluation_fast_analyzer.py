@@ -5,67 +5,22 @@ This script inputs the PGN files with games annotated with Stockfish and outputs
 import chess
 import chess.pgn
 import chess.engine
-import json
+import instrumentation
 import os
+from contextlib import nullcontext
+from functools import partial
 from chess.engine import Cp, Wdl
+from pgn_io import is_pgn_file, pgn_base_name
+from game_stream import iter_pgn_records, JSONObjectWriter
+from game_store import open_game_store, analyze_game_record, STORE_BATCH_SIZE
+from game_metrics import (extract_eval_from_node, stockfish_pawns_list, extract_game_details, calculate_acpl, calculate_gi_by_result,
+                          calculate_expected_value, calculate_normalized_gi, calculate_adjusted_gi)
 import time
 
 
-# Function to extract the evaluation from a node
-def extract_eval_from_node(node):
-    node_evaluation = node.eval()
-    #print("node_evaluation: ", node_evaluation)
-    if node_evaluation:
-        cp_value = node_evaluation.pov(chess.WHITE).score(mate_score=10000) / 100.0
-        return cp_value
-    else:
-        return None
-
 # Function to extract the evaluations from a PGN file
 def extract_pawn_evals_from_pgn(game):
-    # set the initial value to 0
-    pawns_list = [0]
-    for node in game.mainline():
-        eval_value = extract_eval_from_node(node)
-        if eval_value is not None:
-            pawns_list.append(eval_value)
-    if len(pawns_list) > 1:
-        pawns_list[0] = pawns_list[1]
-    #print("pawns_list: ", pawns_list)
-    return pawns_list if pawns_list else None
-
-# Function to calculate the ACPL for both players
-def calculate_acpl(pawns_list):
-    white_losses, black_losses = [], []
-    for i in range(1, len(pawns_list)):
-        centipawn_loss = 100*(pawns_list[i] - pawns_list[i - 1])
-        if i % 2 == 1:  # White's turn
-            white_losses.append(-centipawn_loss)
-        else:  # Black's turn
-            black_losses.append(centipawn_loss)
-    white_acpl = sum(white_losses) / len(white_losses) if white_losses else 0
-    black_acpl = sum(black_losses) / len(black_losses) if black_losses else 0
-    return white_acpl, black_acpl
-
-def calculate_gi_by_result(white_gpl, black_gpl, game_result, wdl_values, postmove_exp_white, postmove_exp_black):
-    win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
-    # Calculate GI based on game result
-    if game_result == '1/2-1/2':
-        white_gi = draw_value - white_gpl
-        black_gi = draw_value - black_gpl
-    elif game_result == '1-0':
-        white_gi = win_value - white_gpl
-        black_gi = loss_value - black_gpl
-    elif game_result == '0-1':
-        black_gi = win_value - black_gpl
-        white_gi = loss_value - white_gpl
-    else:
-        white_gi = postmove_exp_white - white_gpl
-        black_gi = postmove_exp_black - black_gpl
-    # Normalize GI scores to the standard 1,0.5,0 scoring system.
-    white_gi = white_gi / win_value
-    black_gi = black_gi / win_value
-    return white_gi, black_gi
+    return stockfish_pawns_list([extract_eval_from_node(node) for node in game.mainline()])
 
 # Function to calculate GI and GPL in the usual way
 def gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted, counts):
@@ -132,114 +87,95 @@ def gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted
     black_gi = calculate_normalized_gi(black_gi)
     return white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number-1, counts
 
-# Function to calculate the expected value of a position
-def calculate_expected_value(win_prob, draw_prob, loss_prob, turn, wdl_values):
-    win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
-    if turn == "White":
-        expected_value_white = win_prob * win_value + draw_prob * draw_value
-        expected_value_black = loss_prob * win_value + draw_prob * draw_value
-    else:
-        expected_value_white = loss_prob * win_value + draw_prob * draw_value
-        expected_value_black = win_prob * win_value + draw_prob * draw_value
-    return expected_value_white, expected_value_black
-
-# Calculate normalized GI score
-def calculate_normalized_gi(gi):
-    # set a and b for normalized_gi = a + b *gi
-    a, b = 157.57, 18.55
-    return a  + b* gi
-    
-# Adjust the GI score with respect to the opponent's rating
-def calculate_adjusted_gi(gi, opponent_elo, reference_elo):
-    return gi - (1 - 2 * expected_score(opponent_elo, reference_elo)) * abs(gi)
-
-# Adjust the GI score with respect to the opponent's rating
-def expected_score(opponent_elo, reference_elo):
-    return 1 / (1 + 10 ** ((reference_elo - opponent_elo) / 400))
-    
-def main_analyze(input_pgn_dir, output_json_dir, wdl_values, weighted):
+# Function to calculate the stats of a game from its list of evaluations, returns the metrics and the counts of
+# blunders, mistakes and inaccuracies
+def stockfish_metrics(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted):
+    white_acpl, black_acpl = calculate_acpl(pawns_list)
+
+    #black_moves = (len(pawns_list) - 1) // 2
+    #white_moves = len(pawns_list) - 1 - black_moves
+    counts = {
+        'white_inaccuracy': 0,
+        'white_mistake': 0,
+        'white_blunder': 0,
+        'black_inaccuracy': 0,
+        'black_mistake': 0,
+        'black_blunder': 0,
+    }
+    # Calculate GI and GPL for both players
+    white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number, counts = gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted, counts)
+    metrics = format_stockfish_metrics(white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number, white_acpl, black_acpl)
+    return metrics, counts
+
+# Function to round the stats of a game as in the JSON output, also used by compact_corpus.py
+def format_stockfish_metrics(white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number, white_acpl, black_acpl):
+    metrics = {
+        "white_gi": round(white_gi, 1), "black_gi": round(black_gi, 1), 
+        "white_missed_points": round(white_gpl, 2), "black_missed_points": round(black_gpl, 2), "white_missed_points_permove": round(white_gpl/white_move_number, 4), "black_missed_points_permove": round(black_gpl/black_move_number, 4),
+        "white_acpl": round(white_acpl, 2), "black_acpl": round(black_acpl, 2),
+        "white_gi_permove": round(white_gi/white_move_number, 1), "black_gi_permove": round(black_gi/black_move_number, 1),
+        "white_gi_raw": round(white_gi_raw, 2), "black_gi_raw": round(black_gi_raw, 2),
+        "white_move_number": white_move_number, "black_move_number": black_move_number,
+    }
+    return metrics
+
+# Function to calculate the stats of a single annotated game, returns None if the game has no evaluations
+def analyze_game(game, wdl_values, weighted):
+    # Get the headers of the game
+    game_result, game_details, WhiteElo, BlackElo = extract_game_details(game, unknown_result='...')
+    pawns_list = extract_pawn_evals_from_pgn(game)
+    if pawns_list is None or len(pawns_list) < 2:  # Skip this game if no evaluations are available
+        return None
+    instrumentation.count('games')
+    instrumentation.count('plies', len(pawns_list) - 1)
+    metrics, counts = stockfish_metrics(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted)
+    game_data = {
+        **metrics,
+        **game_details,
+        "counts": counts,
+    }
+    # "RawEval": pawns_list,
+    return game_data
+
+@instrumentation.timed_stage('analyze')
+def main_analyze(input_pgn_dir, output_json_dir, wdl_values, weighted, workers=1, store=None):
+    # Set workers > 1 (or None for all cores) to split each large PGN at game boundaries and analyze it in parallel
+    # Set store to a SQLite file (see game_store.py) to also upsert the games, plies and blunder positions into it.
+    # output_json_dir can then be None to skip the JSON files.
     # Ensure the output directory exists
-    if not os.path.exists(output_json_dir):
+    if output_json_dir is not None and not os.path.exists(output_json_dir):
         os.makedirs(output_json_dir)
+    game_store = open_game_store(store)
+    analyze_fn = partial(analyze_game, wdl_values=wdl_values, weighted=weighted)
+    if game_store is not None:
+        analyze_fn = partial(analyze_game_record, analyze_fn=analyze_fn)
     key_counter = 1
     # walk through all pgn files in the dir
     for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
         for filename in filenames:
-            if filename.endswith('.pgn'):
-                aggregated_data = {}
+            if is_pgn_file(filename):
                 pgn_file_path = os.path.join(dirpath, filename)
-                json_file_name = filename.replace('.pgn', '.json')
-                output_json_path = os.path.join(output_json_dir, json_file_name)
-                with open(pgn_file_path) as pgn:
-                    while True:
-                        game = chess.pgn.read_game(pgn)
-                        if game is None:
-                            break
-                        # Get the headers of the game
-                        game_result = game.headers.get('Result', None)
-                        if game_result == '1-0':
-                            whiteResult = 1
-                            blackResult = 0
-                        elif game_result == '0-1':
-                            whiteResult = 0
-                            blackResult = 1
-                        elif game_result == '1/2-1/2':
-                            whiteResult = 0.5
-                            blackResult = 0.5
-                        else:
-                            whiteResult = '...'
-                            blackResult = '...'
-                        # Further game details
-                        game_details = {
-                            "White": game.headers.get("White", None),
-                            "Black": game.headers.get("Black", None),
-                            "Event": game.headers.get("Event", None),
-                            "Site": game.headers.get("Site", None),
-                            "Round": game.headers.get("Round", None),
-                            "WhiteElo": game.headers.get("WhiteElo", None),
-                            "BlackElo": game.headers.get("BlackElo", None),
-                            "WhiteResult": whiteResult,
-                            "BlackResult": blackResult,
-                            "Date": game.headers.get("Date", None),
-                                }
-                        # Get the ELO ratings of the players as integers
-                        WhiteElo = int(game.headers.get("WhiteElo", None)) if game.headers.get("WhiteElo", None) else None
-                        BlackElo = int(game.headers.get("BlackElo", None)) if game.headers.get("BlackElo", None) else None
-                        pawns_list = extract_pawn_evals_from_pgn(game)
-                        if pawns_list is None or len(pawns_list) < 2:  # Skip this game if no evaluations are available
-                            continue
-                        white_acpl, black_acpl = calculate_acpl(pawns_list)
-
-                        #black_moves = (len(pawns_list) - 1) // 2
-                        #white_moves = len(pawns_list) - 1 - black_moves
-                        counts = {
-                            'white_inaccuracy': 0,
-                            'white_mistake': 0,
-                            'white_blunder': 0,
-                            'black_inaccuracy': 0,
-                            'black_mistake': 0,
-                            'black_blunder': 0,
-                        }
-                        # Calculate GI and GPL for both players
-                        white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number, counts = gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted, counts)
-                        key = key_counter
-                        game_data = {
-                            "white_gi": round(white_gi, 1), "black_gi": round(black_gi, 1), 
-                            "white_missed_points": round(white_gpl, 2), "black_missed_points": round(black_gpl, 2), "white_missed_points_permove": round(white_gpl/white_move_number, 4), "black_missed_points_permove": round(black_gpl/black_move_number, 4),
-                            "white_acpl": round(white_acpl, 2), "black_acpl": round(black_acpl, 2),
-                            "white_gi_permove": round(white_gi/white_move_number, 1), "black_gi_permove": round(black_gi/black_move_number, 1),
-                            "white_gi_raw": round(white_gi_raw, 2), "black_gi_raw": round(black_gi_raw, 2),
-                            "white_move_number": white_move_number, "black_move_number": black_move_number,
-                            **game_details,
-                            "counts": counts,
-                        }
-                        # "RawEval": pawns_list,
-                        aggregated_data[key] = game_data
-                        key_counter += 1                
-                if aggregated_data:
-                    with open(output_json_path, 'w') as f:
-                        json.dump(aggregated_data, f, indent=4)                        
-                    # print(f"Aggregated data saved to {output_json_path}")
+                json_file_name = pgn_base_name(filename) + '.json'
+                output_json_path = os.path.join(output_json_dir, json_file_name) if output_json_dir is not None else None
+                # The games are written as they are analyzed, so memory does not grow with the size of the file, and the
+                # temporary file is removed if the analysis fails
+                with JSONObjectWriter(output_json_path) if output_json_dir is not None else nullcontext() as writer:
+                    records = []
+                    # Large uncompressed files are split at game boundaries and analyzed in parallel if workers != 1
+                    for result in iter_pgn_records(pgn_file_path, analyze_fn, workers):
+                        if game_store is not None:
+                            records.append(result)
+                            if len(records) >= STORE_BATCH_SIZE:
+                                game_store.upsert_games(records, 'stockfish', pgn_file_path)
+                                records = []
+                            result = result['game_data']
+                        if writer is not None:
+                            writer.write(key_counter, result)
+                        key_counter += 1
+                    if records:
+                        game_store.upsert_games(records, 'stockfish', pgn_file_path)
+    if game_store is not None:
+        game_store.close()
     # print(f"#Games = {key_counter - 1}")
 
 if __name__ == "__main__":
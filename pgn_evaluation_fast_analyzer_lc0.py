@@ -1,119 +1,24 @@
 import chess
 import chess.pgn
 import chess.engine
-import json
+import instrumentation
 import os
+from contextlib import nullcontext
+from functools import partial
 from chess.engine import Cp, Wdl
-from datetime import timedelta
-import re
-
-# Function to extract the evaluation from a node
-def extract_eval_from_node(node):
-    node_evaluation = node.eval()
-    if node_evaluation:
-        cp_value = node_evaluation.pov(chess.WHITE).score(mate_score=10000) / 100.0
-        return cp_value
-    else:
-        return None
-
-# Function to extract the WDL from a node's comment
-def extract_wdl_from_node(node):
-    comment = node.comment
-    wdl_annotation = re.search(r'\[%wdl \[([\d\.]+), ([\d\.]+), ([\d\.]+)\]\]', comment)
-    if wdl_annotation:
-        win_prob = float(wdl_annotation.group(1))
-        draw_prob = float(wdl_annotation.group(2))
-        loss_prob = float(wdl_annotation.group(3))
-        return [win_prob, draw_prob, loss_prob]
-    else:
-        return None
-
-# Function to extract time from a node
-def extract_time_from_node(node):
-    # This attempts to find the [%clk hh:mm:ss] annotation within the node's comment
-    comment = node.comment  # Extract the comment from the node
-    time_annotation = re.search(r'\[%clk (\d+:\d+:\d+)\]', comment)
-    if time_annotation:
-        # Extract the time string from the regex match group
-        time_string = time_annotation.group(1)
-        # Optionally, convert the time string to a datetime.timedelta object for further manipulation
-        hours, minutes, seconds = map(int, time_string.split(':'))
-        return timedelta(hours=hours, minutes=minutes, seconds=seconds)
-    else:
-        return None
+from pgn_io import is_pgn_file, pgn_base_name
+from game_stream import iter_pgn_records, JSONObjectWriter
+from game_store import open_game_store, analyze_game_record, STORE_BATCH_SIZE
+from game_metrics import (extract_eval_from_node, extract_wdl_from_node, extract_time_from_node, lc0_lists, extract_game_details, calculate_acpl,
+                          calculate_gi_by_result, move_time_diff, calculate_expected_value, calculate_normalized_gi, calculate_adjusted_gi)
 
 # Function to extract the evaluations from a PGN file
 def extract_pawn_evals_from_pgn(game):
-    pawns_list = [0]
-    wdl_list = []
-    nodes_list = [game]  # Start with the root node
-    time_list = [timedelta(seconds=0)]
-    for node in game.mainline():
-        eval_value = extract_eval_from_node(node)
-        wdl_value = extract_wdl_from_node(node)
-        time_value = extract_time_from_node(node)
-        if eval_value is not None:
-            pawns_list.append(eval_value)
-        else:
-            # Append the previous evaluation if the current evaluation is None
-            pawns_list.append(pawns_list[-1])
-        if wdl_value is not None:
-            wdl_list.append(wdl_value)
-        else:
-            # Append the previous WDL if the current WDL is None
-            if len(wdl_list) > 0:
-                wdl_list.append(wdl_list[-1])
-            else:
-                wdl_list.append([0.33, 0.34, 0.33])  # Default values
-        nodes_list.append(node)
-        if time_value is not None:
-            time_list.append(time_value)
-        else:
-            if len(time_list) > 1 and time_list[-2] is not None:
-                # Append the previous time of the same player if the current time is None
-                time_list.append(time_list[-2])
-            else:
-                # list is empty, so continue the loop
-                continue
-    # Handle the case where there is only one evaluation
-    if len(pawns_list) > 1:
-        pawns_list[0] = pawns_list[1]
-    if len(time_list) == 1:
-        time_list = None
-    return pawns_list if pawns_list else None, nodes_list if nodes_list else None, time_list if time_list else None, wdl_list if wdl_list else None
-
-# Function to calculate the ACPL for both players
-def calculate_acpl(pawns_list):
-    white_losses, black_losses = [], []
-    for i in range(1, len(pawns_list)):
-        centipawn_loss = 100*(pawns_list[i] - pawns_list[i - 1])
-        if i % 2 == 1:  # White's turn
-            white_losses.append(-centipawn_loss)
-        else:  # Black's turn
-            black_losses.append(centipawn_loss)
-    white_acpl = sum(white_losses) / len(white_losses) if white_losses else 0
-    black_acpl = sum(black_losses) / len(black_losses) if black_losses else 0
-    return white_acpl, black_acpl
-
-def calculate_gi_by_result(white_gpl, black_gpl, game_result, wdl_values, postmove_exp_white, postmove_exp_black):
-    win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
-    # Calculate GI based on game result
-    if game_result == '1/2-1/2':
-        white_gi = draw_value - white_gpl
-        black_gi = draw_value - black_gpl
-    elif game_result == '1-0':
-        white_gi = win_value - white_gpl
-        black_gi = loss_value - black_gpl
-    elif game_result == '0-1':
-        black_gi = win_value - black_gpl
-        white_gi = loss_value - white_gpl
-    else:
-        white_gi = postmove_exp_white - white_gpl
-        black_gi = postmove_exp_black - black_gpl
-    # Normalize GI scores to the standard 1,0.5,0 scoring system.
-    white_gi = white_gi / win_value
-    black_gi = black_gi / win_value
-    return white_gi, black_gi
+    nodes = list(game.mainline())
+    evals = [extract_eval_from_node(node) for node in nodes]
+    wdls = [extract_wdl_from_node(node) for node in nodes]
+    clocks = [extract_time_from_node(node) for node in nodes]
+    return lc0_lists(game, nodes, evals, wdls, clocks)
 
 # Function to save the position and move before a blunder
 def position_saver(i, nodes_list, counts, exp_point_loss, time_diff, turn):
@@ -183,25 +88,8 @@ def gi_and_gpl(wdl_list, game_result, WhiteElo, BlackElo, wdl_values, plus_min_p
         premove_win_prob, premove_draw_prob, premove_loss_prob = premove_wdl
         postmove_win_prob, postmove_draw_prob, postmove_loss_prob = postmove_wdl
 
-        if time_list is not None:
-            # Calculate the time difference between the current move and the same player's previous move
-            total_min, plus_min, plus_sec = plus_min_plus_sec[0], plus_min_plus_sec[1], plus_min_plus_sec[2]
-            if i > 2 and i < len(time_list):
-                if time_list[i].total_seconds() < time_list[i-2].total_seconds() + plus_sec:
-                    # time_diff gives the time the player spent on the move
-                    time_diff = time_list[i-2] + timedelta(seconds=plus_sec) - time_list[i]
-                else: 
-                    # it means that there was a time addition after the move, so plus_min should be added
-                    time_diff = time_list[i-2] + timedelta(minutes=plus_min) + timedelta(seconds=plus_sec) - time_list[i]
-                # Handle the case where the time difference is negative
-                if time_diff.total_seconds() < 0:
-                    # time_diff must be the absolute value of the time difference
-                    time_diff = abs(time_diff)
-            else:
-                # set default value of time_diff 0 seconds as a timedelta object
-                time_diff = timedelta(seconds=0)
-        else:
-            time_diff = None
+        # Time the player spent on the move, None without clock times
+        time_diff = move_time_diff(i, time_list, plus_min_plus_sec)
 
         # Calculate expected values before the move
         premove_exp_white, premove_exp_black = calculate_expected_value(premove_win_prob, premove_draw_prob, premove_loss_prob, turn, wdl_values)
@@ -269,116 +157,93 @@ def gi_and_gpl(wdl_list, game_result, WhiteElo, BlackElo, wdl_values, plus_min_p
     black_gi = calculate_normalized_gi(black_gi)
     return white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number-1, counts
 
-# Function to calculate the expected value of a position
-def calculate_expected_value(win_prob, draw_prob, loss_prob, turn, wdl_values):
-    win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
-    if turn == "White":
-        expected_value_white = win_prob * win_value + draw_prob * draw_value
-        expected_value_black = loss_prob * win_value + draw_prob * draw_value
-    else:
-        expected_value_white = loss_prob * win_value + draw_prob * draw_value
-        expected_value_black = win_prob * win_value + draw_prob * draw_value
-    return expected_value_white, expected_value_black
-
-# Calculate normalized GI score
-def calculate_normalized_gi(gi):
-    # set a and b for normalized_gi = a + b *gi
-    a, b = 157.57, 18.55
-    return a  + b* gi
+# Function to calculate the stats of a game from its lists of evaluations, nodes, clock times and WDLs, returns the
+# metrics and the counts of blunders, mistakes, inaccuracies and long thinks with their positions
+def lc0_metrics(pawns_list, nodes_list, time_list, wdl_list, game_result, WhiteElo, BlackElo, wdl_values, plus_min_plus_sec, weighted):
+    white_acpl, black_acpl = calculate_acpl(pawns_list)
 
-# Adjust the GI score with respect to the opponent's rating
-def calculate_adjusted_gi(gi, opponent_elo, reference_elo):
-    return gi - (1 - 2 * expected_score(opponent_elo, reference_elo)) * abs(gi)
+    counts = {
+        'white_inaccuracy': 0,
+        'white_mistake': 0,
+        'white_blunder': 0,
+        'black_inaccuracy': 0,
+        'black_mistake': 0,
+        'black_blunder': 0,
+        'white_deepthink': 0,
+        'black_deepthink': 0,
+        'white_critical_position': 0,
+        'black_critical_position': 0,
+        'blunder_positions': [],
+        'critical_positions': []
+    }
+    # Calculate GI and GPL for both players using wdl_list
+    white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number, counts = gi_and_gpl(wdl_list, game_result, WhiteElo, BlackElo, wdl_values, plus_min_plus_sec, weighted, counts, nodes_list, time_list)
+    metrics = {
+        "white_gi": round(white_gi, 1), "black_gi": round(black_gi, 1), "white_gi_permove": round(white_gi/white_move_number, 1), "black_gi_permove": round(black_gi/black_move_number, 1),
+        "white_missed_points": round(white_gpl, 2), "black_missed_points": round(black_gpl, 2), "white_missed_points_permove": round(white_gpl/white_move_number, 2), "black_missed_points_permove": round(black_gpl/black_move_number, 2),
+        "white_acpl": round(white_acpl, 2), "black_acpl": round(black_acpl, 2),
+        "white_gi_raw": round(white_gi_raw, 2), "black_gi_raw": round(black_gi_raw, 2),
+        "white_move_number": white_move_number, "black_move_number": black_move_number,
+    }
+    return metrics, counts
 
-# Adjust the GI score with respect to the opponent's rating
-def expected_score(opponent_elo, reference_elo):
-    return 1 / (1 + 10 ** ((reference_elo - opponent_elo) / 400))
+# Function to calculate the stats of a single annotated game, returns None if the game has no evaluations
+def analyze_game_lc0(game, wdl_values, plus_min_plus_sec, weighted):
+    # Get the headers of the game
+    game_result, game_details, WhiteElo, BlackElo = extract_game_details(game)
+    pawns_list, nodes_list, time_list, wdl_list = extract_pawn_evals_from_pgn(game)
+    if pawns_list is None or len(pawns_list) < 2:  # Skip this game if no evaluations are available
+        return None
+    instrumentation.count('games')
+    instrumentation.count('plies', len(pawns_list) - 1)
+    metrics, counts = lc0_metrics(pawns_list, nodes_list, time_list, wdl_list, game_result, WhiteElo, BlackElo, wdl_values, plus_min_plus_sec, weighted)
+    game_data = {
+        **metrics,
+        **game_details,
+        "counts": counts,
+    }
+    return game_data
 
-def main_analyze_lc0(input_pgn_dir, output_json_dir, wdl_values, plus_min_plus_sec, weighted):
+@instrumentation.timed_stage('analyze_lc0')
+def main_analyze_lc0(input_pgn_dir, output_json_dir, wdl_values, plus_min_plus_sec, weighted, workers=1, store=None):
+    # Set workers > 1 (or None for all cores) to split each large PGN at game boundaries and analyze it in parallel
+    # Set store to a SQLite file (see game_store.py) to also upsert the games, plies and blunder positions into it.
+    # output_json_dir can then be None to skip the JSON files.
     # Ensure the output directory exists
-    if not os.path.exists(output_json_dir):
+    if output_json_dir is not None and not os.path.exists(output_json_dir):
         os.makedirs(output_json_dir)
+    game_store = open_game_store(store)
+    analyze_fn = partial(analyze_game_lc0, wdl_values=wdl_values, plus_min_plus_sec=plus_min_plus_sec, weighted=weighted)
+    if game_store is not None:
+        analyze_fn = partial(analyze_game_record, analyze_fn=analyze_fn)
     key_counter = 1
     # walk through all pgn files in the dir
     for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
         for filename in filenames:
-            if filename.endswith('.pgn'):
-                aggregated_data = {}
+            if is_pgn_file(filename):
                 pgn_file_path = os.path.join(dirpath, filename)
-                json_file_name = filename.replace('.pgn', '.json')
-                output_json_path = os.path.join(output_json_dir, json_file_name)
-                with open(pgn_file_path) as pgn:
-                    while True:
-                        game = chess.pgn.read_game(pgn)
-                        if game is None:
-                            break
-                        # Get the headers of the game
-                        game_result = game.headers.get('Result', None)
-                        if game_result == '1-0':
-                            whiteResult = 1
-                            blackResult = 0
-                        elif game_result == '0-1':
-                            whiteResult = 0
-                            blackResult = 1
-                        elif game_result == '1/2-1/2':
-                            whiteResult = 0.5
-                            blackResult = 0.5
-                        else:
-                            whiteResult = None
-                            blackResult = None
-                        # Further game details
-                        game_details = {
-                            "White": game.headers.get("White", None),
-                            "Black": game.headers.get("Black", None),
-                            "Event": game.headers.get("Event", None),
-                            "Site": game.headers.get("Site", None),
-                            "Round": game.headers.get("Round", None),
-                            "WhiteElo": game.headers.get("WhiteElo", None),
-                            "BlackElo": game.headers.get("BlackElo", None),
-                            "WhiteResult": whiteResult,
-                            "BlackResult": blackResult,
-                            "Date": game.headers.get("Date", None),
-                                }
-                        # Get the ELO ratings of the players as integers
-                        WhiteElo = int(game.headers.get("WhiteElo", None)) if game.headers.get("WhiteElo", None) else None
-                        BlackElo = int(game.headers.get("BlackElo", None)) if game.headers.get("BlackElo", None) else None
-                        pawns_list, nodes_list, time_list, wdl_list = extract_pawn_evals_from_pgn(game)
-                        if pawns_list is None or len(pawns_list) < 2:  # Skip this game if no evaluations are available
-                            continue
-                        white_acpl, black_acpl = calculate_acpl(pawns_list)
-
-                        counts = {
-                            'white_inaccuracy': 0,
-                            'white_mistake': 0,
-                            'white_blunder': 0,
-                            'black_inaccuracy': 0,
-                            'black_mistake': 0,
-                            'black_blunder': 0,
-                            'white_deepthink': 0,
-                            'black_deepthink': 0,
-                            'white_critical_position': 0,
-                            'black_critical_position': 0,
-                            'blunder_positions': [],
-                            'critical_positions': []
-                        }
-                        # Calculate GI and GPL for both players using wdl_list
-                        white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number, counts = gi_and_gpl(wdl_list, game_result, WhiteElo, BlackElo, wdl_values, plus_min_plus_sec, weighted, counts, nodes_list, time_list)
-                        key = key_counter
-                        game_data = {
-                            "white_gi": round(white_gi, 1), "black_gi": round(black_gi, 1), "white_gi_permove": round(white_gi/white_move_number, 1), "black_gi_permove": round(black_gi/black_move_number, 1),
-                            "white_missed_points": round(white_gpl, 2), "black_missed_points": round(black_gpl, 2), "white_missed_points_permove": round(white_gpl/white_move_number, 2), "black_missed_points_permove": round(black_gpl/black_move_number, 2),
-                            "white_acpl": round(white_acpl, 2), "black_acpl": round(black_acpl, 2),
-                            "white_gi_raw": round(white_gi_raw, 2), "black_gi_raw": round(black_gi_raw, 2),
-                            "white_move_number": white_move_number, "black_move_number": black_move_number,
-                            **game_details,
-                            "counts": counts,
-                        }
-                        aggregated_data[key] = game_data
-                        key_counter += 1                
-                if aggregated_data:
-                    with open(output_json_path, 'w') as f:
-                        json.dump(aggregated_data, f, indent=4)                        
+                json_file_name = pgn_base_name(filename) + '.json'
+                output_json_path = os.path.join(output_json_dir, json_file_name) if output_json_dir is not None else None
+                # The games are written as they are analyzed, so memory does not grow with the size of the file, and the
+                # temporary file is removed if the analysis fails
+                with JSONObjectWriter(output_json_path) if output_json_dir is not None else nullcontext() as writer:
+                    records = []
+                    # Large uncompressed files are split at game boundaries and analyzed in parallel if workers != 1
+                    for result in iter_pgn_records(pgn_file_path, analyze_fn, workers):
+                        if game_store is not None:
+                            records.append(result)
+                            if len(records) >= STORE_BATCH_SIZE:
+                                game_store.upsert_games(records, 'lc0', pgn_file_path)
+                                records = []
+                            result = result['game_data']
+                        if writer is not None:
+                            writer.write(key_counter, result)
+                        key_counter += 1
+                    if records:
+                        game_store.upsert_games(records, 'lc0', pgn_file_path)
         print(f"#Games = {key_counter - 1}")
+    if game_store is not None:
+        game_store.close()
 
 if __name__ == "__main__":
     # Example usage:
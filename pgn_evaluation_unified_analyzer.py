@@ -0,0 +1,146 @@
+"""
+This script computes the Stockfish and Lc0 stats of annotated games in a single pass. Each game is parsed once and the
+annotations of each node are read once by the eval sources that are needed: 'cp' ([%eval]), 'wdl' ([%wdl]) and
+'clock' ([%clk]). The metric families are then computed from these values with the same functions as
+pgn_evaluation_fast_analyzer.py ('stockfish') and pgn_evaluation_fast_analyzer_lc0.py ('lc0'), plus a 'clock' family
+with the time used per move. The output is one JSON row per game with the game details and the metrics of each
+family, prefixed with the family, e.g. sf_white_gi, lc0_white_gi, clock_white_time_used, sf_counts.white_blunder.
+"""
+
+import instrumentation
+import os
+from functools import partial
+from pgn_io import is_pgn_file, pgn_base_name
+from game_stream import iter_pgn_records, JSONObjectWriter
+from game_metrics import extract_eval_from_node, extract_wdl_from_node, extract_time_from_node, stockfish_pawns_list, lc0_lists, extract_game_details, move_time_diff
+from pgn_evaluation_fast_analyzer import stockfish_metrics
+from pgn_evaluation_fast_analyzer_lc0 import lc0_metrics
+
+# Eval sources: the function reading the value of a node, None if the node has no such annotation
+EVAL_SOURCES = {
+    'cp': extract_eval_from_node,
+    'wdl': extract_wdl_from_node,
+    'clock': extract_time_from_node,
+}
+
+# Function to calculate the Stockfish family from the [%eval] values
+def stockfish_family(game, values, settings):
+    pawns_list = stockfish_pawns_list(values['cp'])
+    if pawns_list is None or len(pawns_list) < 2:
+        return None
+    return stockfish_metrics(pawns_list, settings['game_result'], settings['WhiteElo'], settings['BlackElo'], settings['wdl_values'], settings['weighted'])
+
+# Function to calculate the Lc0 family from the [%wdl] values (and the [%eval] values for ACPL and [%clk] for long thinks).
+# As in main_analyze_lc0, plies without [%wdl] get the previous WDL, or [0.33, 0.34, 0.33] before the first one, so
+# every game with at least one move is scored, also if it has no [%wdl] at all.
+def lc0_family(game, values, settings):
+    pawns_list, nodes_list, time_list, wdl_list = lc0_lists(game, values['nodes'], values['cp'], values['wdl'], values['clock'])
+    if pawns_list is None or len(pawns_list) < 2:
+        return None
+    return lc0_metrics(pawns_list, nodes_list, time_list, wdl_list, settings['game_result'], settings['WhiteElo'], settings['BlackElo'],
+                       settings['wdl_values'], settings['plus_min_plus_sec'], settings['weighted'])
+
+# Function to calculate the time used per move and the number of long thinks from the [%clk] values, with the move
+# times and thresholds of the Lc0 analyzer
+def clock_family(game, values, settings):
+    n_plies = len(values['nodes'])
+    time_list = lc0_lists(game, values['nodes'], [None] * n_plies, [None] * n_plies, values['clock'])[2]
+    if time_list is None:
+        return None
+    seconds = {'White': 0.0, 'Black': 0.0}
+    moves = {'White': 0, 'Black': 0}
+    counts = {'white_deepthink': 0, 'black_deepthink': 0, 'white_critical_position': 0, 'black_critical_position': 0}
+    for i in range(n_plies):
+        # As in the Lc0 analyzer, odd indices are White's moves
+        player = 'White' if i % 2 == 1 else 'Black'
+        time_diff = move_time_diff(i, time_list, settings['plus_min_plus_sec']).total_seconds()
+        seconds[player] += time_diff
+        moves[player] += 1
+        if time_diff >= 1800:
+            counts[f'{player.lower()}_deepthink'] += 1
+        elif time_diff >= 900:
+            counts[f'{player.lower()}_critical_position'] += 1
+    metrics = {
+        "white_time_used": seconds['White'], "black_time_used": seconds['Black'],
+        "white_time_permove": round(seconds['White'] / moves['White'], 1) if moves['White'] else 0,
+        "black_time_permove": round(seconds['Black'] / moves['Black'], 1) if moves['Black'] else 0,
+    }
+    return metrics, counts
+
+# Metric families: the prefix of their keys, the eval sources they read and the function calculating them. A function
+# gets the game, the values of the sources (one per mainline node, plus the nodes) and the settings, and returns the
+# metrics and counts, or None if the game has no annotations for the family.
+METRIC_FAMILIES = {
+    'stockfish': {'prefix': 'sf', 'sources': ['cp'], 'function': stockfish_family},
+    'lc0': {'prefix': 'lc0', 'sources': ['cp', 'wdl', 'clock'], 'function': lc0_family},
+    'clock': {'prefix': 'clock', 'sources': ['clock'], 'function': clock_family},
+}
+
+# Function to read the values of the eval sources for all mainline nodes in one pass
+def extract_source_values(game, sources):
+    nodes = list(game.mainline())
+    values = {'nodes': nodes}
+    for source in EVAL_SOURCES:
+        values[source] = [EVAL_SOURCES[source](node) for node in nodes] if source in sources else [None] * len(nodes)
+    return values
+
+# Function to calculate the metric families of a single annotated game, returns None if no family has annotations
+def analyze_game_unified(game, wdl_values, plus_min_plus_sec, weighted, families=tuple(METRIC_FAMILIES)):
+    game_result, game_details, WhiteElo, BlackElo = extract_game_details(game)
+    sources = {source for family in families for source in METRIC_FAMILIES[family]['sources']}
+    values = extract_source_values(game, sources)
+    settings = {
+        'game_result': game_result, 'WhiteElo': WhiteElo, 'BlackElo': BlackElo,
+        'wdl_values': wdl_values, 'plus_min_plus_sec': plus_min_plus_sec, 'weighted': weighted,
+    }
+    game_data = dict(game_details)
+    found = []
+    for family in families:
+        result = METRIC_FAMILIES[family]['function'](game, values, settings)
+        if result is None:
+            continue
+        found.append(family)
+        metrics, counts = result
+        prefix = METRIC_FAMILIES[family]['prefix']
+        game_data.update({f"{prefix}_{key}": value for key, value in metrics.items()})
+        game_data[f"{prefix}_counts"] = counts
+    if not found:
+        return None
+    instrumentation.count('games')
+    # The evaluated plies as counted by the single-family analyzers: the plies with an [%eval] for Stockfish, and all
+    # plies for Lc0, whose missing values are filled in
+    if 'stockfish' in found:
+        instrumentation.count('plies', len(stockfish_pawns_list(values['cp'])) - 1)
+    else:
+        instrumentation.count('plies', len(values['nodes']))
+    return game_data
+
+# Set families to the metric families to calculate, e.g. ['stockfish', 'lc0'], and workers > 1 (or None for all cores)
+# to split each large PGN at game boundaries and analyze it in parallel
+@instrumentation.timed_stage('analyze_unified')
+def main_analyze_unified(input_pgn_dir, output_json_dir, wdl_values, plus_min_plus_sec, weighted, families=tuple(METRIC_FAMILIES), workers=1):
+    # Ensure the output directory exists
+    if not os.path.exists(output_json_dir):
+        os.makedirs(output_json_dir)
+    analyze_fn = partial(analyze_game_unified, wdl_values=wdl_values, plus_min_plus_sec=plus_min_plus_sec, weighted=weighted, families=tuple(families))
+    key_counter = 1
+    # walk through all pgn files in the dir
+    for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
+        for filename in filenames:
+            if is_pgn_file(filename):
+                pgn_file_path = os.path.join(dirpath, filename)
+                output_json_path = os.path.join(output_json_dir, pgn_base_name(filename) + '.json')
+                # The games are written as they are analyzed, so memory does not grow with the size of the file
+                with JSONObjectWriter(output_json_path) as writer:
+                    for game_data in iter_pgn_records(pgn_file_path, analyze_fn, workers):
+                        writer.write(key_counter, game_data)
+                        key_counter += 1
+
+if __name__ == "__main__":
+    # Example usage:
+    input_pgn_dir = '/path/to/PGNs'
+    output_json_dir = input_pgn_dir
+    wdl_values = [1, 0.5, 0]
+    plus_min_plus_sec = [90, 30, 30]
+    weighted = True
+    main_analyze_unified(input_pgn_dir, output_json_dir, wdl_values, plus_min_plus_sec, weighted)
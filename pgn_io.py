@@ -0,0 +1,114 @@
+"""
+This script reads and writes PGN files. PGN files can be read from compressed archives such as the Lichess .pgn.zst
+databases. Compressed files are decompressed as a stream, so no temporary files are written. If a parallel
+decompressor (pzstd, pigz, lbzip2 or pbzip2) or the plain command line tool is installed, it runs in a separate
+process, so decompression and parsing use different cores. Otherwise the Python modules are used (zstandard for .zst).
+"""
+
+import bz2
+import chess.pgn
+import gzip
+import io
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+COMPRESSED_EXTENSIONS = ('.zst', '.bz2', '.gz')
+PGN_EXTENSIONS = ('.pgn',) + tuple('.pgn' + ext for ext in COMPRESSED_EXTENSIONS)
+
+# Command line decompressors in order of preference, they write the decompressed stream to stdout
+DECOMPRESSOR_COMMANDS = {
+    '.zst': [['pzstd', '-dcq', '-p', str(os.cpu_count() or 1)], ['zstd', '-dcq']],
+    '.gz': [['pigz', '-dc'], ['gzip', '-dc']],
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+}
+
+# Function to check whether a file is a PGN file, plain or compressed
+def is_pgn_file(filename):
+    return filename.endswith(PGN_EXTENSIONS)
+
+# Function to check whether a PGN file is compressed
+def is_compressed(filename):
+    return filename.endswith(COMPRESSED_EXTENSIONS)
+
+# Function to get the file name without the .pgn and compression extensions, e.g. 'games.pgn.zst' -> 'games'
+def pgn_base_name(filename):
+    name = os.path.basename(filename)
+    for ext in COMPRESSED_EXTENSIONS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return os.path.splitext(name)[0]
+
+# Function to find an installed command line decompressor for the extension
+def find_decompressor(ext):
+    for command in DECOMPRESSOR_COMMANDS.get(ext, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+# Function to open a binary decompression stream with the Python modules
+def open_python_decompressor(file_path, ext):
+    if ext == '.gz':
+        return gzip.open(file_path, 'rb')
+    if ext == '.bz2':
+        return bz2.open(file_path, 'rb')
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"Reading {file_path} needs the zstd command line tool or the zstandard package (pip install zstandard)")
+    # Lichess archives may use long distance matching, so allow large windows
+    decompressor = zstandard.ZstdDecompressor(max_window_size=2 ** 31)
+    return decompressor.stream_reader(open(file_path, 'rb'), closefd=True)
+
+# Open a PGN file as a text stream, decompressing .zst, .bz2 and .gz files on the fly.
+# Set use_external to False to always decompress in this process.
+@contextmanager
+def open_pgn(file_path, use_external=True):
+    ext = os.path.splitext(file_path)[1]
+    if ext not in COMPRESSED_EXTENSIONS:
+        with open(file_path) as pgn:
+            yield pgn
+        return
+    command = find_decompressor(ext) if use_external else None
+    if command is not None:
+        process = subprocess.Popen(command + [file_path], stdout=subprocess.PIPE)
+        pgn = io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace')
+        terminated = False
+        try:
+            yield pgn
+        finally:
+            # Stop the decompressor if the caller did not read the whole file
+            if process.poll() is None:
+                process.terminate()
+                terminated = True
+            pgn.close()
+            returncode = process.wait()
+        # A failed decompressor ends the stream early, which would otherwise look like the end of the file
+        if returncode != 0 and not terminated:
+            raise RuntimeError(f"{command[0]} failed on {file_path} with exit status {returncode}")
+        return
+    raw = open_python_decompressor(file_path, ext)
+    pgn = io.TextIOWrapper(raw, encoding='utf-8', errors='replace')
+    try:
+        yield pgn
+    finally:
+        pgn.close()
+
+# Function to get the path of the annotated copy of a PGN file, given its path relative to the input directory
+def annotated_output_path(relative_path, output_directory):
+    dest_folder = Path(output_directory) / Path(relative_path).parent
+    dest_folder.mkdir(parents=True, exist_ok=True)
+    base_name = pgn_base_name(relative_path)
+    return dest_folder / f"{base_name}_annotated.pgn"
+
+# Function to append an annotated game to OUTPUT/<relative path of the input file>/<base name>_annotated.pgn
+def write_annotated_game(game, file_path, output_directory, input_dir_path):
+    # Construct the output file path and save the game
+    output_file_path = annotated_output_path(Path(file_path).relative_to(input_dir_path), output_directory)
+
+    with open(output_file_path, 'a') as annotated_pgn:  # 'a' to append each game
+        exporter = chess.pgn.FileExporter(annotated_pgn)
+        game.accept(exporter)
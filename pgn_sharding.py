@@ -0,0 +1,134 @@
+"""
+This script splits a large PGN file into byte ranges at safe game boundaries (an [Event line after a blank line)
+and analyzes the ranges in parallel worker processes. The file is memory-mapped, so the workers read their own
+range directly from the page cache and only the per-game results are sent back. The results are merged in the
+original game order. iter_pgn_sharded splits the file into many small ranges and yields the results of each range in
+order as soon as it is done, so the output can be written while the rest of the file is analyzed.
+"""
+
+import chess.pgn
+import instrumentation
+import io
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Files smaller than this are parsed on one core, the process start-up is not worth it
+MIN_SHARD_BYTES = 64 * 1024 * 1024
+# Size of the byte ranges of iter_pgn_sharded, the memory used is a few ranges of results per worker
+STREAM_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Raw stream over a byte range of a memory-mapped file
+class MmapRangeReader(io.RawIOBase):
+    def __init__(self, mm, start, end):
+        self.mm = mm
+        self.pos = start
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.end - self.pos)
+        if n <= 0:
+            return 0
+        buffer[:n] = self.mm[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+# Function to check that the [Event tag at pos starts a new game, i.e. it follows a blank line
+def is_game_start(mm, pos):
+    if pos == 0:
+        return True
+    if mm[pos - 1:pos] != b'\n':
+        return False
+    # Skip the line break of the previous line and check that the line before is empty
+    i = pos - 2
+    if i >= 0 and mm[i:i + 1] == b'\r':
+        i -= 1
+    return i < 0 or mm[i:i + 1] == b'\n'
+
+# Function to find the first game start at or after offset
+def find_game_start(mm, offset):
+    size = len(mm)
+    while offset < size:
+        pos = mm.find(b'[Event ', offset)
+        if pos == -1:
+            return size
+        if is_game_start(mm, pos):
+            return pos
+        offset = pos + 1
+    return size
+
+# Function to split a memory-mapped PGN into at most n_shards byte ranges that start at game boundaries
+def shard_byte_ranges(mm, n_shards):
+    size = len(mm)
+    starts = [0]
+    for i in range(1, n_shards):
+        start = find_game_start(mm, size * i // n_shards)
+        if start > starts[-1] and start < size:
+            starts.append(start)
+    ends = starts[1:] + [size]
+    return list(zip(starts, ends))
+
+# Function to analyze all games in a byte range of a PGN file, runs in a worker process
+def analyze_byte_range(pgn_file_path, start, end, analyze_fn):
+    return list(iter_byte_range(pgn_file_path, start, end, analyze_fn))
+
+# Function to yield the results of the games in a byte range of a PGN file as they are analyzed
+def iter_byte_range(pgn_file_path, start, end, analyze_fn):
+    with open(pgn_file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pgn = io.TextIOWrapper(io.BufferedReader(MmapRangeReader(mm, start, end)), encoding='utf-8', errors='replace')
+            while True:
+                game = chess.pgn.read_game(pgn)
+                if game is None:
+                    break
+                game_data = analyze_fn(game)
+                if game_data is not None:
+                    yield game_data
+            pgn.detach()
+
+# Function to analyze a byte range in a worker process, also returns the metrics counted by the worker
+def analyze_byte_range_worker(pgn_file_path, start, end, analyze_fn, collect_metrics):
+    instrumentation.reset()
+    instrumentation.enable(collect_metrics)
+    with instrumentation.stage('shard'):
+        results = analyze_byte_range(pgn_file_path, start, end, analyze_fn)
+        counters = instrumentation.snapshot()
+    return results, counters
+
+# Function to analyze a large PGN file with several processes and yield the results in game order as soon as they are
+# ready. The file is split into small byte ranges and only a few ranges per worker are in progress at a time, so the
+# memory does not grow with the size of the file. analyze_fn must be picklable (e.g. a functools.partial of a module
+# level function) and return None for games that should be skipped.
+def iter_pgn_sharded(pgn_file_path, analyze_fn, workers=None, chunk_bytes=None, min_shard_bytes=None):
+    workers = workers or os.cpu_count() or 1
+    chunk_bytes = chunk_bytes or STREAM_CHUNK_BYTES
+    if min_shard_bytes is None:
+        min_shard_bytes = MIN_SHARD_BYTES
+    size = os.path.getsize(pgn_file_path)
+    if size == 0:
+        return
+    if workers == 1 or size < min_shard_bytes:
+        yield from iter_byte_range(pgn_file_path, 0, size, analyze_fn)
+        return
+    with open(pgn_file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ranges = shard_byte_ranges(mm, max(1, size // chunk_bytes))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, end in ranges:
+            pending.append(executor.submit(analyze_byte_range_worker, pgn_file_path, start, end, analyze_fn, instrumentation.enabled))
+            if len(pending) >= 2 * workers:
+                yield from merge_range_results(pending.popleft())
+        while pending:
+            yield from merge_range_results(pending.popleft())
+
+# Function to wait for the results of a byte range and merge its metrics
+def merge_range_results(future):
+    results, counters = future.result()
+    instrumentation.merge(counters)
+    return results
+
@@ -0,0 +1,242 @@
+"""
+This script tracks the form of players over time. For each player the games are kept in date order with their GI,
+missed points, ACPL, result and opponent Elo, and two rolling windows are calculated after each game: the last N games
+and the last K months. Each window has the average GI, missed points and ACPL, the points, the number of games and the
+TPR (with calculate_TPR of pr_calculator.py). The series are saved to a JSON file together with the analyzer JSON files
+already read and the games each of them added, so a later run only reads new or changed files and only calculates the
+windows of the new games (and of the later games of a player when a game is inserted before or removed from them).
+The games of a changed or deleted file are removed before the file is read again.
+"""
+
+import bisect
+import json
+import math
+import os
+from json_to_csv_converter import extract_full_name
+from pr_calculator import calculate_TPR
+
+# last_games: size of the games window
+# last_months: size of the months window
+ROLLING_DEFAULTS = {
+    'last_games': 10,
+    'last_months': 12,
+}
+
+# Columns of the games of a series and of each window
+GAME_COLUMNS = ['date', 'round', 'key', 'opponent', 'colour', 'gi', 'missed_points', 'acpl', 'result', 'opponent_elo']
+WINDOW_COLUMNS = ['games', 'avg_gi', 'avg_missed_points', 'avg_acpl', 'points', 'TPR']
+# Values summed in the windows, missing values count as 0 as in main_stats
+SUMMED_COLUMNS = ['gi', 'missed_points', 'acpl', 'result', 'opponent_elo']
+
+# Function to convert a value to float, NaN if it is missing or not a number
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+# Function to normalize a PGN date for sorting, unknown months and days become 01. None if the year is unknown.
+def normalize_date(date):
+    if not date or not date[:4].isdigit():
+        return None
+    parts = (date.split('.') + ['01', '01'])[:3]
+    return '.'.join([parts[0]] + [part if part.isdigit() else '01' for part in parts[1:]])
+
+# Function to get the date K months before a normalized date
+def months_before(date, months):
+    year, month, day = (int(part) for part in date.split('.'))
+    month_index = year * 12 + (month - 1) - months
+    return f"{month_index // 12:04d}.{month_index % 12 + 1:02d}.{day:02d}"
+
+# Function to get the sort key of a game of a series: date, then round (numeric when possible), then game key
+def game_order(date, round_, key):
+    round_value = to_float(round_)
+    return (date, round_value if not math.isnan(round_value) else math.inf, key)
+
+# Function to calculate the window values from prefix sums, for the games start..end-1
+def window_values(prefix, start, end):
+    n = end - start
+    sums = {column: prefix[column][end] - prefix[column][start] for column in SUMMED_COLUMNS}
+    elo_games = prefix['elo_games'][end] - prefix['elo_games'][start]
+    tpr = None
+    if n > 0 and elo_games > 0:
+        tpr = round(calculate_TPR(sums['result'], n, sums['opponent_elo'] / n), 2)
+    return {
+        'games': n,
+        'avg_gi': round(sums['gi'] / n, 2),
+        'avg_missed_points': round(sums['missed_points'] / n, 2),
+        'avg_acpl': round(sums['acpl'] / n, 2),
+        'points': sums['result'],
+        'TPR': tpr,
+    }
+
+# The date-ordered games of a player with the values of the two windows after each game, stored as columns
+class PlayerSeries:
+    def __init__(self, columns=None):
+        self.columns = {column: [] for column in GAME_COLUMNS}
+        for window in ('last_games', 'last_months'):
+            for column in WINDOW_COLUMNS:
+                self.columns[f'{window}_{column}'] = []
+        if columns:
+            self.columns.update(columns)
+        self.order = [game_order(date, round_, key) for date, round_, key in zip(self.columns['date'], self.columns['round'], self.columns['key'])]
+        self.build_prefix(0)
+
+    def __len__(self):
+        return len(self.order)
+
+    # Function to rebuild the prefix sums from game index start on
+    def build_prefix(self, start):
+        if start == 0:
+            self.prefix = {column: [0.0] for column in SUMMED_COLUMNS + ['elo_games']}
+        else:
+            for values in self.prefix.values():
+                del values[start + 1:]
+        for i in range(start, len(self)):
+            for column in SUMMED_COLUMNS:
+                value = self.columns[column][i]
+                self.prefix[column].append(self.prefix[column][-1] + (value if value is not None else 0.0))
+            self.prefix['elo_games'].append(self.prefix['elo_games'][-1] + (self.columns['opponent_elo'][i] is not None))
+
+    # Add or replace a game, returns the index from which the windows must be calculated again
+    def add_game(self, game):
+        order = game_order(game['date'], game['round'], game['key'])
+        i = bisect.bisect_left(self.order, order)
+        if i < len(self) and self.order[i] == order:
+            if all(self.columns[column][i] == game[column] for column in GAME_COLUMNS):
+                return None
+            for column in GAME_COLUMNS:
+                self.columns[column][i] = game[column]
+        else:
+            self.order.insert(i, order)
+            for column in self.columns:
+                self.columns[column].insert(i, game[column] if column in game else None)
+        return i
+
+    # Remove a game, returns the index from which the windows must be calculated again, None if it is not in the series
+    def remove_game(self, date, round_, key):
+        order = game_order(date, round_, key)
+        i = bisect.bisect_left(self.order, order)
+        if i == len(self) or self.order[i] != order:
+            return None
+        del self.order[i]
+        for values in self.columns.values():
+            del values[i]
+        return i
+
+    # Calculate the windows of the games from index start on
+    def update_windows(self, start, settings):
+        self.build_prefix(start)
+        for i in range(start, len(self)):
+            end = i + 1
+            windows = {
+                'last_games': max(0, end - settings['last_games']),
+                # Games after the date K months before this game
+                'last_months': bisect.bisect_right(self.columns['date'], months_before(self.columns['date'][i], settings['last_months']), 0, end),
+            }
+            for window, window_start in windows.items():
+                for column, value in window_values(self.prefix, window_start, end).items():
+                    self.columns[f'{window}_{column}'][i] = value
+
+# Function to read the games of an analyzer JSON file as one entry per player, skipping games without a known year.
+# prefix selects the metrics of a family of the unified analyzer, e.g. 'sf' or 'lc0'.
+def read_player_games(json_file_path, prefix=None):
+    key = (lambda name: f"{prefix}_{name}") if prefix else (lambda name: name)
+    with open(json_file_path) as f:
+        all_data = json.load(f)
+    player_games = []
+    for data in all_data.values():
+        date = normalize_date(data.get('Date'))
+        if date is None or key('white_gi') not in data:
+            continue
+        players = {colour: extract_full_name(data.get(colour.capitalize(), '')) for colour in ('white', 'black')}
+        game_key = '|'.join(str(data.get(header, '')) for header in ('Event', 'Site', 'Date', 'Round', 'White', 'Black'))
+        for colour, opponent in (('white', 'black'), ('black', 'white')):
+            opponent_elo = to_float(data.get(f'{opponent.capitalize()}Elo'))
+            values = {name: to_float(data.get(key(f'{colour}_{name}'))) for name in ('gi', 'missed_points', 'acpl')}
+            values['result'] = to_float(data.get(f'{colour.capitalize()}Result'))
+            player_games.append((players[colour], {
+                'date': date, 'round': data.get('Round'), 'key': game_key, 'opponent': players[opponent], 'colour': colour,
+                **{name: value if not math.isnan(value) else None for name, value in values.items()},
+                'opponent_elo': opponent_elo if not math.isnan(opponent_elo) else None,
+            }))
+    return player_games
+
+# Function to load the saved series, or start empty if there is no file or the windows changed. Returns the signature
+# of each file read, the games each file added as [player, date, round, key] and the series.
+def load_series(series_path, settings):
+    if series_path and os.path.exists(series_path):
+        with open(series_path) as f:
+            saved = json.load(f)
+        if saved.get('settings') == settings and 'sources' in saved:
+            return saved['files'], saved['sources'], {player: PlayerSeries(columns) for player, columns in saved['players'].items()}
+        print("Rolling windows changed, calculating the series again")
+    return {}, {}, {}
+
+# Function to remove the games added by a file from the series, the start indices of the windows to calculate are
+# kept in updated
+def remove_source(series, entries, updated):
+    for player, date, round_, key in entries:
+        if player not in series:
+            continue
+        start = series[player].remove_game(date, round_, key)
+        if start is not None:
+            updated[player] = min(start, updated.get(player, start))
+        if not len(series[player]):
+            del series[player]
+            updated.pop(player, None)
+
+# Update the per-player series in series_path with the new or changed analyzer JSON files in json_dir (searched
+# recursively). settings: see ROLLING_DEFAULTS.
+def main_player_timeseries(json_dir, series_path, settings=None, prefix=None):
+    settings = {**ROLLING_DEFAULTS, **(settings or {})}
+    files, sources, series = load_series(series_path, settings)
+    # start index of the windows to calculate per player
+    updated = {}
+    new_files = 0
+    found = set()
+    for dirpath, dirnames, filenames in os.walk(json_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith('.json'):
+                continue
+            json_file_path = os.path.join(dirpath, filename)
+            found.add(json_file_path)
+            stat = os.stat(json_file_path)
+            signature = [stat.st_mtime_ns, stat.st_size]
+            if files.get(json_file_path) == signature:
+                continue
+            try:
+                player_games = read_player_games(json_file_path, prefix)
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Error processing {json_file_path}: {e}")
+                continue
+            # The games of the previous version of the file may have been removed or changed their date, round or key
+            remove_source(series, sources.pop(json_file_path, []), updated)
+            files[json_file_path] = signature
+            new_files += 1
+            sources[json_file_path] = []
+            for player, game in player_games:
+                sources[json_file_path].append([player, game['date'], game['round'], game['key']])
+                player_series = series.setdefault(player, PlayerSeries())
+                start = player_series.add_game(game)
+                if start is not None:
+                    updated[player] = min(start, updated.get(player, start))
+    # Files of json_dir that were deleted since the last run
+    for json_file_path in [path for path in files if path.startswith(os.path.join(json_dir, '')) and path not in found]:
+        remove_source(series, sources.pop(json_file_path, []), updated)
+        del files[json_file_path]
+    for player, start in updated.items():
+        series[player].update_windows(start, settings)
+    output_dir = os.path.dirname(series_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(series_path, 'w') as f:
+        json.dump({'settings': settings, 'files': files, 'sources': sources, 'players': {player: s.columns for player, s in sorted(series.items())}}, f)
+    print(f"{new_files} new or changed files, {len(updated)} players updated, {len(series)} players in {series_path}")
+    return series
+
+if __name__ == "__main__":
+    # Example usage:
+    json_dir = '/path/to/WCC_matches/Stockfish'
+    series_path = '/path/to/WCC_matches/Stockfish/Stats/player_series.json'
+    main_player_timeseries(json_dir, series_path, {'last_games': 10, 'last_months': 12})
@@ -0,0 +1,104 @@
+"""
+This script classifies positions before they are sent to an engine, so cheap positions do not cost a full search:
+- terminal: the game is over by the rules (checkmate, stalemate, insufficient material, 75-move rule, fivefold
+  repetition). The result is filled in as for finished games, 100.0 / -100.0 / 0.0 with the matching WDL.
+- repetition: the position was already evaluated earlier in the same game. The earlier evaluation is reused.
+- forced: the side to move has a single legal reply. The position is searched with a much smaller budget.
+- search: a normal search.
+The annotators also record 'tablebase' for positions taken from Syzygy tables (see syzygy_tablebase.py). The treatment
+of each ply is written as a [%shortcut ...] comment, and the number of engine calls avoided is reported.
+"""
+
+import chess
+import instrumentation
+
+# terminal, repetition, forced: enable the treatment
+# forced_budget: fraction of the depth (Stockfish) or nodes and time (Lc0) used for a position with a single legal reply
+SHORTCUT_DEFAULTS = {
+    'terminal': True,
+    'repetition': True,
+    'forced': True,
+    'forced_budget': 0.1,
+}
+
+# Treatments that do not call the engine
+AVOIDED_TREATMENTS = ('terminal', 'repetition', 'tablebase')
+
+# Function to get the key of a position for repetitions: pieces, side to move, castling and en passant rights
+def position_key(board):
+    return board.epd()
+
+# Function to get the result of a finished game from the rules, returns the evaluation in pawns and the WDL
+# probabilities from White's point of view
+def terminal_result(board):
+    winner = board.outcome().winner
+    if winner == chess.WHITE:
+        return 100.0, [1.0, 0.0, 0.0]
+    if winner == chess.BLACK:
+        return -100.0, [0.0, 0.0, 1.0]
+    return 0.0, [0.0, 1.0, 0.0]
+
+# The classifier of one engine, with the treatments of the current game and the counts of the run. Use one instance
+# per thread.
+class PositionShortcuts:
+    def __init__(self, settings=None):
+        self.settings = {**SHORTCUT_DEFAULTS, **(settings or {})}
+        self.counts = {treatment: 0 for treatment in ('search', 'forced') + AVOIDED_TREATMENTS}
+        self.treatments = []
+        self.evaluated = {}
+
+    # Start a game with n_plies positions, the treatments of the previous game are added to the counts
+    def new_game(self, n_plies):
+        for treatment in self.treatments:
+            self.counts[treatment] += 1
+        self.treatments = ['search'] * n_plies
+        self.evaluated = {}
+
+    # Function to choose the treatment of ply i, returns it and the known result for 'terminal' and 'repetition'
+    def classify(self, i, board):
+        treatment, result = 'search', None
+        if self.settings['terminal'] and board.is_game_over():
+            treatment, result = 'terminal', terminal_result(board)
+        elif self.settings['repetition'] and position_key(board) in self.evaluated:
+            treatment, result = 'repetition', self.evaluated[position_key(board)]
+        elif self.settings['forced'] and board.legal_moves.count() == 1:
+            treatment = 'forced'
+        self.treatments[i] = treatment
+        return treatment, result
+
+    # Store the result of a searched position for later repetitions
+    def store(self, board, result):
+        self.evaluated[position_key(board)] = result
+
+    # Function to reduce a budget (depth, nodes or seconds) for a forced position
+    def reduced(self, budget, minimum=1):
+        if budget is None:
+            return None
+        return max(minimum, type(budget)(budget * self.settings['forced_budget']))
+
+    def summary(self):
+        counts = dict(self.counts)
+        for treatment in self.treatments:
+            counts[treatment] += 1
+        return {
+            **{f"shortcut_{treatment}": count for treatment, count in counts.items()},
+            'engine_calls_avoided': sum(counts[treatment] for treatment in AVOIDED_TREATMENTS),
+        }
+
+    # Print the summary and add it to the run report
+    def report(self, name=''):
+        summary = self.summary()
+        for key, value in summary.items():
+            instrumentation.count(key, value)
+        counts = ', '.join(f"{key[len('shortcut_'):]} {value}" for key, value in summary.items() if key.startswith('shortcut_'))
+        print(f"Shortcuts {name}: {summary['engine_calls_avoided']} engine calls avoided ({counts})")
+
+# Function to open the classifier, or None if no settings are given
+def open_shortcuts(settings):
+    return PositionShortcuts(settings) if settings is not None else None
+
+# Function to append the [%shortcut ...] comments of the plies that were not searched normally
+def add_shortcut_comments(game, treatments):
+    for node, treatment in zip(game.mainline(), treatments):
+        if treatment != 'search':
+            node.comment = f"{node.comment} [%shortcut {treatment}]" if node.comment else f"[%shortcut {treatment}]"
@@ -19,3 +19,13 @@ def calculate_TPR(m, n, B):
     elif m == n:
         return calculate_cpr(m, n, B)
     return B - 400 * math.log10((n - m) / m)
+
+# Vectorized calculate_TPR for NumPy arrays of scores m, numbers of games n and average opponent ratings B, e.g. the
+# bootstrap resamples of csv_to_player_stats.py
+def calculate_TPR_array(m, n, B):
+    import numpy as np
+    m, n, B = np.broadcast_arrays(np.asarray(m, dtype=float), np.asarray(n, dtype=float), np.asarray(B, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = B - 400 * np.log10((n - m) / m)
+        cpr = B - ((n + 1) / n) * 400 * np.log10((n + 0.5 - m) / (m + 0.5))
+    return np.where((m == 0) | (m == n), cpr, tpr)
@@ -0,0 +1,194 @@
+"""
+This script gives a quick estimate of the player stats of a new event before the full annotation. Instead of searching
+every ply at depth 25, each game is searched at a low depth on a sample of plies: every k-th ply, the first and the
+last ply, and all plies between two samples whose expected scores differ by more than a threshold (the large swings,
+where the blunders are). The evaluations of the other plies are interpolated, the games are analyzed as annotated games
+with pgn_evaluation_fast_analyzer.py and the player stats are calculated as by csv_to_player_stats.py.
+
+The error of the interpolation is estimated on a random sample of check games, which are searched at every ply (at
+reference_depth if given, so the error of the low depth is included too). The per-game differences between the
+estimated and the checked GI and missed points give the bias and the standard deviation of the error of a game, and the
+player stats get the bounds avg +/- (|bias| + z * std / sqrt(games)) for the estimated games of the player. The check
+games themselves use their checked stats.
+"""
+
+import chess
+import chess.pgn
+import instrumentation
+import os
+import random
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+from chess.engine import Cp
+from pgn_io import open_pgn, is_pgn_file
+from engine_supervisor import open_supervised_engine
+from stockfish_pgn_annotator import search_evaluation, add_stockfish_comments
+from pgn_evaluation_fast_analyzer import analyze_game
+from json_to_csv_converter import extract_full_name
+from csv_to_player_stats import read_csv, player_stats_from_csv, PLAYER_STATS_COLUMNS, save_to_csv
+
+# depth: search depth of the sampled plies
+# step: every step-th ply is searched
+# swing: plies between two samples are all searched when the White expected scores of the samples differ by more
+# check_fraction: fraction of the games searched at every ply to estimate the error
+# reference_depth: search depth of the check games (None: depth, the bounds then only cover the interpolation)
+# confidence: level of the error bounds
+# seed: seed of the choice of the check games
+PREVIEW_DEFAULTS = {
+    'depth': 10,
+    'step': 4,
+    'swing': 0.1,
+    'check_fraction': 0.1,
+    'reference_depth': None,
+    'confidence': 0.95,
+    'seed': 0,
+}
+
+# Metrics of the player stats with error bounds, each adds the columns <metric>_bound_low and <metric>_bound_high
+PREVIEW_METRICS = {'avg_gi': 'gi', 'avg_missed_points': 'missed_points'}
+
+# Function to get the White expected score of an evaluation in pawns
+def expected_score(evaluation):
+    return Cp(int(round(100 * evaluation))).wdl().expectation()
+
+# Function to fill the evaluations that were not searched by linear interpolation between the searched ones, rounded
+# to centipawns as the annotations
+def interpolate_evaluations(evaluations):
+    known = [i for i, evaluation in enumerate(evaluations) if evaluation is not None]
+    if not known:
+        return evaluations
+    values = np.interp(np.arange(len(evaluations)), known, [evaluations[i] for i in known])
+    return [evaluation if evaluation is not None else round(float(value), 2) for evaluation, value in zip(evaluations, values)]
+
+# Function to search the sampled plies of a game: every step-th ply, the last ply, and all plies between two samples
+# with a large swing. Returns the evaluations (None where not searched) and the number of searches.
+def sample_evaluations(engine, game, settings):
+    nodes = list(game.mainline())
+    evaluations = [None] * len(nodes)
+    searched = set()
+
+    def search(i):
+        if i not in searched:
+            searched.add(i)
+            evaluations[i] = search_evaluation(engine, nodes[i].board(), settings['depth'], game=game)
+
+    samples = sorted(set(range(0, len(nodes), settings['step'])) | {len(nodes) - 1}) if nodes else []
+    for i in samples:
+        search(i)
+    for a, b in zip(samples, samples[1:]):
+        if b - a > 1 and evaluations[a] is not None and evaluations[b] is not None:
+            if abs(expected_score(evaluations[a]) - expected_score(evaluations[b])) > settings['swing']:
+                for i in range(a + 1, b):
+                    search(i)
+    return evaluations, len(searched)
+
+# Function to search every ply of a check game, reusing the sampled evaluations when the depth is the same. Returns the
+# evaluations and the number of searches.
+def check_evaluations(engine, game, evaluations, settings):
+    depth = settings['reference_depth'] or settings['depth']
+    reuse = depth == settings['depth']
+    checked, searches = [], 0
+    for i, node in enumerate(game.mainline()):
+        if reuse and evaluations[i] is not None:
+            checked.append(evaluations[i])
+        else:
+            checked.append(search_evaluation(engine, node.board(), depth, game=game))
+            searches += 1
+    return checked, searches
+
+# Function to analyze a game with the given evaluations as its annotations, see analyze_game
+def analyze_evaluations(game, evaluations, wdl_values, weighted):
+    add_stockfish_comments(game, evaluations)
+    return analyze_game(game, wdl_values, weighted)
+
+# Function to estimate the stats of a game. Returns the game data (None if nothing could be searched), the
+# per-player differences between the estimate and the check (empty if not a check game) and the number of searches.
+def preview_game(engine, game, wdl_values, weighted, settings, check):
+    for node in game.mainline():
+        node.comment = ''
+    evaluations, searches = sample_evaluations(engine, game, settings)
+    game_data = analyze_evaluations(game, interpolate_evaluations(evaluations), wdl_values, weighted)
+    if game_data is None or not check:
+        return game_data, [], searches
+    checked, check_searches = check_evaluations(engine, game, evaluations, settings)
+    searches += check_searches
+    checked_data = analyze_evaluations(game, checked, wdl_values, weighted)
+    if checked_data is None:
+        return game_data, [], searches
+    errors = [{metric: game_data[f'{colour}_{metric}'] - checked_data[f'{colour}_{metric}'] for metric in PREVIEW_METRICS.values()}
+              for colour in ('white', 'black')]
+    return checked_data, errors, searches
+
+# Function to add the error bounds to the player stats from the differences of the check games. games has the
+# estimated games (preview_checked False) and the checked games of the players.
+def add_error_bounds(player_stats, games, errors, confidence):
+    errors = pd.DataFrame(errors, columns=list(PREVIEW_METRICS.values()))
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    estimated = games[~games['preview_checked'].astype(bool)]
+    estimated_counts = pd.concat([estimated['White'], estimated['Black']]).value_counts()
+    m = player_stats['Player'].map(estimated_counts).fillna(0)
+    n = player_stats['total_game_count']
+    for avg_col, value_col in PREVIEW_METRICS.items():
+        if len(errors) >= 2:
+            bias, std = abs(errors[value_col].mean()), errors[value_col].std()
+            # Error of the average of the player: the m estimated games of the n games have the error of a game
+            error = (m / n) * (bias + z * std / np.sqrt(m.where(m > 0, 1)))
+        else:
+            error = np.nan
+        player_stats[f'{avg_col}_bound_low'] = player_stats[avg_col] - error
+        player_stats[f'{avg_col}_bound_high'] = player_stats[avg_col] + error
+    return player_stats
+
+# Estimate the player stats of the games in input_pgn_dir (searched recursively, the games do not need annotations)
+# and write aggregated_game_data_preview_{folder}.csv and player_stats_preview_{folder}.csv to stats_output_dir.
+# settings: see PREVIEW_DEFAULTS. supervisor: see engine_supervisor.py.
+@instrumentation.timed_stage('preview')
+def main_preview(input_pgn_dir, stats_output_dir, folder, stockfish_path, wdl_values, weighted, settings=None, supervisor=None):
+    settings = {**PREVIEW_DEFAULTS, **(settings or {})}
+    rng = random.Random(settings['seed'])
+    rows, errors = [], []
+    searches, plies = 0, 0
+    with open_supervised_engine(stockfish_path, supervisor=supervisor, name='stockfish') as engine:
+        for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
+            for filename in sorted(filenames):
+                if not is_pgn_file(filename):
+                    continue
+                with open_pgn(os.path.join(dirpath, filename)) as pgn:
+                    while True:
+                        game = chess.pgn.read_game(pgn)
+                        if game is None:
+                            break
+                        check = rng.random() < settings['check_fraction']
+                        game_data, game_errors, game_searches = preview_game(engine, game, wdl_values, weighted, settings, check)
+                        searches += game_searches
+                        plies += len(list(game.mainline()))
+                        if game_data is None:
+                            continue
+                        errors.extend(game_errors)
+                        game_data['preview_checked'] = bool(game_errors)
+                        game_data['White'], game_data['Black'] = extract_full_name(game_data['White']), extract_full_name(game_data['Black'])
+                        rows.append(game_data)
+    if not rows:
+        print(f"No games found in {input_pgn_dir}")
+        return None
+    instrumentation.count('searches', searches)
+    if not os.path.exists(stats_output_dir):
+        os.makedirs(stats_output_dir)
+    # The player stats are calculated from the written CSV, so the headers are parsed as in main_stats
+    csv_all_games_path = os.path.join(stats_output_dir, f'aggregated_game_data_preview_{folder}.csv')
+    pd.json_normalize(rows).to_csv(csv_all_games_path, index=False)
+    games = read_csv(csv_all_games_path)
+    player_stats = player_stats_from_csv(games).round(2)[PLAYER_STATS_COLUMNS]
+    player_stats = add_error_bounds(player_stats, games, errors, settings['confidence']).round(2)
+    player_stats = player_stats.sort_values(by='avg_gi', ascending=False)
+    save_to_csv(player_stats, os.path.join(stats_output_dir, f'player_stats_preview_{folder}.csv'))
+    print(f"Searched {searches} of {plies} plies ({100 * searches / max(plies, 1):.1f}%) at depth {settings['depth']}, "
+          f"{len(errors) // 2} check games")
+    return player_stats
+
+if __name__ == "__main__":
+    # Example usage:
+    input_pgn_dir = '/path/to/new_event'
+    stats_output_dir = '/path/to/new_event/Stats'
+    main_preview(input_pgn_dir, stats_output_dir, 'new_event', '/usr/bin/stockfish', [1, 0.5, 0], True, {'depth': 10, 'step': 4})
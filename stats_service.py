@@ -0,0 +1,288 @@
+"""
+This script runs a local HTTP service that answers player stats queries without re-running main_stats. The JSON files
+written by the analyzers are loaded once into an in-memory columnar index: one row per player and game, stored as
+NumPy columns, with indexes by player, year, event and colour. Queries are aggregated with the formulas of
+csv_to_player_stats.py and pr_calculator.py, so a query over all games returns the rows of player_stats_*.csv.
+The directory is watched and the index is rebuilt when analyzer output is added or changed.
+
+    GET /stats?player=Emanuel Lasker&year_from=1900&year_to=1921&event=...&colour=white
+    GET /status
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from csv_to_player_stats import PLAYER_STATS_COLUMNS
+from json_to_csv_converter import extract_full_name
+from pr_calculator import calculate_TPR
+
+# Numeric columns of the index, read from the keys white_<name> / black_<name> of the analyzer output
+METRIC_COLUMNS = ['gi', 'gi_raw', 'missed_points', 'acpl', 'move_number']
+
+# Function to convert a JSON value to a float, NaN if it is missing or not a number (e.g. the result '...')
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+# Function to get the year from a PGN date such as '1921.03.15', None if it is unknown
+def date_year(date):
+    if date and date[:4].isdigit():
+        return int(date[:4])
+    return None
+
+# Function to add the rows of a list of indices to a dict value -> indices
+def add_to_index(index, key, row):
+    index.setdefault(key, []).append(row)
+
+# Function to calculate the mean of each group, skipping missing values, 0 for a group without values
+def group_mean(values, groups, n_groups):
+    valid = ~np.isnan(values)
+    counts = np.bincount(groups[valid], minlength=n_groups)
+    sums = np.bincount(groups[valid], weights=values[valid], minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, 0.0)
+
+# Function to calculate the median and the sample variance of each group, skipping missing values. Groups without
+# values get 0 and groups with one value a variance of 0, as after the fillna(0) of main_stats.
+def group_median_var(values, groups, n_groups):
+    valid = ~np.isnan(values)
+    values, groups = values[valid], groups[valid]
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    median = np.zeros(n_groups)
+    has = counts > 0
+    median[has] = (values[(starts + (counts - 1) // 2)[has]] + values[(starts + counts // 2)[has]]) / 2
+    mean = group_mean(values, groups, n_groups)
+    squares = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=n_groups)
+    var = np.zeros(n_groups)
+    var[counts > 1] = squares[counts > 1] / (counts[counts > 1] - 1)
+    return median, var
+
+# The in-memory columnar index of the games of a directory. prefix selects the metrics of a family of the unified
+# analyzer, e.g. 'sf' or 'lc0'.
+class GameIndex:
+    def __init__(self, json_dir, prefix=None):
+        self.json_dir = json_dir
+        self.prefix = prefix
+        self.signature = self.directory_signature()
+        self.load()
+
+    # Function to list the JSON files of the directory with their modification times and sizes
+    def directory_signature(self):
+        signature = []
+        for dirpath, dirnames, filenames in os.walk(self.json_dir):
+            for filename in sorted(filenames):
+                if filename.endswith('.json'):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(signature))
+
+    def load(self):
+        start = time.perf_counter()
+        key = (lambda name: f"{self.prefix}_{name}") if self.prefix else (lambda name: name)
+        players, colours, years, events = [], [], [], []
+        columns = {name: [] for name in METRIC_COLUMNS + ['result', 'elo', 'opponent_elo']}
+        n_games = 0
+        for path, mtime, size in self.signature:
+            try:
+                with open(path) as f:
+                    all_data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Skipping {path}: {e}")
+                continue
+            if not isinstance(all_data, dict):
+                continue
+            for data in all_data.values():
+                if not isinstance(data, dict) or key('white_gi') not in data:
+                    continue
+                n_games += 1
+                for colour, opponent in (('white', 'black'), ('black', 'white')):
+                    Colour, Opponent = colour.capitalize(), opponent.capitalize()
+                    players.append(extract_full_name(data.get(Colour, '')))
+                    colours.append(colour)
+                    years.append(date_year(data.get('Date')))
+                    events.append(data.get('Event'))
+                    for name in METRIC_COLUMNS:
+                        columns[name].append(to_float(data.get(key(f'{colour}_{name}'))))
+                    columns['result'].append(to_float(data.get(f'{Colour}Result')))
+                    columns['elo'].append(to_float(data.get(f'{Colour}Elo')))
+                    columns['opponent_elo'].append(to_float(data.get(f'{Opponent}Elo')))
+        # Players are stored as integer codes into the sorted list of distinct names
+        self.player_names, self.player_codes = np.unique(np.array(players, dtype=str), return_inverse=True)
+        self.columns = {name: np.array(values, dtype=float) for name, values in columns.items()}
+        self.is_white = np.array([colour == 'white' for colour in colours], dtype=bool)
+        self.years = np.array([year if year is not None else -1 for year in years], dtype=int)
+        self.indexes = {'player': {}, 'event': {}, 'year': {}, 'colour': {}}
+        for row, (player, event, year, colour) in enumerate(zip(players, events, years, colours)):
+            add_to_index(self.indexes['player'], player, row)
+            add_to_index(self.indexes['event'], event, row)
+            add_to_index(self.indexes['year'], year, row)
+            add_to_index(self.indexes['colour'], colour, row)
+        for index in self.indexes.values():
+            for value in index:
+                index[value] = np.array(index[value], dtype=int)
+        self.n_games = n_games
+        self.n_rows = len(players)
+        self.loaded_at = time.time()
+        self.load_seconds = time.perf_counter() - start
+
+    # Function to get the rows matching the filters, each filter is a list of accepted values
+    def select(self, players=None, events=None, years=None, colours=None, year_from=None, year_to=None):
+        mask = np.ones(self.n_rows, dtype=bool)
+        for name, values in (('player', players), ('event', events), ('year', years), ('colour', colours)):
+            if values:
+                selected = np.zeros(self.n_rows, dtype=bool)
+                for value in values:
+                    selected[self.indexes[name].get(value, np.array([], dtype=int))] = True
+                mask &= selected
+        if year_from is not None:
+            mask &= self.years >= year_from
+        if year_to is not None:
+            mask &= (self.years <= year_to) & (self.years >= 0)
+        return np.flatnonzero(mask)
+
+    # Function to aggregate the selected rows per player, with the formulas of main_stats in csv_to_player_stats.py
+    def player_stats(self, rows):
+        if len(rows) == 0:
+            return []
+        codes, inverse = np.unique(self.player_codes[rows], return_inverse=True)
+        n_players = len(codes)
+        column = lambda name: self.columns[name][rows]
+        # pandas sums skip missing values
+        group_sum = lambda values, mask=None: np.bincount(inverse, weights=np.nan_to_num(np.where(mask, values, 0) if mask is not None else values), minlength=n_players)
+        is_white = self.is_white[rows]
+        is_black = ~is_white
+        stats = {
+            'Player': self.player_names[codes],
+            'White_games': np.bincount(inverse, weights=is_white, minlength=n_players),
+            'Black_games': np.bincount(inverse, weights=is_black, minlength=n_players),
+        }
+        stats['total_game_count'] = stats['White_games'] + stats['Black_games']
+        stats['total_moves'] = group_sum(column('move_number'))
+        stats['white_result_sum'] = group_sum(column('result'), is_white)
+        stats['black_result_sum'] = group_sum(column('result'), is_black)
+        stats['Points'] = stats['white_result_sum'] + stats['black_result_sum']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name in ['gi', 'gi_raw', 'missed_points', 'acpl']:
+                stats[f'avg_{name}'] = group_sum(column(name)) / stats['total_game_count']
+            stats['avg_missed_points_white'] = group_sum(column('missed_points'), is_white) / stats['White_games']
+            stats['avg_missed_points_black'] = group_sum(column('missed_points'), is_black) / stats['Black_games']
+            stats['avg_gi_white'] = group_sum(column('gi'), is_white) / stats['White_games']
+            stats['avg_gi_black'] = group_sum(column('gi'), is_black) / stats['Black_games']
+            avg_opponent_elo = group_sum(column('opponent_elo')) / stats['total_game_count']
+        # Medians, variances (ddof=1, as pandas) and standard deviations per player, missing values are skipped
+        for name in ['gi', 'gi_raw', 'missed_points', 'acpl']:
+            stats[f'{name}_median'], stats[f'{name}_var'] = group_median_var(column(name), inverse, n_players)
+            stats[f'{name}_std'] = np.sqrt(stats[f'{name}_var'])
+        # Average Elo as White and as Black, and their mean if both are known
+        elo = column('elo')
+        elo_white = group_mean(np.where(is_white, elo, np.nan), inverse, n_players)
+        elo_black = group_mean(np.where(is_black, elo, np.nan), inverse, n_players)
+        stats['Elo'] = np.where((elo_white > 0) & (elo_black > 0), np.round((elo_white + elo_black) / 2, 0), np.maximum(elo_white, elo_black))
+        stats['TPR'] = np.array([calculate_TPR(m, n, B) for m, n, B in zip(stats['Points'], stats['total_game_count'], avg_opponent_elo)])
+        result = []
+        for i in np.argsort(-np.round(stats['avg_gi'], 2), kind='stable'):
+            row = {}
+            for name in PLAYER_STATS_COLUMNS:
+                value = stats[name][i]
+                if name == 'Player':
+                    row[name] = str(value)
+                else:
+                    value = round(float(value), 2)
+                    # JSON has no infinity or NaN, e.g. avg_gi_black of a player without games as Black
+                    row[name] = value if math.isfinite(value) else None
+            result.append(row)
+        return result
+
+# Function to parse the query parameters of /stats into the filters of GameIndex.select. Player names are normalised
+# as in the index, so 'Lasker, Emanuel' and 'Emanuel Lasker' find the same player.
+def parse_filters(query):
+    params = parse_qs(query)
+    integer = lambda name: int(params[name][0]) if name in params else None
+    return {
+        'players': [extract_full_name(player) for player in params['player']] if 'player' in params else None,
+        'events': params.get('event'),
+        'years': [int(year) for year in params.get('year', [])],
+        'colours': [colour.lower() for colour in params.get('colour', [])],
+        'year_from': integer('year_from'),
+        'year_to': integer('year_to'),
+    }
+
+# Function to make the request handler of an index holder, a dict with the current index under 'index'
+def make_handler(holder):
+    class StatsHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            index = holder['index']
+            if url.path == '/status':
+                self.send_json(200, {'json_dir': index.json_dir, 'games': index.n_games, 'players': len(index.player_names),
+                                     'files': len(index.signature), 'loaded_at': index.loaded_at, 'load_seconds': round(index.load_seconds, 3)})
+            elif url.path == '/stats':
+                start = time.perf_counter()
+                try:
+                    filters = parse_filters(url.query)
+                except ValueError as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+                rows = index.select(**filters)
+                players = index.player_stats(rows)
+                self.send_json(200, {'rows': len(rows), 'query_ms': round(1000 * (time.perf_counter() - start), 2), 'players': players})
+            else:
+                self.send_json(404, {'error': 'use /stats or /status'})
+
+        def log_message(self, format, *args):
+            pass
+    return StatsHandler
+
+# Function to rebuild the index when the JSON files of the directory change, runs in a background thread
+def watch_directory(holder, reload_interval, stop_event):
+    while not stop_event.wait(reload_interval):
+        index = holder['index']
+        signature = index.directory_signature()
+        if signature != index.signature:
+            # The new index replaces the old one only when it is complete, so queries never see a partial index
+            holder['index'] = GameIndex(index.json_dir, index.prefix)
+            print(f"Reloaded {holder['index'].n_games} games from {index.json_dir}")
+
+# Start the service on host:port for the analyzer JSON files in json_dir (searched recursively). Set prefix to 'sf'
+# or 'lc0' for the output of pgn_evaluation_unified_analyzer.py. Runs until interrupted.
+def main_stats_service(json_dir, host='127.0.0.1', port=8765, prefix=None, reload_interval=5.0):
+    holder = {'index': GameIndex(json_dir, prefix)}
+    print(f"Loaded {holder['index'].n_games} games in {holder['index'].load_seconds:.2f} seconds")
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=watch_directory, args=(holder, reload_interval, stop_event), daemon=True)
+    watcher.start()
+    server = ThreadingHTTPServer((host, port), make_handler(holder))
+    print(f"Serving player stats on http://{host}:{port}/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+
+if __name__ == "__main__":
+    # Example usage:
+    json_dir = '/path/to/WCC_matches/Stockfish'
+    main_stats_service(json_dir)
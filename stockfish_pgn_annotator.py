@@ -5,64 +5,155 @@ This script annotates each game with Stockfish evaluations in each PGN file in a
 import chess
 import chess.engine
 import chess.pgn
+import instrumentation
 import os
+import re
 import time
-from pathlib import Path
+from pgn_io import open_pgn, is_pgn_file, write_annotated_game
+from engine_search import search_position
+from engine_supervisor import EngineFailure, open_supervised_engine
+from syzygy_tablebase import open_syzygy, tablebase_eval
+from position_shortcuts import open_shortcuts, add_shortcut_comments
 
-def analyze_game_with_stockfish(file_path, stockfish_path, depth, output_directory, input_dir_path):
+# Function to evaluate each position of the mainline of a game. If game_session is True, the game is one engine session:
+# ucinewgame is only sent before the first search, so the hash is reused from ply to ply. If backward is True, the
+# mainline is searched from the last move to the first, so the deeper endgame results in the hash feed earlier positions.
+# A position that a supervised engine could not search is left as None, so it gets no comment. If tablebase is given
+# (see syzygy_tablebase.py), positions in the tables get their exact result without an engine search. If shortcuts is
+# given (see position_shortcuts.py), finished and repeated positions are not searched and positions with a single
+# legal reply are searched with a smaller depth; the treatment of each ply is kept in shortcuts.treatments.
+def evaluate_mainline_stockfish(engine, game, depth, convergence=None, game_session=False, backward=False, tablebase=None, shortcuts=None):
+    nodes = list(game.mainline())
+    evaluations = [None] * len(nodes)
+    if shortcuts is not None:
+        shortcuts.new_game(len(nodes))
+    order = range(len(nodes) - 1, -1, -1) if backward else range(len(nodes))
+    for i in order:
+        board = nodes[i].board()
+        search_depth = depth
+        if shortcuts is not None:
+            treatment, result = shortcuts.classify(i, board)
+            if result is not None:
+                evaluations[i] = result[0] if treatment == 'terminal' else result
+                continue
+            if treatment == 'forced':
+                search_depth = shortcuts.reduced(depth)
+        if tablebase is not None:
+            wdl = tablebase.probe(board)
+            if wdl is not None:
+                evaluations[i] = tablebase_eval(wdl)
+                if shortcuts is not None:
+                    shortcuts.treatments[i] = 'tablebase'
+                continue
+        start = time.perf_counter()
+        evaluation = search_evaluation(engine, board, search_depth, convergence, game=game if game_session else None)
+        if evaluation is not None:
+            # Only successful searches count in the time per search the tablebase savings are estimated with
+            if tablebase is not None:
+                tablebase.record_search(time.perf_counter() - start)
+            evaluations[i] = evaluation
+            if shortcuts is not None:
+                shortcuts.store(board, evaluation)
+    return evaluations
+
+# Function to search a position to the given depth, returns the evaluation in pawns from White's point of view or None
+# if the engine failed or gave no score. Also used by preview_mode.py for the sampled plies.
+def search_evaluation(engine, board, depth, convergence=None, game=None):
+    try:
+        info = search_position(engine, board, chess.engine.Limit(depth=depth), convergence, game=game)
+    except EngineFailure as e:
+        print(f"Skipping position {board.fen()}: {e}")
+        return None
+    score = info.get("score", None)
+    if score is None:
+        return None
+    instrumentation.record_search(info)
+    cp = score.relative.score(mate_score=10000)
+    evaluation = cp / 100.0
+    if not board.turn:
+        evaluation *= -1
+    return evaluation
+
+# If engine is given, it is used for all games (see main_stockfish), otherwise a new engine is started for each game
+def analyze_game_with_stockfish(file_path, stockfish_path, depth, output_directory, input_dir_path, convergence=None, engine=None, backward=False, supervisor=None, tablebase=None, shortcuts=None):
     # Open and read the PGN file
-    with open(file_path) as pgn_file:
+    with open_pgn(file_path) as pgn_file:
         while True:  # Loop to process each game in the PGN file
             game = chess.pgn.read_game(pgn_file)
             if game is None:
                 break  # No more games in the file
 
-            scores = []
-            with chess.engine.SimpleEngine.popen_uci(stockfish_path) as engine:
-                node = game
-                while node.variations:
-                    next_node = node.variations[0]
-                    board = next_node.board()
-                    info = engine.analyse(board, chess.engine.Limit(depth=depth))
-                    score = info.get("score", None)
-                    if score is not None:
-                        cp = score.relative.score(mate_score=10000)
-                        evaluation = cp / 100.0
-                        if not board.turn:
-                            evaluation *= -1
-                        scores.append(evaluation)
-                    node = next_node
+            annotate_game_stockfish(game, stockfish_path, depth, convergence, engine, backward, supervisor, tablebase, shortcuts)
+            write_annotated_game(game, file_path, output_directory, input_dir_path)
+
+# Function to evaluate a game and add the comments to it, without writing it. Used for each game of
+# analyze_game_with_stockfish and by the workers of distributed_annotation.py.
+def annotate_game_stockfish(game, stockfish_path, depth, convergence=None, engine=None, backward=False, supervisor=None, tablebase=None, shortcuts=None):
+    if engine is not None:
+        scores = evaluate_mainline_stockfish(engine, game, depth, convergence, game_session=True, backward=backward, tablebase=tablebase, shortcuts=shortcuts)
+    else:
+        with open_supervised_engine(stockfish_path, supervisor=supervisor, name='stockfish') as game_engine:
+            scores = evaluate_mainline_stockfish(game_engine, game, depth, convergence, backward=backward, tablebase=tablebase, shortcuts=shortcuts)
 
-            # Call the function to annotate the game with the scores
-            annotate_game_with_scores(game, scores, file_path, output_directory, input_dir_path)
+    instrumentation.count('games')
+    instrumentation.count('plies', sum(score is not None for score in scores))
+    add_stockfish_comments(game, scores)
+    if shortcuts is not None:
+        add_shortcut_comments(game, shortcuts.treatments)
 
-def annotate_game_with_scores(game, scores, file_path, output_directory, input_dir_path):
+def annotate_game_with_scores(game, scores, file_path, output_directory, input_dir_path, shortcuts=None):
+    add_stockfish_comments(game, scores)
+    if shortcuts is not None:
+        add_shortcut_comments(game, shortcuts.treatments)
+    write_annotated_game(game, file_path, output_directory, input_dir_path)
+
+EVAL_PATTERN = re.compile(r'\[%eval [^\]]+\]')
+
+# Function to set the [%eval] comments of the mainline. If keep_comments is True, the existing comments (e.g. [%clk])
+# are kept: an [%eval] in them is replaced and otherwise the evaluation is appended.
+def add_stockfish_comments(game, scores, keep_comments=False):
     # Iterate over the nodes and add the scores as comments
     node = game
     score_index = 0
     while node.variations:
         next_node = node.variations[0]
-        if score_index < len(scores):
+        if score_index < len(scores) and scores[score_index] is not None:
             score = scores[score_index]
             eval_string = f"[%eval {score}]" if isinstance(score, float) else f"[{score}]"
-            next_node.comment = eval_string
+            if not keep_comments or not next_node.comment:
+                next_node.comment = eval_string
+            elif EVAL_PATTERN.search(next_node.comment):
+                next_node.comment = EVAL_PATTERN.sub(lambda match: eval_string, next_node.comment, count=1)
+            else:
+                next_node.comment = f"{next_node.comment} {eval_string}"
         node = next_node
         score_index += 1
 
-    # Construct the output file path and save the game
-    relative_path = Path(file_path).relative_to(input_dir_path)
-    dest_folder = Path(output_directory) / relative_path.parent
-    dest_folder.mkdir(parents=True, exist_ok=True)
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    output_file_path = dest_folder / f"{base_name}_annotated.pgn"
-
-    with open(output_file_path, 'a') as annotated_pgn:  # 'a' to append each game
-        exporter = chess.pgn.FileExporter(annotated_pgn)
-        game.accept(exporter)
-        
-def main_stockfish(input_dir_path, output_directory, stockfish_path, DEPTH):
-    for subdir, dirs, files in os.walk(input_dir_path):
-        for file in files:
-            if file.endswith(".pgn"):
-                file_path = os.path.join(subdir, file)
-                analyze_game_with_stockfish(file_path, stockfish_path, DEPTH, output_directory, input_dir_path)
+# Set convergence, e.g. {'tolerance': 0.1, 'stable': 4, 'min_depth': 12}, to stop a search early once the score is stable
+# (see engine_search.py). DEPTH remains the maximum depth.
+# Set continuous to True to keep one engine for the whole run and analyze each game as one session (the hash is kept
+# from ply to ply), and backward to True to search each game from the last move to the first, as the Lichess server
+# analysis does.
+# Set supervisor, e.g. {'position_timeout': 60, 'max_retries': 2, 'failure_log': 'engine_failures.jsonl'}, to run the
+# engine under a watchdog that restarts it when a search hangs or fails (see engine_supervisor.py).
+# Set syzygy_path to a directory of Syzygy tables to take the results of endgame positions from the tables, and
+# shortcuts, e.g. {} for the defaults of position_shortcuts.py, to skip or shorten the searches of cheap positions.
+@instrumentation.timed_stage('annotate_stockfish')
+def main_stockfish(input_dir_path, output_directory, stockfish_path, DEPTH, convergence=None, continuous=False, backward=False, supervisor=None, syzygy_path=None, shortcuts=None):
+    engine = open_supervised_engine(stockfish_path, supervisor=supervisor, name='stockfish') if continuous else None
+    tablebase = open_syzygy(syzygy_path)
+    shortcuts = open_shortcuts(shortcuts)
+    try:
+        for subdir, dirs, files in os.walk(input_dir_path):
+            for file in files:
+                if is_pgn_file(file):
+                    file_path = os.path.join(subdir, file)
+                    analyze_game_with_stockfish(file_path, stockfish_path, DEPTH, output_directory, input_dir_path, convergence, engine, backward, supervisor, tablebase, shortcuts)
+    finally:
+        if engine is not None:
+            engine.quit()
+        if tablebase is not None:
+            tablebase.report('stockfish')
+            tablebase.close()
+        if shortcuts is not None:
+            shortcuts.report('stockfish')
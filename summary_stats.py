@@ -7,8 +7,7 @@
     It also outputs a density distribution plot for each merged column.
 """
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import instrumentation
 import os
 
 def generate_summary_stats(player_stats, summary_stats_path):
@@ -33,6 +32,7 @@ def generate_summary_stats(player_stats, summary_stats_path):
     summary_stats.to_csv(summary_stats_path)
 
 # Main Functionality
+@instrumentation.timed_stage('summary_stats')
 def main_summary_stats(player_stats_output_path, player_stats_output_dir, folder):
 
     # Define the output of the summary_stats CSV file path within the output directory
@@ -0,0 +1,140 @@
+"""
+This script generates a synthetic corpus of annotated PGN files for benchmarking. The games are random legal games
+annotated like the Lichess/Lc0 exports used in this repository: [%eval], [%eval_lc0], [%wdl] and [%clk] comments,
+move assessments ($2, $4, $6) and short variations after mistakes. A pool of move sequences is generated once and
+reused with fresh annotations and headers, so a million games can be written in minutes without any engine.
+"""
+
+import chess
+import math
+import os
+import random
+import time
+
+FIRST_NAMES = ['Anna', 'Boris', 'Carlos', 'Dmitri', 'Elena', 'Fabiano', 'Gukesh', 'Hikaru', 'Ian', 'Judit', 'Levon', 'Magnus',
+               'Nodirbek', 'Olga', 'Praggnanandhaa', 'Richard', 'Sergey', 'Teimour', 'Viswanathan', 'Wesley']
+LAST_NAMES = ['Alekhine', 'Botvinnik', 'Capablanca', 'Ding', 'Euwe', 'Fischer', 'Gelfand', 'Karpov', 'Kasparov', 'Kramnik',
+              'Lasker', 'Morphy', 'Nepomniachtchi', 'Petrosian', 'Rubinstein', 'Smyslov', 'Spassky', 'Steinitz', 'Tal', 'Zukertort']
+
+# Function to generate a random legal game, returns the SAN moves and an alternative SAN move for each ply
+def random_move_sequence(rng, min_plies=40, max_plies=160):
+    board = chess.Board()
+    san_moves, alternatives = [], []
+    n_plies = rng.randint(min_plies, max_plies)
+    while len(san_moves) < n_plies and not board.is_game_over():
+        legal_moves = list(board.legal_moves)
+        # Prefer captures a little, so material comes off the board as in real games
+        captures = [move for move in legal_moves if board.is_capture(move)]
+        move = rng.choice(captures) if captures and rng.random() < 0.3 else rng.choice(legal_moves)
+        others = [m for m in legal_moves if m != move]
+        alternatives.append(board.san(rng.choice(others)) if others else None)
+        san_moves.append(board.san(move))
+        board.push(move)
+    return san_moves, alternatives
+
+# Function to convert an evaluation in pawns to White's win, draw and loss probabilities
+def eval_to_wdl(evaluation):
+    win = 1 / (1 + math.exp(-1.1 * (evaluation - 0.9)))
+    loss = 1 / (1 + math.exp(-1.1 * (-evaluation - 0.9)))
+    draw = max(0.0, 1 - win - loss)
+    return win, draw, loss
+
+# Function to format a clock in seconds as h:mm:ss
+def format_clock(seconds):
+    seconds = max(0, int(seconds))
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+# Function to write the movetext of a game with synthetic evaluations, WDL and clock annotations
+def annotated_movetext(rng, san_moves, alternatives, plus_min_plus_sec):
+    total_min, plus_min, plus_sec = plus_min_plus_sec
+    clocks = [total_min * 60.0, total_min * 60.0]
+    evaluation = rng.gauss(0.2, 0.1)
+    parts = []
+    n_plies = len(san_moves)
+    for i, san in enumerate(san_moves):
+        color = i % 2
+        move_number = i // 2 + 1
+        sign = 1 if color == 0 else -1
+        # Random walk of the evaluation with occasional mistakes of the side to move
+        swing = rng.gauss(0, 0.15)
+        if rng.random() < 0.04:
+            swing -= sign * rng.uniform(0.5, 4.0)
+        evaluation = max(-15.0, min(15.0, evaluation + swing))
+        mate = None
+        if i >= n_plies - 3 and abs(evaluation) > 8:
+            mate = int(math.copysign(n_plies - i, evaluation))
+        eval_text = f"#{mate}" if mate is not None else f"{round(evaluation, 2)}"
+        eval_lc0 = round(evaluation + rng.gauss(0, 0.1), 2)
+        win, draw, loss = eval_to_wdl(eval_lc0)
+        # Clock of the player that just moved
+        clocks[color] -= rng.expovariate(1 / 150.0)
+        clocks[color] += plus_sec
+        if move_number == 40:
+            clocks[color] += plus_min * 60
+        comment = f"[%eval {eval_text}] [%eval_lc0 {eval_lc0}] [%wdl [{win:.2f}, {draw:.2f}, {loss:.2f}]] [%clk {format_clock(clocks[color])}]"
+        number = f"{move_number}." if color == 0 else f"{move_number}..."
+        nag = ''
+        if -sign * swing >= 2.0:
+            nag = ' $4'
+        elif -sign * swing >= 1.0:
+            nag = ' $2'
+        elif -sign * swing >= 0.5:
+            nag = ' $6'
+        parts.append(f"{number} {san}{nag} {{ {comment} }}")
+        if nag and alternatives[i] is not None:
+            parts.append(f"( {number} {alternatives[i]} )")
+    if evaluation > 3:
+        result = '1-0'
+    elif evaluation < -3:
+        result = '0-1'
+    else:
+        result = '1/2-1/2'
+    return ' '.join(parts), result
+
+# Function to write the headers of a game
+def game_headers(rng, game_index, n_players, year, result):
+    white, black = rng.sample(range(n_players), 2)
+    def player_name(i):
+        return f"{LAST_NAMES[i % len(LAST_NAMES)]}{i // len(LAST_NAMES) or ''}, {FIRST_NAMES[(i * 7) % len(FIRST_NAMES)]}"
+    headers = [
+        ('Event', f"Synthetic Championship {year}"),
+        ('Site', 'Benchmark'),
+        ('Date', f"{year}.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}"),
+        ('Round', str(game_index + 1)),
+        ('White', player_name(white)),
+        ('Black', player_name(black)),
+        ('Result', result),
+        ('WhiteElo', str(2400 + (white * 37) % 450)),
+        ('BlackElo', str(2400 + (black * 37) % 450)),
+        ('TimeControl', '5400+30'),
+    ]
+    return '\n'.join(f'[{key} "{value}"]' for key, value in headers)
+
+# Function to generate a corpus of n_games annotated games in files of games_per_file games
+def main_generate_corpus(output_dir, n_games, games_per_file=10000, n_players=200, seed=0, pool_size=500, plus_min_plus_sec=[90, 30, 30]):
+    rng = random.Random(seed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    pool = [random_move_sequence(rng) for _ in range(min(pool_size, n_games))]
+    game_index = 0
+    file_index = 0
+    while game_index < n_games:
+        file_path = os.path.join(output_dir, f"synthetic_{file_index:04d}.pgn")
+        with open(file_path, 'w') as f:
+            for _ in range(min(games_per_file, n_games - game_index)):
+                san_moves, alternatives = pool[rng.randrange(len(pool))]
+                movetext, result = annotated_movetext(rng, san_moves, alternatives, plus_min_plus_sec)
+                year = 1886 + game_index % 139
+                f.write(game_headers(rng, game_index, n_players, year, result))
+                f.write(f"\n\n{movetext} {result}\n\n")
+                game_index += 1
+        file_index += 1
+    return file_index
+
+if __name__ == "__main__":
+    start_time = time.time()
+    # Example usage:
+    output_dir = '/path/to/synthetic_corpus'
+    n_games = 10000
+    main_generate_corpus(output_dir, n_games)
+    print("Corpus generated in {:.2f} minutes".format((time.time() - start_time) / 60.0))
@@ -0,0 +1,96 @@
+"""
+This script probes local Syzygy endgame tablebases (https://syzygy-tables.info) with chess.syzygy before a position is
+sent to an engine. Positions with few enough pieces get their exact result, translated into the conventions of the
+annotators: [%eval 100.0] / [%eval -100.0] / [%eval 0.0] and [%wdl [1.00, 0.00, 0.00]] etc. from White's point of
+view, as for positions where the game is over. Wins and losses that the fifty-move rule turns into draws (cursed wins,
+blessed losses) count as draws. The probes, hits and the estimated engine time saved are reported.
+"""
+
+import chess
+import chess.syzygy
+import instrumentation
+import os
+
+# Evaluation in pawns of a won position, the same as for a finished game in the Lc0 annotator
+TABLEBASE_WIN_EVAL = 100.0
+
+# Function to convert a Syzygy WDL value from White's point of view (2 win, 1 cursed win, 0 draw, -1 blessed loss,
+# -2 loss) to an evaluation in pawns
+def tablebase_eval(wdl):
+    if wdl == 2:
+        return TABLEBASE_WIN_EVAL
+    if wdl == -2:
+        return -TABLEBASE_WIN_EVAL
+    return 0.0
+
+# Function to convert a Syzygy WDL value from White's point of view to win, draw and loss probabilities
+def tablebase_wdl_probabilities(wdl):
+    if wdl == 2:
+        return [1.0, 0.0, 0.0]
+    if wdl == -2:
+        return [0.0, 0.0, 1.0]
+    return [0.0, 1.0, 0.0]
+
+# The Syzygy tables of one or more directories (separated by os.pathsep, as for the engines' SyzygyPath option),
+# with probe statistics. Use one instance per thread.
+class SyzygyTablebase:
+    def __init__(self, syzygy_path):
+        directories = syzygy_path.split(os.pathsep)
+        self.tablebase = chess.syzygy.open_tablebase(directories[0])
+        for directory in directories[1:]:
+            self.tablebase.add_directory(directory)
+        # Table names such as 'KRPvKR' have one letter per piece and the 'v'
+        self.max_pieces = max((len(name) - 1 for name in self.tablebase.wdl), default=0)
+        self.probes = 0
+        self.hits = 0
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    # Function to get the exact result of a position from White's point of view, or None if it is not in the tables
+    def probe(self, board):
+        if chess.popcount(board.occupied) > self.max_pieces or board.castling_rights:
+            return None
+        self.probes += 1
+        wdl = self.tablebase.get_wdl(board)
+        instrumentation.cache_lookup('tablebase', wdl is not None)
+        if wdl is None:
+            return None
+        self.hits += 1
+        return wdl if board.turn == chess.WHITE else -wdl
+
+    # Record the wall time of an engine search, used to estimate the time saved by the hits
+    def record_search(self, seconds):
+        self.searches += 1
+        self.search_seconds += seconds
+
+    def summary(self):
+        seconds_per_search = self.search_seconds / self.searches if self.searches else 0.0
+        return {
+            'tablebase_probes': self.probes,
+            'tablebase_hits': self.hits,
+            'engine_searches': self.searches,
+            'estimated_seconds_saved': round(self.hits * seconds_per_search, 2),
+        }
+
+    # Print the summary and add the time saved to the run report
+    def report(self, name=''):
+        summary = self.summary()
+        instrumentation.count('tablebase_seconds_saved', summary['estimated_seconds_saved'])
+        print(f"Syzygy {name}: {summary['tablebase_hits']} of {summary['tablebase_probes']} probes found, "
+              f"{summary['engine_searches']} engine searches, about {summary['estimated_seconds_saved']} seconds saved")
+
+    def close(self):
+        self.tablebase.close()
+
+# Function to open the tablebase, or None if no path is given
+def open_syzygy(syzygy_path):
+    return SyzygyTablebase(syzygy_path) if syzygy_path else None
+
+if __name__ == "__main__":
+    # Example usage:
+    syzygy_path = '/path/to/syzygy'
+    tablebase = open_syzygy(syzygy_path)
+    board = chess.Board('8/8/8/8/8/4k3/4P3/4K3 w - - 0 1')
+    wdl = tablebase.probe(board)
+    print(wdl, tablebase_eval(wdl), tablebase_wdl_probabilities(wdl))
+    tablebase.close()
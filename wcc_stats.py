@@ -1,9 +1,11 @@
+import instrumentation
 import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
 # Define the function to process the directory
+@instrumentation.timed_stage('wcc_stats')
 def process_chess_data(directory_path):
     # Dictionary to store average missed_points per year
     avg_missed_points_per_year = {}